@@ -0,0 +1,66 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Size bounded, least recently used cache whose entries expire `ttl`
+    seconds after they were set.
+
+    Every invalidation bumps `generation`. Readers take the generation
+    before loading a value from the backing store and pass it to `set`, so
+    a value loaded before a concurrent write is never cached after the
+    write invalidated it.
+
+    """
+
+    def __init__(self, maxsize, ttl, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > self.timer():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def set(self, key, value, generation):
+        if not self.enabled or generation != self.generation:
+            return
+        self._entries[key] = (value, self.timer() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        self.generation += 1
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+        }
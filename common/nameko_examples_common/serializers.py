@@ -0,0 +1,97 @@
+"""
+Serializers compiled from marshmallow schemas, shared by the services.
+
+`compile_serializer` generates, once, a plain function building the same
+dict as `schema.dump(obj).data`: same keys, in the same order, with the
+same values, so that it serializes to the same JSON. The per-call cost of
+instantiating the schema, and of dispatching every value through field
+objects, is gone, which matters for large lists.
+
+Int, Str, Decimal and Nested fields are inlined; any other field, or one
+with a default, falls back to its own `serialize`.
+"""
+import decimal
+
+from marshmallow import fields, missing
+from marshmallow.utils import ensure_text_type
+
+
+def _get_value(obj, attr, default):
+    # like marshmallow, read keys of dicts and attributes of anything else
+    if isinstance(obj, dict):
+        return obj.get(attr, default)
+    return getattr(obj, attr, default)
+
+
+def _int(value):
+    return None if value is None else int(value)
+
+
+def _str(value):
+    if value is None or type(value) is str:
+        return value
+    return ensure_text_type(value)
+
+
+def _decimal(field):
+    def serialize(value):
+        if value is None:
+            return None
+        num = decimal.Decimal(str(value))
+        if field.places is not None and num.is_finite():
+            num = num.quantize(field.places, rounding=field.rounding)
+        return format(num, 'f') if field.as_string else num
+    return serialize
+
+
+def _nested(field):
+    serialize = compile_serializer(field.schema)
+    if field.many:
+        return lambda value: (
+            None if value is None else [serialize(item) for item in value])
+    return lambda value: None if value is None else serialize(value)
+
+
+def _converter(field):
+    if type(field) in (fields.Integer, fields.Int) and not field.as_string:
+        return _int
+    if type(field) in (fields.String, fields.Str):
+        return _str
+    if type(field) is fields.Decimal:
+        return _decimal(field)
+    if type(field) is fields.Nested:
+        return _nested(field)
+    return None
+
+
+def compile_serializer(schema):
+    """ Return a function serializing one object like `schema.dump`.
+    """
+    namespace = {'get_value': _get_value, 'missing': missing}
+    lines = ['def serialize(obj):', '    result = {}']
+    for index, (name, field) in enumerate(schema.fields.items()):
+        if field.load_only:
+            continue
+        attr = field.attribute or name
+        key = field.dump_to or name
+        converter = _converter(field)
+        if converter is None or field.default is not missing:
+            # let the field itself deal with defaults, methods and the like
+            namespace['field_{}'.format(index)] = field
+            lines += [
+                '    value = field_{}.serialize({!r}, obj)'.format(
+                    index, attr),
+                '    if value is not missing:',
+                '        result[{!r}] = value'.format(key),
+            ]
+            continue
+        namespace['convert_{}'.format(index)] = converter
+        lines += [
+            '    value = get_value(obj, {!r}, missing)'.format(attr),
+            '    if value is not missing:',
+            '        result[{!r}] = convert_{}(value)'.format(key, index),
+        ]
+    lines.append('    return result')
+
+    exec('\n'.join(lines), namespace)
+    return namespace['serialize']
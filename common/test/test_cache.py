@@ -0,0 +1,83 @@
+import pytest
+
+from nameko_examples_common.cache import TTLCache
+
+
+class Timer:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def timer():
+    return Timer()
+
+
+@pytest.fixture
+def cache(timer):
+    return TTLCache(maxsize=2, ttl=10, timer=timer)
+
+
+def test_get_miss(cache):
+    assert cache.get('LZ127') is None
+    assert {'hits': 0, 'misses': 1} == {
+        key: cache.stats()[key] for key in ('hits', 'misses')}
+
+
+def test_get_hit(cache):
+    cache.set('LZ127', {'id': 'LZ127'}, cache.generation)
+
+    assert {'id': 'LZ127'} == cache.get('LZ127')
+    assert {'hits': 1, 'misses': 0} == {
+        key: cache.stats()[key] for key in ('hits', 'misses')}
+
+
+def test_entries_expire(cache, timer):
+    cache.set('LZ127', {'id': 'LZ127'}, cache.generation)
+
+    timer.now = 10
+
+    assert cache.get('LZ127') is None
+    assert 0 == cache.stats()['size']
+
+
+def test_least_recently_used_entry_is_evicted(cache):
+    cache.set('LZ127', {'id': 'LZ127'}, cache.generation)
+    cache.set('LZ129', {'id': 'LZ129'}, cache.generation)
+    cache.get('LZ127')
+
+    cache.set('LZ130', {'id': 'LZ130'}, cache.generation)
+
+    assert cache.get('LZ129') is None
+    assert cache.get('LZ127') is not None
+    assert cache.get('LZ130') is not None
+
+
+def test_invalidate(cache):
+    cache.set('LZ127', {'id': 'LZ127'}, cache.generation)
+
+    cache.invalidate('LZ127')
+
+    assert cache.get('LZ127') is None
+
+
+def test_set_is_skipped_after_concurrent_invalidation(cache):
+    generation = cache.generation
+    cache.invalidate('LZ127')
+
+    cache.set('LZ127', {'id': 'LZ127'}, generation)
+
+    assert cache.get('LZ127') is None
+
+
+@pytest.mark.parametrize('maxsize, ttl', [(0, 10), (2, 0)])
+def test_disabled(maxsize, ttl):
+    cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    cache.set('LZ127', {'id': 'LZ127'}, cache.generation)
+
+    assert cache.get('LZ127') is None
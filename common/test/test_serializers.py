@@ -0,0 +1,58 @@
+import json
+from decimal import Decimal
+
+from marshmallow import Schema, fields
+
+from nameko_examples_common.serializers import compile_serializer
+
+
+class DetailSchema(Schema):
+    id = fields.Int()
+    price = fields.Decimal(as_string=True)
+    rounded = fields.Decimal(places=1)
+
+
+class OrderSchema(Schema):
+    id = fields.Int(as_string=True)
+    reference = fields.Str()
+    details = fields.Nested(DetailSchema, many=True)
+    first_detail = fields.Nested(DetailSchema)
+
+
+def test_inlined_fields_match_schema():
+    order = {
+        'id': 1,
+        'reference': b'A-1',
+        'details': [
+            {'id': '1', 'price': '99.51', 'rounded': Decimal('1.25')},
+            {'id': 2, 'price': None, 'rounded': None},
+        ],
+        'first_detail': None,
+    }
+
+    # same keys, in the same order, with the same values
+    assert json.dumps(
+        compile_serializer(OrderSchema())(order), default=repr
+    ) == json.dumps(OrderSchema().dump(order).data, default=repr)
+
+
+def test_missing_values_are_left_out():
+    assert {} == compile_serializer(OrderSchema())({})
+
+
+def test_compile_serializer_honours_field_options():
+
+    class ProductSchema(Schema):
+        name = fields.Str(attribute='title', dump_to='product_name')
+        secret = fields.Str(load_only=True)
+        created = fields.DateTime()
+        in_stock = fields.Int(default=0)
+        label = fields.Method('get_label')
+
+        def get_label(self, obj):
+            return obj['title'].upper()
+
+    product = {'title': 'The Odyssey', 'secret': 'x', 'created': None}
+
+    assert compile_serializer(ProductSchema())(product) == (
+        ProductSchema().dump(product).data)
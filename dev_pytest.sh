@@ -1,3 +1,8 @@
-coverage run -m pytest gateway/test 
+# the code shared by the services is not installed in the dev environment
+export PYTHONPATH=./common
+
+coverage run -m pytest common/test
+coverage run --append -m pytest gateway/test 
 coverage run --append -m pytest orders/test
-coverage run --append -m pytest products/test
\ No newline at end of file
+coverage run --append -m pytest products/test
+coverage run --append -m pytest gateapi/test
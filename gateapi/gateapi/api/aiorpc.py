@@ -0,0 +1,336 @@
+"""
+Asyncio-native client for Nameko RPC.
+
+Speaks the same AMQP protocol as nameko's `ClusterRpcClient`: requests are
+published to the RPC exchange with the routing key `<service>.<method>` and
+replies come back on a reply queue bound to that exchange, matched to their
+request by correlation id. Calls are awaitable, so a single event loop can
+keep hundreds of them in flight without blocking a thread for each.
+"""
+import asyncio
+import json
+import logging
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+import aio_pika
+from aio_pika.exceptions import DeliveryError
+from nameko.exceptions import UnknownService, deserialize
+
+RPC_EXCHANGE = 'nameko-rpc'
+RPC_REPLY_QUEUE_TEMPLATE = 'rpc.reply-gateapi-{}'
+RPC_REPLY_QUEUE_TTL = 300000  # ms (5 mins)
+
+logger = logging.getLogger(__name__)
+
+
+class RpcPoolExhausted(Exception):
+    """ Raised when no slot for a call frees up within the acquire timeout.
+    """
+    pass
+
+
+class MethodProxy(object):
+    def __init__(self, client, service_name, method_name):
+        self.client = client
+        self.service_name = service_name
+        self.method_name = method_name
+
+    def __call__(self, *args, **kwargs):
+        return self.client.call(
+            self.service_name, self.method_name, *args, **kwargs)
+
+
+class ServiceProxy(object):
+    def __init__(self, client, service_name):
+        self.client = client
+        self.service_name = service_name
+
+    def __getattr__(self, method_name):
+        return MethodProxy(self.client, self.service_name, method_name)
+
+
+class ClusterProxy(object):
+    """ Gives the `nameko.<service>.<method>(...)` call style of nameko's
+    standalone client, with every call returning an awaitable.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, service_name):
+        return ServiceProxy(self.client, service_name)
+
+
+class AsyncRpcClient(object):
+    """ A single AMQP connection multiplexing any number of concurrent calls.
+    *Usage*
+        client = AsyncRpcClient(uri)
+        await client.start()
+        # ...
+        product = await client.call('products', 'get', 'the_odyssey')
+        # ...
+        await client.stop()
+    """
+
+    def __init__(self, uri, timeout=None, exchange=RPC_EXCHANGE):
+        self.uri = uri
+        self.timeout = timeout
+        self.exchange_name = exchange
+        self.reply_to = str(uuid.uuid4())
+        self.pending = {}
+
+    async def start(self):
+        self.connection = await aio_pika.connect_robust(self.uri)
+        # with publisher confirms, a mandatory message that no queue is bound
+        # for (an unknown service) raises `DeliveryError` instead of being
+        # dropped, which would leave the call waiting forever
+        self.channel = await self.connection.channel(on_return_raises=True)
+        self.exchange = await self.channel.declare_exchange(
+            self.exchange_name, aio_pika.ExchangeType.TOPIC, durable=True)
+
+        queue = await self.channel.declare_queue(
+            RPC_REPLY_QUEUE_TEMPLATE.format(self.reply_to),
+            auto_delete=True,
+            arguments={'x-expires': RPC_REPLY_QUEUE_TTL},
+        )
+        await queue.bind(self.exchange, routing_key=self.reply_to)
+        await queue.consume(self._on_reply, no_ack=True)
+
+    @property
+    def is_connected(self):
+        return self.connection.connected.is_set()
+
+    @property
+    def is_closed(self):
+        """ Whether the connection was closed for good, rather than lost
+        and being reconnected.
+        """
+        return self.connection.is_closed
+
+    async def stop(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        await self.connection.close()
+
+    async def _on_reply(self, message):
+        future = self.pending.pop(message.correlation_id, None)
+        if future is None or future.done():
+            return
+
+        reply = json.loads(message.body)
+        if reply['error'] is not None:
+            future.set_exception(deserialize(reply['error']))
+        else:
+            future.set_result(reply['result'])
+
+    async def call(self, service_name, method_name, *args, **kwargs):
+        correlation_id = str(uuid.uuid4())
+        future = asyncio.get_event_loop().create_future()
+        self.pending[correlation_id] = future
+
+        message = aio_pika.Message(
+            body=json.dumps({'args': args, 'kwargs': kwargs}).encode('utf-8'),
+            content_type='application/json',
+            content_encoding='utf-8',
+            correlation_id=correlation_id,
+            reply_to=self.reply_to,
+        )
+        try:
+            await self.exchange.publish(
+                message,
+                routing_key='{}.{}'.format(service_name, method_name),
+                mandatory=True,
+            )
+            return await asyncio.wait_for(future, self.timeout)
+        except DeliveryError:
+            raise UnknownService(service_name)
+        finally:
+            self.pending.pop(correlation_id, None)
+
+
+class AsyncRpcClientPool(object):
+    """ Pool of `AsyncRpcClient` connections for the Nameko RPC cluster.
+
+    Every client multiplexes its calls, so connections only spread the
+    load. The pool opens `pool_size` of them and grows on demand up to
+    `max_size`, when every connection is already lent to `connection_share`
+    callers. Connections above `pool_size` that are not lent for
+    `idle_timeout` seconds are closed. Connections that are reconnecting
+    are lent last, and one closed for good is replaced.
+
+    Back-pressure comes from `max_in_flight`: at most that many `next()`
+    blocks (typically one per request) run at once, and a caller that
+    cannot get a slot within `acquire_timeout` seconds gets
+    `RpcPoolExhausted`.
+    *Usage*
+        pool = AsyncRpcClientPool(uri)
+        await pool.start()
+        # ...
+        async with pool.next() as nameko:
+            await nameko.mailer.send_mail(foo='bar')
+        # ...
+        pool.stats()
+        # ...
+        await pool.stop()
+    """
+
+    def __init__(
+        self, uri, timeout=None, pool_size=2, max_size=None,
+        connection_share=100, idle_timeout=60, max_in_flight=500,
+        acquire_timeout=None, timer=time.monotonic
+    ):
+        self.uri = uri
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.max_size = max(max_size or pool_size, pool_size)
+        self.connection_share = connection_share
+        self.idle_timeout = idle_timeout
+        self.max_in_flight = max_in_flight
+        self.acquire_timeout = acquire_timeout
+        self.timer = timer
+
+    async def start(self):
+        """ Open the pool connections.
+        """
+        self.clients = []
+        self._lent = {}
+        self._last_used = {}
+        self._opening = 0
+        self.in_use = 0
+        self.created = 0
+        self.failed = 0
+        self.discarded = 0
+        self.exhausted = 0
+        self.waits = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        await asyncio.gather(*(self._open() for _ in range(self.pool_size)))
+
+    async def _open(self):
+        self._opening += 1
+        try:
+            client = AsyncRpcClient(self.uri, timeout=self.timeout)
+            await client.start()
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self._opening -= 1
+        self.created += 1
+        self.clients.append(client)
+        self._lent[client] = 0
+        self._last_used[client] = self.timer()
+        return client
+
+    def _discard(self, client):
+        if client not in self._lent:
+            return
+        self.clients.remove(client)
+        del self._lent[client]
+        del self._last_used[client]
+        self.discarded += 1
+        asyncio.ensure_future(client.stop())
+
+    def _should_grow(self, client):
+        size = len(self.clients) + self._opening
+        if client is None or size < self.pool_size:
+            return True
+        busy = (
+            not client.is_connected or
+            self._lent[client] >= self.connection_share
+        )
+        return busy and size < self.max_size
+
+    async def _checkout(self):
+        """ Pick the least loaded connection, opening a new one if the pool
+        can and should grow.
+        """
+        for client in [client for client in self.clients if client.is_closed]:
+            self._discard(client)
+
+        client = min(
+            self.clients, default=None,
+            key=lambda client: (not client.is_connected, self._lent[client])
+        )
+        if self._should_grow(client):
+            try:
+                return await self._open()
+            except Exception:
+                if client is None:
+                    raise
+                logger.warning(
+                    'Failed to open an RPC connection', exc_info=True)
+        return client
+
+    def _reap_idle(self):
+        """ Close connections above `pool_size` not lent for `idle_timeout`.
+        """
+        now = self.timer()
+        surplus = len(self.clients) - self.pool_size
+        idle = [
+            client for client in self.clients
+            if not self._lent[client] and
+            now - self._last_used[client] > self.idle_timeout
+        ]
+        for client in idle[:max(surplus, 0)]:
+            self._discard(client)
+
+    @asynccontextmanager
+    async def next(self):
+        """ Reserve a slot for calls and lend the least loaded connection.
+        """
+        started = self.timer()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.exhausted += 1
+            raise RpcPoolExhausted(
+                'No RPC slot available after {}s'.format(self.acquire_timeout))
+        try:
+            client = await self._checkout()
+            waited = self.timer() - started
+            self.waits += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+            self._lent[client] += 1
+            self.in_use += 1
+            try:
+                yield ClusterProxy(client)
+            finally:
+                self.in_use -= 1
+                if client in self._lent:
+                    self._lent[client] -= 1
+                    self._last_used[client] = self.timer()
+                self._reap_idle()
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        """ Pool size and usage counters.
+        """
+        return {
+            'size': len(self.clients),
+            'idle': sum(1 for lent in self._lent.values() if not lent),
+            'in_use': self.in_use,
+            'min_size': self.pool_size,
+            'max_size': self.max_size,
+            'max_in_flight': self.max_in_flight,
+            'created': self.created,
+            'failed': self.failed,
+            'discarded': self.discarded,
+            'exhausted': self.exhausted,
+            'waits': self.waits,
+            'wait_time_total': self.wait_time_total,
+            'wait_time_max': self.wait_time_max,
+        }
+
+    async def stop(self):
+        """ Close all the pool connections.
+        """
+        clients, self.clients = self.clients, []
+        self._lent.clear()
+        self._last_used.clear()
+        await asyncio.gather(*(client.stop() for client in clients))
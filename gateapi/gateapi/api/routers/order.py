@@ -1,36 +1,92 @@
+import asyncio
 from os import name
-from fastapi import APIRouter, status, HTTPException
+from fastapi import APIRouter, Query, status, HTTPException
 from fastapi.params import Depends
-from typing import List
+from typing import List, Optional
+from pydantic import ValidationError
+from nameko.exceptions import BadRequest, RemoteError, UnknownService
 from gateapi.api import schemas
 from gateapi.api.dependencies import get_rpc, config
-from .exceptions import OrderNotFound
+from gateapi.api.streaming import ndjson_response
+from .exceptions import InvalidCursor, OrderNotFound, OutOfStock, ProductNotFound
+
+# Errors meaning that the orders service did not create an order: it
+# replied with an error, after rolling its transaction back, or the call was
+# never delivered. Any other error, such as a timeout or a cancelled
+# request, may come after the order was committed, so the stock reserved
+# for it is kept.
+ORDER_NOT_CREATED_ERRORS = (RemoteError, BadRequest, UnknownService)
 
 router = APIRouter(
     prefix = "/orders",
     tags = ['Orders']
 )
 
+@router.get("", status_code=status.HTTP_200_OK)
+async def list_orders(
+    page: int = 1,
+    per_page: int = 10,
+    count: str = Query('exact', regex='^(exact|estimate|cached)$'),
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    summary: bool = False,
+    rpc = Depends(get_rpc)
+):
+    # `after`/`before` take the `next_cursor`/`prev_cursor` of a previous
+    # page and seek to the following/preceding one instead of using `page`.
+    # `summary` lists the orders' totals without their details.
+    if after and before:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Only one of after and before can be given"
+        )
+    try:
+        async with rpc.next() as nameko:
+            return await nameko.orders.list_orders(
+                page=page, per_page=per_page, count=count,
+                after=after, before=before, summary=summary
+            )
+    except InvalidCursor as error:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(error)
+        )
+
+@router.get("/export", status_code=status.HTTP_200_OK)
+async def export_orders(rpc = Depends(get_rpc)):
+    # Streams all the orders, with their details, as newline delimited
+    # json, one order per line. Declared before `/{order_id}`, which would
+    # reject it as an invalid id.
+    chunk_size = int(config.get('EXPORT_CHUNK_SIZE', 500))
+    return ndjson_response(
+        rpc,
+        lambda nameko, cursor: nameko.orders.export_orders(
+            after=cursor, limit=chunk_size),
+        'orders'
+    )
+
 @router.get("/{order_id}", status_code=status.HTTP_200_OK)
-def get_order(order_id: int, rpc = Depends(get_rpc)):
+async def get_order(order_id: int, rpc = Depends(get_rpc)):
     try:
-        return _get_order(order_id, rpc)
+        return await _get_order(order_id, rpc)
     except OrderNotFound as error:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=str(error)
         )
 
-def _get_order(order_id, nameko_rpc):
+async def _get_order(order_id, nameko_rpc):
     # Retrieve order data from the orders service.
     # Note - this may raise a remote exception that has been mapped to
     # raise``OrderNotFound``
-    with nameko_rpc.next() as nameko:
-        order = nameko.orders.get_order(order_id)
+    async with nameko_rpc.next() as nameko:
+        order = await nameko.orders.get_order(order_id)
 
-    # Retrieve all products from the products service
-    with nameko_rpc.next() as nameko:
-        product_map = {prod['id']: prod for prod in nameko.products.list()}
+    # Retrieve the products of the order from the products service
+    async with nameko_rpc.next() as nameko:
+        product_map = await _get_product_map(
+            [item['product_id'] for item in order['order_details']], nameko
+        )
 
     # get the configured image root
     image_root = config['PRODUCT_IMAGE_ROOT']
@@ -46,23 +102,121 @@ def _get_order(order_id, nameko_rpc):
     return order
 
 @router.post("", status_code=status.HTTP_200_OK, response_model=schemas.CreateOrderSuccess)
-def create_order(request: schemas.CreateOrder, rpc = Depends(get_rpc)):
-    id_ =  _create_order(request.dict(), rpc)
+async def create_order(request: schemas.CreateOrder, rpc = Depends(get_rpc)):
+    id_ = await _create_order(request.dict(), rpc)
     return {
         'id': id_
     }
 
-def _create_order(order_data, nameko_rpc):
-    # check order product ids are valid
-    with nameko_rpc.next() as nameko:
-        valid_product_ids = {prod['id'] for prod in nameko.products.list()}
-        for item in order_data['order_details']:
-            if item['product_id'] not in valid_product_ids:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                    detail=f"Product with id {item['product_id']} not found"
+async def _create_order(order_data, nameko_rpc):
+    order_details = order_data['order_details']
+    async with nameko_rpc.next() as nameko:
+        # Take the order's stock off its products, in one atomic call that
+        # also checks that every product exists and is in stock
+        try:
+            await nameko.products.reserve_stock(order_details)
+        except ProductNotFound as error:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=str(error)
+            )
+        except OutOfStock as error:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=str(error)
+            )
+        # Call orders-service to create the order, putting the stock back
+        # if it was not created.
+        try:
+            result = await nameko.orders.create_order(
+                order_details, stock_reserved=True
             )
-        # Call orders-service to create the order.
-        result = nameko.orders.create_order(
-            order_data['order_details']
+        except ORDER_NOT_CREATED_ERRORS:
+            await nameko.products.release_stock(order_details)
+            raise
+        return result['id']
+
+@router.post("/batch", status_code=status.HTTP_200_OK, response_model=schemas.CreateOrdersSuccess, response_model_exclude_none=True)
+async def create_orders(request: schemas.CreateOrders, rpc = Depends(get_rpc)):
+    return {
+        'results': await _create_orders(request.orders, rpc)
+    }
+
+async def _create_orders(orders, nameko_rpc):
+    # Every order succeeds or fails on its own, and gets a result in the
+    # order it was posted
+    results = [None] * len(orders)
+
+    valid = {}
+    for index, order in enumerate(orders):
+        try:
+            valid[index] = schemas.CreateOrder.parse_obj(order).dict()
+        except ValidationError as error:
+            results[index] = {
+                'error': 'VALIDATION_ERROR', 'message': error.errors()
+            }
+
+    async with nameko_rpc.next() as nameko:
+        # look all the products of the batch up at once
+        product_ids = list(dict.fromkeys(
+            item['product_id']
+            for order_data in valid.values()
+            for item in order_data['order_details']
+        ))
+        existing = {
+            prod['id'] for prod in await nameko.products.get_many(product_ids)
+        } if product_ids else set()
+        for index, order_data in list(valid.items()):
+            for item in order_data['order_details']:
+                if item['product_id'] not in existing:
+                    results[index] = {
+                        'error': 'PRODUCT_NOT_FOUND',
+                        'message': f"Product with id {item['product_id']} not found"
+                    }
+                    del valid[index]
+                    break
+
+        # create the valid orders in batches, each inserted in a single
+        # transaction by the orders service, all in flight at once
+        batch_size = int(config.get('ORDERS_BATCH_SIZE', 500))
+        indexes = list(valid)
+        batches = [
+            indexes[start:start + batch_size]
+            for start in range(0, len(indexes), batch_size)
+        ]
+        replies = await asyncio.gather(
+            *(
+                nameko.orders.create_orders(
+                    [valid[index] for index in batch]
+                )
+                for batch in batches
+            ),
+            return_exceptions=True
         )
-        return result['id']
\ No newline at end of file
+
+    for batch, reply in zip(batches, replies):
+        if isinstance(reply, Exception):
+            for index in batch:
+                results[index] = {
+                    'error': 'UNEXPECTED_ERROR', 'message': str(reply)
+                }
+        else:
+            for index, order in zip(batch, reply):
+                results[index] = {'id': order['id']}
+
+    return results
+
+async def _get_product_map(product_ids, nameko):
+    # Fetch only the given products, in a single call, rather than listing
+    # the whole catalogue.
+    product_ids = list(dict.fromkeys(product_ids))
+    product_map = {
+        prod['id']: prod
+        for prod in await nameko.products.get_many(product_ids)
+    }
+    for product_id in product_ids:
+        if product_id not in product_map:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"Product with id {product_id} not found"
+            )
+    return product_map
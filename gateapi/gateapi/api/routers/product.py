@@ -1,7 +1,8 @@
 from fastapi import APIRouter, status, HTTPException
 from fastapi.params import Depends
-from gateapi.api.dependencies import get_rpc
+from gateapi.api.dependencies import get_rpc, config
 from gateapi.api import schemas
+from gateapi.api.streaming import ndjson_response
 from .exceptions import ProductNotFound
 
 router = APIRouter(
@@ -9,11 +10,24 @@ router = APIRouter(
     tags = ["Products"]
 )
 
+@router.get("/export", status_code=status.HTTP_200_OK)
+async def export_products(rpc = Depends(get_rpc)):
+    # Streams the whole catalogue as newline delimited json, one product
+    # per line, in no particular order. Declared before `/{product_id}`,
+    # which would match it too.
+    chunk_size = int(config.get('EXPORT_CHUNK_SIZE', 500))
+    return ndjson_response(
+        rpc,
+        lambda nameko, cursor: nameko.products.export(
+            cursor=cursor or 0, count=chunk_size),
+        'products'
+    )
+
 @router.get("/{product_id}", status_code=status.HTTP_200_OK, response_model=schemas.Product)
-def get_product(product_id: str, rpc = Depends(get_rpc)):
+async def get_product(product_id: str, rpc = Depends(get_rpc)):
     try: 
-        with rpc.next() as nameko:
-            return nameko.products.get(product_id)
+        async with rpc.next() as nameko:
+            return await nameko.products.get(product_id)
     except ProductNotFound as error:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -21,9 +35,9 @@ def get_product(product_id: str, rpc = Depends(get_rpc)):
         )
 
 @router.post("", status_code=status.HTTP_200_OK, response_model=schemas.CreateProductSuccess)
-def create_product(request: schemas.Product, rpc = Depends(get_rpc)):
-    with rpc.next() as nameko:
-        nameko.products.create(request.dict())
+async def create_product(request: schemas.Product, rpc = Depends(get_rpc)):
+    async with rpc.next() as nameko:
+        await nameko.products.create(request.dict())
         return {
             "id": request.id
         }
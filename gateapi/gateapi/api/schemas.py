@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import List
+from pydantic import BaseModel, conint
+from typing import Any, List, Optional
 
 class Product(BaseModel):
     id: str
@@ -12,7 +12,7 @@ class Product(BaseModel):
 class CreateOrderDetail(BaseModel):
     product_id: str
     price: float
-    quantity: int
+    quantity: conint(gt=0)
 
 class CreateOrder(BaseModel):
     order_details: List[CreateOrderDetail]
@@ -20,5 +20,18 @@ class CreateOrder(BaseModel):
 class CreateOrderSuccess(BaseModel):
     id: int
 
+class CreateOrders(BaseModel):
+    # items are validated one by one against `CreateOrder`, so that an
+    # invalid order only fails itself rather than the whole batch
+    orders: List[dict]
+
+class CreateOrdersResult(BaseModel):
+    id: Optional[int]
+    error: Optional[str]
+    message: Optional[Any]
+
+class CreateOrdersSuccess(BaseModel):
+    results: List[CreateOrdersResult]
+
 class CreateProductSuccess(BaseModel):
     id: str
\ No newline at end of file
@@ -0,0 +1,44 @@
+"""
+Streaming of whole collections as newline delimited json, chunk by chunk.
+"""
+import asyncio
+import json
+
+from fastapi.responses import StreamingResponse
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+
+def ndjson_response(rpc, export_chunk, key):
+    """ Stream the items under `key` of the chunks `export_chunk` replies
+    with, one json document per line.
+
+    `export_chunk(nameko, cursor)` asks for the chunk at `cursor` (None for
+    the first one) and its reply has the `next_cursor`, None after the last
+    chunk. The next chunk is asked for before the current one is sent, so
+    at most two chunks are held whatever the size of the export, and an RPC
+    slot is only held while a chunk is fetched, not for the whole download.
+    """
+    async def fetch(cursor):
+        async with rpc.next() as nameko:
+            return await export_chunk(nameko, cursor)
+
+    async def lines():
+        pending = asyncio.ensure_future(fetch(None))
+        try:
+            while pending is not None:
+                chunk = await pending
+                next_cursor = chunk['next_cursor']
+                pending = (
+                    asyncio.ensure_future(fetch(next_cursor))
+                    if next_cursor is not None else None
+                )
+                if chunk[key]:
+                    yield ''.join(
+                        json.dumps(item) + '\n' for item in chunk[key])
+        finally:
+            # the client went away
+            if pending is not None:
+                pending.cancel()
+
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE)
@@ -1,7 +1,8 @@
-import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, status
+from fastapi.responses import JSONResponse
+from gateapi.api.aiorpc import RpcPoolExhausted
 from gateapi.api.routers import order, product
-from gateapi.api.dependencies import destroy_nameko_pool, config
+from gateapi.api.dependencies import start_nameko_pool, destroy_nameko_pool, config
 
 app = FastAPI()
 
@@ -9,15 +10,24 @@ app = FastAPI()
 app.include_router(order.router)
 app.include_router(product.router)
 
+# Too many calls in flight: ask the client to back off
+@app.exception_handler(RpcPoolExhausted)
+async def rpc_pool_exhausted_handler(request: Request, exc: RpcPoolExhausted):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={'detail': str(exc)}
+    )
+
 # Setting up nameko cluster rpc client pool connections
 @app.on_event("startup")
 async def startup_event():
-    pass
+    await start_nameko_pool()
 
 @app.on_event("shutdown")
 async def shutdown_event():
     # stopping nameko rpc pool
-    destroy_nameko_pool()
+    await destroy_nameko_pool()
 
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run("gateapi.main:app", host="0.0.0.0", port=config['PORT'], workers=config['WEB_CONCURRENCY'])
\ No newline at end of file
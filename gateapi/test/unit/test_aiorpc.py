@@ -0,0 +1,259 @@
+import asyncio
+import json
+
+import pytest
+from aio_pika.exceptions import DeliveryError
+from mock import AsyncMock, Mock, patch
+from nameko.exceptions import MethodNotFound, RemoteError, UnknownService
+
+from gateapi.api.aiorpc import (
+    AsyncRpcClient, AsyncRpcClientPool, RpcPoolExhausted)
+
+
+class Timer:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeClient:
+
+    def __init__(self, uri, timeout=None):
+        self.is_connected = True
+        self.is_closed = False
+        self.stopped = False
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        self.stopped = True
+
+
+@pytest.fixture
+def run():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture
+def client(run):
+    client = AsyncRpcClient('memory://', timeout=0.01)
+    client.exchange = Mock(publish=AsyncMock())
+    return client
+
+
+def reply(correlation_id, result=None, error=None):
+    return Mock(
+        correlation_id=correlation_id,
+        body=json.dumps({'result': result, 'error': error}).encode('utf-8'))
+
+
+@pytest.fixture
+def timer():
+    return Timer()
+
+
+@pytest.fixture
+def pool(run, timer):
+    pool = AsyncRpcClientPool(
+        'memory://', pool_size=1, max_size=2, connection_share=2,
+        idle_timeout=10, max_in_flight=5, acquire_timeout=0.01, timer=timer)
+    with patch('gateapi.api.aiorpc.AsyncRpcClient', FakeClient):
+        run(pool.start())
+        yield pool
+    run(pool.stop())
+
+
+async def hold(pool, count):
+    """ Enter `count` `next()` blocks and return their proxies, with the
+    function that exits them.
+    """
+    blocks = [pool.next() for _ in range(count)]
+    proxies = [await block.__aenter__() for block in blocks]
+
+    async def release():
+        for block in blocks:
+            await block.__aexit__(None, None, None)
+    return proxies, release
+
+
+def test_reply_resolves_pending_call(run, client):
+    future = client.pending['id'] = asyncio.get_event_loop().create_future()
+
+    run(client._on_reply(reply('id', result={'id': 1})))
+
+    assert {'id': 1} == future.result()
+    assert {} == client.pending
+
+
+def test_error_reply_raises_remote_error(run, client):
+    future = client.pending['id'] = asyncio.get_event_loop().create_future()
+
+    run(client._on_reply(reply('id', error={
+        'exc_path': 'orders.exceptions.Boom', 'exc_type': 'Boom',
+        'value': 'boom', 'exc_args': []
+    })))
+
+    with pytest.raises(RemoteError) as exc:
+        future.result()
+    assert 'Boom' == exc.value.exc_type
+
+
+def test_error_reply_raises_registered_exception(run, client):
+    future = client.pending['id'] = asyncio.get_event_loop().create_future()
+
+    run(client._on_reply(reply('id', error={
+        'exc_path': 'nameko.exceptions.MethodNotFound',
+        'exc_type': 'MethodNotFound', 'value': 'get', 'exc_args': ['get']
+    })))
+
+    with pytest.raises(MethodNotFound):
+        future.result()
+
+
+def test_reply_with_unknown_correlation_id_is_dropped(run, client):
+    future = client.pending['id'] = asyncio.get_event_loop().create_future()
+
+    run(client._on_reply(reply('unknown', result=1)))
+
+    assert not future.done()
+    assert ['id'] == list(client.pending)
+
+
+def test_late_reply_is_dropped(run, client):
+    future = client.pending['id'] = asyncio.get_event_loop().create_future()
+    future.cancel()
+
+    run(client._on_reply(reply('id', result=1)))
+
+    assert future.cancelled()
+
+
+def test_call_returns_the_reply(run, client):
+
+    async def call():
+        calling = asyncio.ensure_future(client.call('orders', 'get_order', 1))
+        await asyncio.sleep(0)
+        message = client.exchange.publish.call_args[0][0]
+        assert {'args': [1], 'kwargs': {}} == json.loads(message.body)
+        await client._on_reply(reply(message.correlation_id, result='order'))
+        return await calling
+
+    assert 'order' == run(call())
+    assert 'orders.get_order' == (
+        client.exchange.publish.call_args[1]['routing_key'])
+    assert {} == client.pending
+
+
+def test_call_timeout_forgets_the_call(run, client):
+    with pytest.raises(asyncio.TimeoutError):
+        run(client.call('orders', 'get_order', 1))
+
+    assert {} == client.pending
+
+
+def test_undeliverable_call_raises_unknown_service(run, client):
+    client.exchange.publish.side_effect = DeliveryError(None, None)
+
+    with pytest.raises(UnknownService):
+        run(client.call('nowhere', 'get', 1))
+
+    assert {} == client.pending
+
+
+def test_next_raises_when_no_slot_frees_up(run, pool):
+    _, release = run(hold(pool, 5))
+
+    with pytest.raises(RpcPoolExhausted):
+        run(hold(pool, 1))
+    assert 1 == pool.stats()['exhausted']
+
+    run(release())
+    _, release = run(hold(pool, 5))
+    run(release())
+
+
+def test_next_releases_its_slot_on_error(run, pool):
+
+    async def fail():
+        async with pool.next():
+            raise ValueError('boom')
+
+    for _ in range(6):
+        with pytest.raises(ValueError):
+            run(fail())
+
+    assert 0 == pool.stats()['in_use']
+
+
+def test_start_opens_pool_size_connections(pool):
+    assert 1 == len(pool.clients)
+    assert 1 == pool.stats()['created']
+
+
+def test_grows_when_every_connection_is_shared(run, pool):
+    proxies, release = run(hold(pool, 3))
+
+    assert 2 == len(pool.clients)
+    assert [pool.clients[0]] * 2 + [pool.clients[1]] == [
+        proxy.client for proxy in proxies]
+    run(release())
+
+
+def test_never_grows_above_max_size(run, pool):
+    proxies, release = run(hold(pool, 5))
+
+    assert 2 == len(pool.clients)
+    assert 5 == pool.stats()['in_use']
+    run(release())
+
+
+def test_idle_surplus_connections_are_reaped(run, pool, timer):
+    _, release = run(hold(pool, 3))
+    run(release())
+    assert 2 == len(pool.clients)
+
+    timer.now = 11
+    _, release = run(hold(pool, 1))
+    run(release())
+
+    assert 1 == len(pool.clients)
+    assert 1 == pool.stats()['discarded']
+
+
+def test_closed_connection_is_replaced(run, pool):
+    closed = pool.clients[0]
+    closed.is_closed = True
+
+    (proxy,), release = run(hold(pool, 1))
+    run(release())
+
+    assert proxy.client is not closed
+    assert [proxy.client] == pool.clients
+    assert closed.stopped
+
+
+def test_reconnecting_connection_is_lent_last(run, pool):
+    pool.clients[0].is_connected = False
+
+    (proxy,), release = run(hold(pool, 1))
+    run(release())
+
+    assert 2 == len(pool.clients)
+    assert proxy.client is pool.clients[1]
+
+
+def test_stats(run, pool):
+    _, release = run(hold(pool, 1))
+    stats = pool.stats()
+    run(release())
+
+    assert (1, 0, 1, 1) == (
+        stats['size'], stats['idle'], stats['in_use'], stats['waits'])
+    assert 1 == pool.stats()['idle']
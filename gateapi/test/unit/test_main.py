@@ -0,0 +1,234 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+
+import pytest
+from fastapi.testclient import TestClient
+from mock import AsyncMock, Mock
+from nameko import config
+from nameko.exceptions import RemoteError
+
+from gateapi.api.aiorpc import RpcPoolExhausted
+from gateapi.api.dependencies import get_rpc
+from gateapi.api.streaming import ndjson_response
+from gateapi.main import app
+
+
+class Pool:
+    """ Lends `nameko`, or raises `exc` like a pool out of slots """
+
+    def __init__(self, nameko=None, exc=None):
+        self.nameko = nameko
+        self.exc = exc
+
+    @asynccontextmanager
+    async def next(self):
+        if self.exc is not None:
+            raise self.exc
+        yield self.nameko
+
+
+@pytest.fixture
+def nameko():
+    return Mock(
+        products=Mock(reserve_stock=AsyncMock(), release_stock=AsyncMock()),
+        orders=Mock(create_order=AsyncMock(return_value={'id': 11})),
+    )
+
+
+@pytest.fixture
+def client():
+    # no startup event, so no broker connection
+    yield TestClient(app, raise_server_exceptions=False)
+    app.dependency_overrides.clear()
+
+
+def use(pool):
+    app.dependency_overrides[get_rpc] = lambda: pool
+
+
+ORDER = {
+    'order_details': [
+        {'product_id': 'the_odyssey', 'price': '99.51', 'quantity': 1}
+    ]
+}
+
+
+def test_exhausted_pool_is_service_unavailable(client):
+    use(Pool(exc=RpcPoolExhausted('No RPC slot available after 5s')))
+
+    response = client.get('/orders/1')
+
+    assert 503 == response.status_code
+    assert {'detail': 'No RPC slot available after 5s'} == response.json()
+
+
+def test_create_order(client, nameko):
+    use(Pool(nameko))
+
+    response = client.post('/orders', json=ORDER)
+
+    assert 200 == response.status_code
+    assert {'id': 11} == response.json()
+    assert not nameko.products.release_stock.called
+
+
+def test_create_order_releases_stock_when_not_created(client, nameko):
+    nameko.orders.create_order.side_effect = RemoteError(
+        'OperationalError', 'database is down')
+    use(Pool(nameko))
+
+    response = client.post('/orders', json=ORDER)
+
+    assert 500 == response.status_code
+    assert nameko.products.release_stock.called
+
+
+def test_create_order_keeps_stock_when_outcome_is_unknown(client, nameko):
+    # the order may have been created after all
+    nameko.orders.create_order.side_effect = asyncio.TimeoutError()
+    use(Pool(nameko))
+
+    response = client.post('/orders', json=ORDER)
+
+    assert 500 == response.status_code
+    assert not nameko.products.release_stock.called
+
+
+@pytest.mark.parametrize('quantity', [0, -1])
+def test_create_order_rejects_non_positive_quantity(client, nameko, quantity):
+    use(Pool(nameko))
+
+    response = client.post('/orders', json={
+        'order_details': [
+            {'product_id': 'the_odyssey', 'price': '99.51',
+             'quantity': quantity}
+        ]
+    })
+
+    assert 422 == response.status_code
+    assert not nameko.products.reserve_stock.called
+
+
+def test_create_orders_reports_each_result_in_order(client, nameko):
+    nameko.products.get_many = AsyncMock(
+        return_value=[{'id': 'the_odyssey'}])
+    ids = iter(range(1, 10))
+
+    async def create_orders(orders):
+        if len(orders) == 1:
+            raise RemoteError('OperationalError', 'database is down')
+        return [{'id': next(ids)} for _ in orders]
+
+    nameko.orders.create_orders = AsyncMock(side_effect=create_orders)
+    use(Pool(nameko))
+    unknown = {'order_details': [
+        {'product_id': 'unknown', 'price': '1.00', 'quantity': 1}]}
+
+    with config.patch({'ORDERS_BATCH_SIZE': 2}):
+        response = client.post('/orders/batch', json={
+            'orders': [ORDER, {'order_details': [{}]}, ORDER, unknown, ORDER]
+        })
+
+    assert 200 == response.status_code
+    results = response.json()['results']
+    assert [{'id': 1}, {'id': 2}] == [results[0], results[2]]
+    assert 'VALIDATION_ERROR' == results[1]['error']
+    assert {
+        'error': 'PRODUCT_NOT_FOUND',
+        'message': 'Product with id unknown not found',
+    } == results[3]
+    # the whole batch of the last order failed
+    assert 'UNEXPECTED_ERROR' == results[4]['error']
+    assert 'database is down' in results[4]['message']
+
+    # the products of the batch are looked up at once
+    nameko.products.get_many.assert_awaited_once_with(
+        ['the_odyssey', 'unknown'])
+    assert [2, 1] == [
+        len(call.args[0])
+        for call in nameko.orders.create_orders.await_args_list
+    ]
+
+
+def test_create_orders_without_valid_orders(client, nameko):
+    nameko.products.get_many = AsyncMock()
+    nameko.orders.create_orders = AsyncMock()
+    use(Pool(nameko))
+
+    response = client.post('/orders/batch', json={
+        'orders': [{'order_details': [{}]}]
+    })
+
+    assert 200 == response.status_code
+    assert 'VALIDATION_ERROR' == response.json()['results'][0]['error']
+    assert not nameko.products.get_many.called
+    assert not nameko.orders.create_orders.called
+
+
+def test_export_orders_streams_ndjson_chunk_by_chunk(client, nameko):
+    nameko.orders.export_orders = AsyncMock(side_effect=[
+        {'orders': [{'id': 1}, {'id': 2}], 'next_cursor': 'c2'},
+        {'orders': [], 'next_cursor': 'c3'},
+        {'orders': [{'id': 3}], 'next_cursor': None},
+    ])
+    use(Pool(nameko))
+
+    with config.patch({'EXPORT_CHUNK_SIZE': 2}):
+        response = client.get('/orders/export')
+
+    assert 200 == response.status_code
+    assert 'application/x-ndjson' == response.headers['content-type']
+    # an empty chunk adds no blank line
+    assert '{"id": 1}\n{"id": 2}\n{"id": 3}\n' == response.text
+    assert [
+        ((), {'after': None, 'limit': 2}),
+        ((), {'after': 'c2', 'limit': 2}),
+        ((), {'after': 'c3', 'limit': 2}),
+    ] == nameko.orders.export_orders.await_args_list
+
+
+def test_export_products_streams_ndjson(client, nameko):
+    nameko.products.export = AsyncMock(side_effect=[
+        {'products': [{'id': 'LZ127'}], 'next_cursor': 7},
+        {'products': [{'id': 'LZ129'}], 'next_cursor': None},
+    ])
+    use(Pool(nameko))
+
+    with config.patch({'EXPORT_CHUNK_SIZE': 1}):
+        response = client.get('/products/export')
+
+    assert 200 == response.status_code
+    assert [{'id': 'LZ127'}, {'id': 'LZ129'}] == [
+        json.loads(line) for line in response.text.splitlines()]
+    assert [
+        ((), {'cursor': 0, 'count': 1}),
+        ((), {'cursor': 7, 'count': 1}),
+    ] == nameko.products.export.await_args_list
+
+
+def test_export_is_cancelled_when_the_client_goes_away():
+
+    async def download_first_chunk():
+        fetching = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def export_chunk(nameko, cursor):
+            if cursor is None:
+                return {'items': [1], 'next_cursor': 1}
+            fetching.set()
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        lines = ndjson_response(Pool(Mock()), export_chunk, 'items')
+        body = lines.body_iterator
+        assert '1\n' == await body.__anext__()
+        # the next chunk is fetched ahead, until the client goes away
+        await fetching.wait()
+        await body.aclose()
+        await asyncio.wait_for(cancelled.wait(), 1)
+
+    asyncio.run(download_first_chunk())
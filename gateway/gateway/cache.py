@@ -0,0 +1,137 @@
+import logging
+import time
+from collections import OrderedDict
+
+import eventlet
+from eventlet.event import Event
+
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    Size bounded, least recently used cache of the replies of backing
+    services, with stampede protection.
+
+    An entry is fresh for `ttl` seconds and served as is. For `stale_ttl`
+    more seconds it is still served, but the first request to find it
+    stale starts loading it again in the background (stale while
+    revalidate), so a hot entry is never missing.
+
+    Concurrent loads of the same key are coalesced (single flight): the
+    first caller loads the value and the others wait for its result, or
+    its exception, instead of sending the same request again.
+
+    Every invalidation bumps `generation`, and drops the loads in flight,
+    so that a value loaded before a write is neither cached nor handed to
+    a caller that came after the write.
+
+    """
+
+    def __init__(
+        self, maxsize, ttl, stale_ttl=0, timer=time.monotonic,
+        spawn=eventlet.spawn
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.timer = timer
+        self.spawn = spawn
+        self.generation = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._loading = {}
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key, load):
+        """ Return the value cached for `key`, calling `load` for it when
+        there is none.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, fresh_until, stale_until = entry
+            now = self.timer()
+            if fresh_until > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            if stale_until > now:
+                self._entries.move_to_end(key)
+                self.stale_hits += 1
+                if key not in self._loading:
+                    loading = self._loading[key] = Event()
+                    self.spawn(lambda: self._revalidate(key, load, loading))
+                return value
+            del self._entries[key]
+
+        self.misses += 1
+        loading = self._loading.get(key)
+        if loading is not None:
+            self.coalesced += 1
+            return loading.wait()
+
+        loading = self._loading[key] = Event()
+        return self._load(key, load, loading)
+
+    def _load(self, key, load, loading):
+        generation = self.generation
+        try:
+            value = load()
+        except Exception as exc:
+            loading.send_exception(exc)
+            raise
+        else:
+            self._set(key, value, generation)
+            loading.send(value)
+            return value
+        finally:
+            if self._loading.get(key) is loading:
+                del self._loading[key]
+
+    def _revalidate(self, key, load, loading):
+        try:
+            self._load(key, load, loading)
+        except Exception:
+            # keep serving the stale value until it expires
+            logger.warning(
+                'Failed to refresh cached %r', key, exc_info=True)
+
+    def _set(self, key, value, generation):
+        if not self.enabled or generation != self.generation:
+            return
+        now = self.timer()
+        self._entries[key] = (
+            value, now + self.ttl, now + self.ttl + self.stale_ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        self.generation += 1
+        for key in keys:
+            self._entries.pop(key, None)
+            self._loading.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+        self._loading.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'stale_ttl': self.stale_ttl,
+        }
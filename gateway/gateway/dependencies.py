@@ -0,0 +1,30 @@
+from nameko import config
+from nameko.extensions import DependencyProvider
+
+from gateway.cache import ResponseCache
+
+
+PRODUCT_RESPONSE_CACHE_SIZE_KEY = 'PRODUCT_RESPONSE_CACHE_SIZE'
+PRODUCT_RESPONSE_CACHE_TTL_KEY = 'PRODUCT_RESPONSE_CACHE_TTL'
+PRODUCT_RESPONSE_CACHE_STALE_TTL_KEY = 'PRODUCT_RESPONSE_CACHE_STALE_TTL'
+
+
+class ProductCache(DependencyProvider):
+    """ Provides a `ResponseCache` of products service replies, shared by
+    all the workers of the container.
+
+    Entries are refreshed in the background by threads managed by the
+    container.
+    """
+
+    def setup(self):
+        self.cache = ResponseCache(
+            maxsize=int(config.get(PRODUCT_RESPONSE_CACHE_SIZE_KEY, 1024)),
+            ttl=float(config.get(PRODUCT_RESPONSE_CACHE_TTL_KEY, 1)),
+            stale_ttl=float(
+                config.get(PRODUCT_RESPONSE_CACHE_STALE_TTL_KEY, 10)),
+            spawn=self.container.spawn_managed_thread,
+        )
+
+    def get_dependency(self, worker_ctx):
+        return self.cache
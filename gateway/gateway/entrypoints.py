@@ -1,24 +1,130 @@
+import gzip
 import json
+import time
 
 from marshmallow import ValidationError
+from nameko import config
 from nameko.exceptions import safe_for_serialization, BadRequest
 from nameko.web.handlers import HttpRequestHandler
+from nameko.web.server import WebServer
 from werkzeug import Response
 
-from gateway.exceptions import ProductNotFound, OrderNotFound
+from gateway.exceptions import OrderNotFound, OutOfStock, ProductNotFound
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+
+COMPRESSION_MIN_SIZE_KEY = 'COMPRESSION_MIN_SIZE'
+
+# When the client last wrote, in seconds since the epoch, passed on to the
+# services as context data, so that they can serve its reads from where its
+# writes already are
+LAST_WRITE_AT_COOKIE = 'last_write_at'
+LAST_WRITE_AT_CONTEXT_KEY = 'last_write_at'
+LAST_WRITE_AT_MAX_AGE = 60
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# in order of preference
+COMPRESSORS = {'gzip': gzip.compress}
+if brotli is not None:  # pragma: no cover
+    COMPRESSORS = {'br': brotli.compress, **COMPRESSORS}
+
+
+def not_modified(etag):
+    """ Return a `304 Not Modified` response for the (weak) `etag`.
+    """
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    return response
+
+
+class ReadYourWritesWebServer(WebServer):
+    """ Passes the `last_write_at` cookie of requests on as context data.
+    """
+
+    def context_data_from_headers(self, request):
+        last_write_at = request.cookies.get(LAST_WRITE_AT_COOKIE)
+        if last_write_at is None:
+            return {}
+        return {LAST_WRITE_AT_CONTEXT_KEY: last_write_at}
 
 
 class HttpEntrypoint(HttpRequestHandler):
     """ Overrides `response_from_exception` so we can customize error handling.
+
+    Also makes successful `GET` responses conditional and compresses the
+    responses that are worth it:
+
+    * A response without an `ETag` gets a weak one hashed from its body, and
+      is replaced by a `304 Not Modified` when the request's `If-None-Match`
+      already has it. Handlers that can tell that nothing changed more
+      cheaply set their own `ETag`, or return `not_modified` themselves.
+    * Bodies of at least `COMPRESSION_MIN_SIZE` bytes are encoded with the
+      best of gzip and, when the `brotli` package is installed, brotli, that
+      the client accepts.
+
+    Successful writes set a `last_write_at` cookie, which the following
+    requests of the client pass on to the services as context data, see
+    `ReadYourWritesWebServer`.
     """
 
+    server = ReadYourWritesWebServer()
+
     mapped_errors = {
         BadRequest: (400, 'BAD_REQUEST'),
         ValidationError: (400, 'VALIDATION_ERROR'),
         ProductNotFound: (404, 'PRODUCT_NOT_FOUND'),
         OrderNotFound: (404, 'ORDER_NOT_FOUND'),
+        OutOfStock: (409, 'OUT_OF_STOCK'),
     }
 
+    def handle_request(self, request):
+        response = super(HttpEntrypoint, self).handle_request(request)
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            response.set_cookie(
+                LAST_WRITE_AT_COOKIE, '{:.3f}'.format(time.time()),
+                max_age=LAST_WRITE_AT_MAX_AGE, httponly=True)
+        if response.is_streamed:
+            # hashing or compressing the body would read all of it at once
+            return response
+        if request.method == 'GET' and response.status_code == 200:
+            response = self.make_conditional(request, response)
+        return self.compress(request, response)
+
+    def make_conditional(self, request, response):
+        etag, _ = response.get_etag()
+        if etag is None:
+            response.add_etag(weak=True)
+            etag, _ = response.get_etag()
+
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        return response
+
+    def compress(self, request, response):
+        if (
+            response.status_code in (204, 304) or
+            response.direct_passthrough or
+            'Content-Encoding' in response.headers
+        ):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        data = response.get_data()
+        if len(data) < int(config.get(COMPRESSION_MIN_SIZE_KEY, 1024)):
+            return response
+
+        encoding = request.accept_encodings.best_match(COMPRESSORS)
+        if encoding is None:
+            return response
+
+        response.set_data(COMPRESSORS[encoding](data))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
     def response_from_exception(self, exc):
         status_code, error_code = 500, 'UNEXPECTED_ERROR'
 
@@ -31,4 +31,14 @@ class ProductNotFound(Exception):
 
 @remote_error('products.exceptions.Conflict')
 class ProductAlreadyExists(Exception):
-    pass
\ No newline at end of file
+    pass
+
+@remote_error('products.exceptions.OutOfStock')
+class OutOfStock(Exception):
+    pass
+
+
+@remote_error('products.exceptions.InvalidCursor')
+@remote_error('orders.exceptions.InvalidCursor')
+class InvalidCursor(Exception):
+    pass
@@ -1,16 +1,22 @@
-from marshmallow import Schema, fields
+from marshmallow import Schema, fields, validate
 
 
 class CreateOrderDetailSchema(Schema):
     product_id = fields.Str(required=True)
     price = fields.Decimal(as_string=True, required=True)
-    quantity = fields.Int(required=True)
+    quantity = fields.Int(required=True, validate=validate.Range(min=1))
 
 
 class CreateOrderSchema(Schema):
     order_details = fields.Nested(
         CreateOrderDetailSchema, many=True, required=True
     )
+
+
+class CreateOrdersSchema(Schema):
+    # items are validated one by one with `CreateOrderSchema`, so that an
+    # invalid order only fails itself rather than the whole batch
+    orders = fields.List(fields.Dict(), required=True)
     
 class UpdateProductSchema(Schema):
     title = fields.String(required=False)
@@ -37,4 +43,6 @@ class GetOrderSchema(Schema):
         product = fields.Nested(ProductSchema, many=False)
 
     id = fields.Int()
+    total_amount = fields.Decimal(as_string=True)
+    line_count = fields.Int()
     order_details = fields.Nested(OrderDetail, many=True)
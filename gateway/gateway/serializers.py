@@ -0,0 +1,11 @@
+"""
+Serializers compiled from the schemas of the service, see
+`nameko_examples_common.serializers`.
+"""
+from nameko_examples_common.serializers import compile_serializer
+
+from gateway.schemas import GetOrderSchema, ProductSchema
+
+
+serialize_order = compile_serializer(GetOrderSchema())
+serialize_product = compile_serializer(ProductSchema())
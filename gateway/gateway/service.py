@@ -2,13 +2,34 @@ import json
 import math
 from marshmallow import ValidationError
 from nameko import config
-from nameko.exceptions import BadRequest
+from nameko.exceptions import BadRequest, RemoteError, UnknownService
 from nameko.rpc import RpcProxy
 from werkzeug import Request, Response
 
-from gateway.entrypoints import http
-from gateway.exceptions import OrderNotFound, ProductNotFound, ProductAlreadyExists
-from gateway.schemas import CreateOrderSchema, GetOrderSchema, ProductSchema, UpdateProductSchema
+from gateway.dependencies import ProductCache
+from gateway.entrypoints import http, not_modified
+from gateway.exceptions import (
+    InvalidCursor, OrderNotFound, OutOfStock, ProductNotFound,
+    ProductAlreadyExists
+)
+from gateway.schemas import (
+    CreateOrderSchema, CreateOrdersSchema, ProductSchema, UpdateProductSchema
+)
+from gateway.serializers import serialize_order, serialize_product
+
+
+PRODUCTS_BATCH_SIZE_KEY = 'PRODUCTS_BATCH_SIZE'
+ORDERS_BATCH_SIZE_KEY = 'ORDERS_BATCH_SIZE'
+EXPORT_CHUNK_SIZE_KEY = 'EXPORT_CHUNK_SIZE'
+
+ORDER_COUNT_MODES = ('exact', 'estimate', 'cached')
+
+
+# Errors meaning that the orders service did not create an order: it
+# replied with an error, after rolling its transaction back, or the call was
+# never delivered. Any other error, such as a timeout, may come after the
+# order was committed, so the stock reserved for it is kept.
+ORDER_NOT_CREATED_ERRORS = (RemoteError, BadRequest, UnknownService)
 
 
 class GatewayService(object):
@@ -20,21 +41,59 @@ class GatewayService(object):
 
     orders_rpc = RpcProxy('orders')
     products_rpc = RpcProxy('products')
+
+    # products service replies, cleared by the product handlers below on
+    # every write and otherwise fresh for `PRODUCT_RESPONSE_CACHE_TTL`
+    product_cache = ProductCache()
     
-    @http("GET", "/orders", expected_exceptions=OrderNotFound)
+    @http(
+        "GET", "/orders",
+        expected_exceptions=(OrderNotFound, BadRequest, InvalidCursor)
+    )
     def get_orders(self, request):
+        """Gets a page of orders, oldest first.
+
+        `total_orders` is an exact count by default. Pass `count=estimate`
+        or `count=cached` to get a cheaper, approximate total on large
+        tables.
+
+        Instead of `page`, the `next_cursor` or `prev_cursor` of a previous
+        response can be passed as `after` or `before` to get the following
+        or preceding page, which costs the same however deep into the list
+        it is ::
+
+            ?per_page=5&after=MjAyNi0xMC0xN1QxMDoxMjo0NHw0Mg==
+
+        With `summary=true`, orders come with their `total_amount` and
+        `line_count` but without their `order_details`.
+
+        """
         req = Request(request.environ)
 
         page = int(req.args.get('page', 1))
         per_page = int(req.args.get('per_page', 10))
-
-        orders = self.orders_rpc.list_orders(page=page, per_page=per_page)
+        count = req.args.get('count', 'exact')
+        if count not in ORDER_COUNT_MODES:
+            raise BadRequest(
+                "count must be one of {}".format(', '.join(ORDER_COUNT_MODES)))
+        after = req.args.get('after')
+        before = req.args.get('before')
+        if after and before:
+            raise BadRequest("Only one of after and before can be given")
+        summary = req.args.get('summary', '').lower() in ('1', 'true')
+
+        orders = self.orders_rpc.list_orders(
+            page=page, per_page=per_page, count=count,
+            after=after, before=before, summary=summary
+        )
     
         response_data = {
             'orders': orders['orders'],
             'page': orders['page'],
             'per_page': orders['per_page'],
             'total_orders': orders['total_orders'],
+            'next_cursor': orders['next_cursor'],
+            'prev_cursor': orders['prev_cursor'],
         }
 
         return Response(
@@ -49,7 +108,52 @@ class GatewayService(object):
         self.orders_rpc.delete_order(order_id)
         return Response(status=204)
     
-    @http("GET", "/orders/<int:order_id>", expected_exceptions=OrderNotFound)
+    @http("GET", "/orders/export")
+    def export_orders(self, request):
+        """Streams all the orders, with their details, as newline delimited
+        json, one order per line ::
+
+            {"id": 1, "total_amount": "99.99", "line_count": 1, ...}
+            {"id": 2, "total_amount": "11.98", "line_count": 1, ...}
+
+        """
+        chunk_size = int(config.get(EXPORT_CHUNK_SIZE_KEY, 500))
+        return self._stream_ndjson(
+            lambda cursor: self.orders_rpc.export_orders.call_async(
+                after=cursor, limit=chunk_size),
+            'orders'
+        )
+
+    def _stream_ndjson(self, export_chunk, key):
+        """Streams the items under `key` of the chunks `export_chunk`
+        replies with, one json document per line.
+
+        `export_chunk(cursor)` asynchronously asks for the chunk at `cursor`
+        (None for the first one) and the reply has the `next_cursor`, None
+        after the last chunk. The next chunk is asked for before the
+        current one is sent, so the backing service and the client work at
+        the same time, and at most two chunks are held whatever the size of
+        the export.
+        """
+        def lines():
+            reply = export_chunk(None)
+            while reply is not None:
+                chunk = reply.result()
+                next_cursor = chunk['next_cursor']
+                reply = (
+                    export_chunk(next_cursor)
+                    if next_cursor is not None else None
+                )
+                if chunk[key]:
+                    yield ''.join(
+                        json.dumps(item) + '\n' for item in chunk[key])
+
+        return Response(lines(), mimetype='application/x-ndjson')
+
+    @http(
+        "GET", "/orders/<int:order_id>",
+        expected_exceptions=(OrderNotFound, ProductNotFound)
+    )
     def get_order(self, request, order_id):
         """Gets the order details for the order given by `order_id`.
 
@@ -58,7 +162,7 @@ class GatewayService(object):
         """
         order = self._get_order(order_id)
         return Response(
-            GetOrderSchema().dumps(order).data,
+            json.dumps(serialize_order(order)),
             mimetype='application/json'
         )
 
@@ -71,12 +175,15 @@ class GatewayService(object):
         # get the configured image root
         image_root = config['PRODUCT_IMAGE_ROOT']
 
+        # Fetch the products of all order lines in a single call.
+        products = self._get_products(
+            item['product_id'] for item in order['order_details'])
+
         # Enhance order details with product and image details.
         for item in order['order_details']:
             product_id = item['product_id']
-            product = self.products_rpc.get(product_id)
-            
-            item['product'] = product
+
+            item['product'] = products[product_id]
             # Construct an image url.
             item['image'] = '{}/{}.jpg'.format(image_root, product_id)
 
@@ -84,7 +191,8 @@ class GatewayService(object):
 
     @http(
         "POST", "/orders",
-        expected_exceptions=(ValidationError, ProductNotFound, BadRequest)
+        expected_exceptions=(
+            ValidationError, ProductNotFound, OutOfStock, BadRequest)
     )
     def create_order(self, request):
         """Create a new order - order data is posted as json
@@ -129,37 +237,211 @@ class GatewayService(object):
         return Response(json.dumps({'id': id_}), mimetype='application/json')
 
     def _create_order(self, order_data):
-        # Check if order product IDs are valid
-        for item in order_data['order_details']:
-            product_id = item['product_id']
-            self.products_rpc.get(product_id)
-
-        # Call orders-service to create the order.
         # Dump the data through the schema to ensure the values are serialized
         # correctly.
         serialized_data = CreateOrderSchema().dump(order_data).data
-        result = self.orders_rpc.create_order(
-            serialized_data['order_details']
-        )
+        order_details = serialized_data['order_details']
+
+        # Take the order's stock off its products, in one atomic call that
+        # also checks that every product exists and is in stock.
+        # Note - this may raise `ProductNotFound` or `OutOfStock`
+        self.products_rpc.reserve_stock(order_details)
+
+        # Call orders-service to create the order, putting the stock back
+        # if it was not created.
+        try:
+            result = self.orders_rpc.create_order(
+                order_details, stock_reserved=True)
+        except ORDER_NOT_CREATED_ERRORS:
+            self.products_rpc.release_stock(order_details)
+            raise
         return result['id']
+
+    @http(
+        "POST", "/orders/batch",
+        expected_exceptions=(ValidationError, BadRequest)
+    )
+    def create_orders(self, request):
+        """Create many orders at once - a list of orders, each in the format
+        expected by `POST /orders`, is posted as json
+
+        Example request ::
+
+            {
+                "orders": [
+                    {
+                        "order_details": [
+                            {
+                                "product_id": "the_odyssey",
+                                "price": "99.99",
+                                "quantity": 1
+                            }
+                        ]
+                    },
+                    {
+                        "order_details": [
+                            {
+                                "product_id": "the_unknown",
+                                "price": "5.99",
+                                "quantity": 2
+                            }
+                        ]
+                    }
+                ]
+            }
+
+        Every order succeeds or fails on its own. The response has a result
+        for each order, in the order they were posted ::
+
+            {
+                "results": [
+                    {"id": 1234},
+                    {
+                        "error": "PRODUCT_NOT_FOUND",
+                        "message": "Product ID the_unknown does not exist"
+                    }
+                ]
+            }
+
+        """
+        schema = CreateOrdersSchema(strict=True)
+
+        try:
+            orders = schema.loads(request.get_data(as_text=True)).data['orders']
+        except ValueError as exc:
+            raise BadRequest("Invalid json: {}".format(exc))
+
+        results = self._create_orders(orders)
+
+        return Response(
+            json.dumps({'results': results}), mimetype='application/json')
+
+    def _create_orders(self, orders):
+        schema = CreateOrderSchema()
+        results = [None] * len(orders)
+
+        # validate every order on its own
+        valid = {}
+        for index, order in enumerate(orders):
+            order_data, errors = schema.load(order)
+            if errors:
+                results[index] = {
+                    'error': 'VALIDATION_ERROR', 'message': errors}
+            else:
+                valid[index] = order_data
+
+        # look all the products of the batch up at once
+        products = self._fetch_products(
+            item['product_id']
+            for order_data in valid.values()
+            for item in order_data['order_details']
+        )
+        for index, order_data in list(valid.items()):
+            for item in order_data['order_details']:
+                if item['product_id'] not in products:
+                    results[index] = {
+                        'error': 'PRODUCT_NOT_FOUND',
+                        'message': 'Product ID {} does not exist'.format(
+                            item['product_id']),
+                    }
+                    del valid[index]
+                    break
+
+        # create the valid orders, in batches of `ORDERS_BATCH_SIZE` that
+        # are each inserted in a single transaction and dispatched together
+        batch_size = int(config.get(ORDERS_BATCH_SIZE_KEY, 500))
+        indexes = list(valid)
+        batches = [
+            indexes[start:start + batch_size]
+            for start in range(0, len(indexes), batch_size)
+        ]
+        replies = [
+            self.orders_rpc.create_orders.call_async(
+                schema.dump([valid[index] for index in batch], many=True).data)
+            for batch in batches
+        ]
+        for batch, reply in zip(batches, replies):
+            try:
+                created = reply.result()
+            except RemoteError as exc:
+                for index in batch:
+                    results[index] = {
+                        'error': 'UNEXPECTED_ERROR', 'message': str(exc)}
+            else:
+                for index, order in zip(batch, created):
+                    results[index] = {'id': order['id']}
+
+        return results
+
+    def _fetch_products(self, product_ids):
+        """Gets the existing products among `product_ids` from the
+        products-service, mapped by id.
+
+        Ids are looked up in batches of `PRODUCTS_BATCH_SIZE`. All batches
+        are dispatched before waiting for any reply, so they are served
+        concurrently and the lookup takes as long as the slowest batch.
+        """
+        product_ids = list(dict.fromkeys(product_ids))
+        batch_size = int(config.get(PRODUCTS_BATCH_SIZE_KEY, 50))
+
+        replies = [
+            self.products_rpc.get_many.call_async(
+                product_ids[start:start + batch_size])
+            for start in range(0, len(product_ids), batch_size)
+        ]
+        return {
+            product['id']: product
+            for reply in replies
+            for product in reply.result()
+        }
+
+    def _get_products(self, product_ids):
+        """Gets the products for `product_ids` from the products-service,
+        mapped by id.
+
+        Raises ``ProductNotFound`` if any of the products does not exist.
+        """
+        product_ids = list(dict.fromkeys(product_ids))
+        products = self._fetch_products(product_ids)
+        for product_id in product_ids:
+            if product_id not in products:
+                raise ProductNotFound(
+                    'Product ID {} does not exist'.format(product_id))
+        return products
     
     
-    @http("GET", "/products", expected_exceptions=ProductNotFound)
+    @http(
+        "GET", "/products",
+        expected_exceptions=(ProductNotFound, InvalidCursor)
+    )
     def get_products(self, request):
-        """Gets a list of products with optional filtering and pagination.
+        """Gets a list of products, ordered by id, with optional filtering and
+        pagination.
         
         These functionalities are exposed as query parameters, e.g.:
         
         Example request ::
             
             ?page=2&per_page=5&filter=odyssey
+
+        Instead of `page`, the `next_cursor` of a previous response can be
+        passed to get the following page, which costs the same however deep
+        into the catalogue it is ::
+
+            ?per_page=5&cursor=TFoxMjc=
+
+        The response has an `ETag` that only changes when a product is
+        written; polling with it in `If-None-Match` gets a `304 Not
+        Modified` as long as the catalogue is unchanged.
             
         The response contains a list of products, its page and the number of items per page in a json document ::
 
             {
                 products: [...] # list of products
                 page: 2,
-                per_page: 5
+                per_page: 5,
+                total_products: 12,
+                next_cursor: "TFoxMjc=" # null on the last page
             }
             
         """
@@ -168,33 +450,91 @@ class GatewayService(object):
         filter_title_term = req.args.get('filter', '')
         page = int(req.args.get('page', 1))
         per_page = int(req.args.get('per_page', 10))
+        cursor = req.args.get('cursor')
+
+        etag = self._catalogue_etag()
+        if req.if_none_match.contains_weak(etag):
+            return not_modified(etag)
         
-        products = self.products_rpc.list(filter_title_term=filter_title_term, page=page, per_page=per_page)
+        etag, products = self._versioned_reply(
+            ('products', filter_title_term, page, per_page, cursor),
+            lambda: self.products_rpc.list(
+                filter_title_term=filter_title_term, page=page,
+                per_page=per_page, cursor=cursor
+            )
+        )
         
         response_data = {
-            'products': ProductSchema(many=True).dump(products['products']).data,
+            'products': [
+                serialize_product(product)
+                for product in products['products']
+            ],
             'page': page,
             'per_page': per_page,
-            'total_products': products['total_products']
+            'total_products': products['total_products'],
+            'next_cursor': products['next_cursor'],
         }
         
-        return Response(
+        response = Response(
             json.dumps(response_data),
             mimetype='application/json'
         )
+        response.set_etag(etag, weak=True)
+        return response
+
+    def _catalogue_etag(self):
+        # the catalogue version changes with every product write, so that
+        # a client holding a reply tagged with the current version has it
+        # fresh
+        return 'products-{}'.format(self.product_cache.get(
+            ('catalogue_version',), self.products_rpc.catalogue_version))
+
+    def _versioned_reply(self, key, load):
+        # The reply is cached along with the catalogue version read just
+        # before it was loaded, and tagged with that version, never with
+        # one cached on its own: the two are refreshed at different times,
+        # and a newer version on an older reply would have the client keep
+        # the older reply as fresh.
+        version, reply = self.product_cache.get(
+            key, lambda: (self.products_rpc.catalogue_version(), load()))
+        return 'products-{}'.format(version), reply
     
+    @http("GET", "/products/export")
+    def export_products(self, request):
+        """Streams the whole catalogue as newline delimited json, one
+        product per line, in no particular order ::
+
+            {"id": "the_odyssey", "title": "The Odyssey", ...}
+            {"id": "the_enigma", "title": "The Enigma", ...}
+
+        """
+        chunk_size = int(config.get(EXPORT_CHUNK_SIZE_KEY, 500))
+        return self._stream_ndjson(
+            lambda cursor: self.products_rpc.export.call_async(
+                cursor=cursor or 0, count=chunk_size),
+            'products'
+        )
+
     @http(
         "GET", "/products/<string:product_id>",
         expected_exceptions=ProductNotFound
     )
     def get_product(self, request, product_id):
-        """Gets product by `product_id`
+        """Gets product by `product_id`, conditionally on its `ETag` like
+        `GET /products`
         """
-        product = self.products_rpc.get(product_id)
-        return Response(
-            ProductSchema().dumps(product).data,
+        etag = self._catalogue_etag()
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+
+        etag, product = self._versioned_reply(
+            ('product', product_id), lambda: self.products_rpc.get(product_id))
+        response = Response(
+            json.dumps(serialize_product(product)),
             mimetype='application/json'
         )
+        response.set_etag(etag, weak=True)
+        return response
 
     @http(
         "POST", "/products",
@@ -228,6 +568,7 @@ class GatewayService(object):
             # or `ValidationError` if data is invalid.
             product_data = schema.loads(request.get_data(as_text=True)).data
             self.products_rpc.create(product_data)
+            self.product_cache.clear()
         except ValueError as exc:
             raise BadRequest("Invalid json: {}".format(exc)) 
         except ProductAlreadyExists as exc:
@@ -270,6 +611,7 @@ class GatewayService(object):
 
         # Update the product
         self.products_rpc.update(product_id, updated_product_data)
+        self.product_cache.clear()
 
         return Response(status=204)  # 204 No Content indicates a successful update
         
@@ -278,4 +620,5 @@ class GatewayService(object):
         """Deletes an existing product by `product_id`
         """
         self.products_rpc.delete(product_id)
+        self.product_cache.clear()
         return Response(status=204)
@@ -7,10 +7,14 @@ setup(
     description='Gateway for Airships ltd',
     packages=find_packages(exclude=['test', 'test.*']),
     install_requires=[
+        "nameko-examples-common==0.0.1",
         "marshmallow==2.19.2",
         "nameko==v3.0.0-rc6",
     ],
     extras_require={
+        'brotli': [
+            'brotli==1.0.9',
+        ],
         'dev': [
             'pytest==4.5.0',
             'coverage==4.5.3',
@@ -1,8 +1,23 @@
 import json
+import time
 
-from mock import call
+import pytest
+from mock import Mock, call
+from nameko import config
+from nameko.exceptions import RemoteError, RpcTimeout
+from nameko.testing.utils import get_extension
 
-from gateway.exceptions import OrderNotFound, ProductNotFound
+from gateway.dependencies import ProductCache
+from gateway.exceptions import (
+    InvalidCursor, OrderNotFound, OutOfStock, ProductNotFound
+)
+
+
+def rpc_reply(result):
+    """ Mocks the reply of an asynchronous RPC call """
+    reply = Mock()
+    reply.result.return_value = result
+    return reply
 
 
 class TestGetProduct(object):
@@ -27,6 +42,105 @@ class TestGetProduct(object):
             "title": "The Odyssey"
         }
 
+    def test_get_product_is_conditional(self, gateway_service, web_session):
+        gateway_service.products_rpc.catalogue_version.return_value = 42
+        gateway_service.products_rpc.get.return_value = {
+            "in_stock": 10,
+            "maximum_speed": 5,
+            "id": "the_odyssey",
+            "passenger_capacity": 101,
+            "title": "The Odyssey"
+        }
+
+        response = web_session.get('/products/the_odyssey')
+        assert response.status_code == 200
+        assert response.headers['ETag'] == 'W/"products-42"'
+
+        response = web_session.get(
+            '/products/the_odyssey',
+            headers={'If-None-Match': response.headers['ETag']}
+        )
+        assert response.status_code == 304
+        assert response.content == b''
+        assert response.headers['ETag'] == 'W/"products-42"'
+        assert gateway_service.products_rpc.get.call_count == 1
+
+        # the catalogue changed, through the gateway
+        gateway_service.products_rpc.catalogue_version.return_value = 43
+        web_session.patch('/products/the_odyssey', json.dumps({'in_stock': 9}))
+        response = web_session.get(
+            '/products/the_odyssey',
+            headers={'If-None-Match': 'W/"products-42"'}
+        )
+        assert response.status_code == 200
+        assert response.headers['ETag'] == 'W/"products-43"'
+
+    def test_reply_is_tagged_with_its_own_version(
+        self, gateway_service, web_session
+    ):
+        gateway_service.products_rpc.catalogue_version.return_value = 5
+        gateway_service.products_rpc.get.return_value = {
+            "in_stock": 10,
+            "maximum_speed": 5,
+            "id": "the_odyssey",
+            "passenger_capacity": 101,
+            "title": "The Odyssey"
+        }
+        response = web_session.get('/products/the_odyssey')
+        assert response.headers['ETag'] == 'W/"products-5"'
+
+        # an order takes stock, which the cached version notices before
+        # the cached product does
+        gateway_service.products_rpc.catalogue_version.return_value = 6
+        gateway_service.products_rpc.get.return_value = dict(
+            gateway_service.products_rpc.get.return_value, in_stock=9)
+        cache = get_extension(gateway_service.container, ProductCache).cache
+        cache.invalidate(('catalogue_version',))
+
+        response = web_session.get('/products/the_odyssey')
+        # the cached reply comes with the version it was loaded at, never
+        # with the newer one, which would have clients keep it as fresh
+        assert response.json()['in_stock'] == 10
+        assert response.headers['ETag'] == 'W/"products-5"'
+
+        # and once it is loaded again, with the new version
+        cache.invalidate(('product', 'the_odyssey'))
+        response = web_session.get(
+            '/products/the_odyssey',
+            headers={'If-None-Match': 'W/"products-5"'}
+        )
+        assert response.status_code == 200
+        assert response.json()['in_stock'] == 9
+        assert response.headers['ETag'] == 'W/"products-6"'
+
+    def test_products_are_cached_until_written(
+        self, gateway_service, web_session
+    ):
+        gateway_service.products_rpc.get.return_value = {
+            "in_stock": 10,
+            "maximum_speed": 5,
+            "id": "the_odyssey",
+            "passenger_capacity": 101,
+            "title": "The Odyssey"
+        }
+        gateway_service.products_rpc.list.return_value = {
+            'products': [], 'total_products': 0, 'next_cursor': None
+        }
+
+        for _ in range(3):
+            assert web_session.get('/products/the_odyssey').status_code == 200
+            assert web_session.get('/products').status_code == 200
+        assert 1 == gateway_service.products_rpc.get.call_count
+        assert 1 == gateway_service.products_rpc.list.call_count
+        # once to check the clients' ETag, and once with each reply
+        assert 3 == gateway_service.products_rpc.catalogue_version.call_count
+
+        web_session.delete('/products/the_odyssey')
+        web_session.get('/products/the_odyssey')
+        web_session.get('/products')
+        assert 2 == gateway_service.products_rpc.get.call_count
+        assert 2 == gateway_service.products_rpc.list.call_count
+
     def test_product_not_found(self, gateway_service, web_session):
         gateway_service.products_rpc.get.side_effect = (
             ProductNotFound('missing'))
@@ -39,6 +153,139 @@ class TestGetProduct(object):
         assert payload['message'] == 'missing'
 
 
+class TestGetProducts(object):
+    def test_can_list_products(self, gateway_service, web_session):
+        gateway_service.products_rpc.list.return_value = {
+            "products": [
+                {
+                    "in_stock": 10,
+                    "maximum_speed": 5,
+                    "id": "the_odyssey",
+                    "passenger_capacity": 101,
+                    "title": "The Odyssey"
+                }
+            ],
+            "total_products": 2,
+            "next_cursor": "dGhlX29keXNzZXk="
+        }
+
+        response = web_session.get('/products?per_page=1&filter=the')
+
+        assert response.status_code == 200
+        assert gateway_service.products_rpc.list.call_args_list == [call(
+            filter_title_term='the', page=1, per_page=1, cursor=None
+        )]
+        assert response.json() == {
+            "products": [
+                {
+                    "in_stock": 10,
+                    "maximum_speed": 5,
+                    "id": "the_odyssey",
+                    "passenger_capacity": 101,
+                    "title": "The Odyssey"
+                }
+            ],
+            "page": 1,
+            "per_page": 1,
+            "total_products": 2,
+            "next_cursor": "dGhlX29keXNzZXk="
+        }
+
+    def test_can_list_products_after_cursor(
+        self, gateway_service, web_session
+    ):
+        gateway_service.products_rpc.list.return_value = {
+            "products": [],
+            "total_products": 2,
+            "next_cursor": None
+        }
+
+        response = web_session.get('/products?cursor=dGhlX29keXNzZXk=')
+
+        assert response.status_code == 200
+        assert gateway_service.products_rpc.list.call_args_list == [call(
+            filter_title_term='', page=1, per_page=10,
+            cursor='dGhlX29keXNzZXk='
+        )]
+        assert response.json()['next_cursor'] is None
+
+    def test_unchanged_products_are_not_listed_again(
+        self, gateway_service, web_session
+    ):
+        gateway_service.products_rpc.catalogue_version.return_value = 7
+
+        response = web_session.get(
+            '/products?page=2', headers={'If-None-Match': 'W/"products-7"'})
+
+        assert response.status_code == 304
+        assert response.headers['ETag'] == 'W/"products-7"'
+        assert not gateway_service.products_rpc.list.called
+
+    def test_large_product_lists_are_compressed(
+        self, gateway_service, web_session
+    ):
+        gateway_service.products_rpc.catalogue_version.return_value = 7
+        gateway_service.products_rpc.list.return_value = {
+            'products': [
+                {
+                    "in_stock": 10,
+                    "maximum_speed": 5,
+                    "id": "product_{}".format(index),
+                    "passenger_capacity": 101,
+                    "title": "Product {}".format(index)
+                }
+                for index in range(50)
+            ],
+            'total_products': 50,
+            'next_cursor': None,
+        }
+
+        response = web_session.get(
+            '/products?per_page=50', headers={'Accept-Encoding': 'gzip'})
+
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        assert 50 == len(response.json()['products'])
+
+    def test_invalid_cursor(self, gateway_service, web_session):
+        gateway_service.products_rpc.list.side_effect = (
+            InvalidCursor('Cursor foo is not valid'))
+
+        response = web_session.get('/products?cursor=foo')
+
+        assert response.status_code == 400
+        assert response.json()['error'] == 'BAD_REQUEST'
+
+
+class TestExportProducts(object):
+
+    def test_can_export_products(self, gateway_service, web_session):
+        gateway_service.products_rpc.export.call_async.side_effect = [
+            rpc_reply({
+                'products': [{'id': 'the_odyssey'}, {'id': 'the_enigma'}],
+                'next_cursor': 17,
+            }),
+            rpc_reply({'products': [], 'next_cursor': 3}),
+            rpc_reply({'products': [{'id': 'zd'}], 'next_cursor': None}),
+        ]
+
+        with config.patch({'EXPORT_CHUNK_SIZE': 2}):
+            response = web_session.get('/products/export')
+
+        assert response.status_code == 200
+        assert response.headers['Content-Type'] == 'application/x-ndjson'
+        assert 'ETag' not in response.headers
+        assert [
+            {'id': 'the_odyssey'}, {'id': 'the_enigma'}, {'id': 'zd'}
+        ] == [json.loads(line) for line in response.text.splitlines()]
+        assert [
+            call(cursor=0, count=2),
+            call(cursor=17, count=2),
+            call(cursor=3, count=2),
+        ] == gateway_service.products_rpc.export.call_async.call_args_list
+
+
 class TestCreateProduct(object):
     def test_can_create_product(self, gateway_service, web_session):
         response = web_session.post(
@@ -124,13 +371,14 @@ class TestGetOrder(object):
         }
 
         # setup mock products-service response:
-        gateway_service.products_rpc.get.return_value = {
-            "in_stock": 250,
-            "maximum_speed": 150,
-            "title": "Zelda",
-            "id": "zd",
-            "passenger_capacity": 30
-        }
+        gateway_service.products_rpc.get_many.call_async.return_value = (
+            rpc_reply([{
+                "in_stock": 250,
+                "maximum_speed": 150,
+                "title": "Zelda",
+                "id": "zd",
+                "passenger_capacity": 30
+            }]))
 
         # call the gateway service to get order #1
         response = web_session.get('/orders/1')
@@ -161,7 +409,8 @@ class TestGetOrder(object):
 
         # check dependencies called as expected
         assert [call(1)] == gateway_service.orders_rpc.get_order.call_args_list
-        assert [call('zd')] == gateway_service.products_rpc.get.call_args_list
+        assert [call(['zd'])] == (
+            gateway_service.products_rpc.get_many.call_async.call_args_list)
 
     def test_order_not_found(self, gateway_service, web_session):
         gateway_service.orders_rpc.get_order.side_effect = (
@@ -175,6 +424,90 @@ class TestGetOrder(object):
         assert payload['message'] == 'missing'
 
 
+    def test_products_are_fetched_in_one_call(
+        self, gateway_service, web_session
+    ):
+        gateway_service.orders_rpc.get_order.return_value = {
+            "order_details": [
+                {"product_id": "zd", "quantity": 1, "price": "1.00", "id": 1},
+                {"product_id": "zx", "quantity": 2, "price": "2.00", "id": 2},
+                {"product_id": "zd", "quantity": 3, "price": "1.00", "id": 3},
+            ],
+            "id": 1
+        }
+        gateway_service.products_rpc.get_many.call_async.return_value = (
+            rpc_reply([
+                {
+                    "in_stock": 250,
+                    "maximum_speed": 150,
+                    "title": product_id,
+                    "id": product_id,
+                    "passenger_capacity": 30
+                }
+                for product_id in ("zx", "zd")
+            ]))
+
+        response = web_session.get('/orders/1')
+
+        assert response.status_code == 200
+        assert [call(['zd', 'zx'])] == (
+            gateway_service.products_rpc.get_many.call_async.call_args_list)
+        assert ['zd', 'zx', 'zd'] == [
+            item['product']['id'] for item in response.json()['order_details']
+        ]
+
+    def test_products_are_fetched_in_concurrent_batches(
+        self, gateway_service, web_session
+    ):
+        gateway_service.orders_rpc.get_order.return_value = {
+            "order_details": [
+                {"product_id": product_id, "quantity": 1, "price": "1.00",
+                 "id": index}
+                for index, product_id in enumerate(("za", "zb", "zc"))
+            ],
+            "id": 1
+        }
+        replies = [
+            rpc_reply([
+                {
+                    "in_stock": 250,
+                    "maximum_speed": 150,
+                    "title": product_id,
+                    "id": product_id,
+                    "passenger_capacity": 30
+                }
+                for product_id in product_ids
+            ])
+            for product_ids in (("za", "zb"), ("zc",))
+        ]
+        gateway_service.products_rpc.get_many.call_async.side_effect = replies
+
+        with config.patch({'PRODUCTS_BATCH_SIZE': 2}):
+            response = web_session.get('/orders/1')
+
+        assert response.status_code == 200
+        assert [call(['za', 'zb']), call(['zc'])] == (
+            gateway_service.products_rpc.get_many.call_async.call_args_list)
+        assert ['za', 'zb', 'zc'] == [
+            item['product']['id'] for item in response.json()['order_details']
+        ]
+
+    def test_order_product_not_found(self, gateway_service, web_session):
+        gateway_service.orders_rpc.get_order.return_value = {
+            "order_details": [
+                {"product_id": "zd", "quantity": 1, "price": "1.00", "id": 1},
+            ],
+            "id": 1
+        }
+        gateway_service.products_rpc.get_many.call_async.return_value = (
+            rpc_reply([]))
+
+        response = web_session.get('/orders/1')
+
+        assert response.status_code == 404
+        assert response.json()['error'] == 'PRODUCT_NOT_FOUND'
+
+
 class TestGetOrders(object):
     def test_can_list_orders(self, gateway_service, web_session):
         # setup mock orders-service response:
@@ -205,13 +538,20 @@ class TestGetOrders(object):
             ],
             "page": 1,
             "per_page": 10,
-            "total_orders": 2
+            "total_orders": 2,
+            "next_cursor": None,
+            "prev_cursor": None
         }
 
         response = web_session.get('/orders')
         
         assert response.status_code == 200
-        assert gateway_service.orders_rpc.list_orders.call_args_list == [call(page=1, per_page=10)]
+        assert gateway_service.orders_rpc.list_orders.call_args_list == [
+            call(
+                page=1, per_page=10, count='exact', after=None, before=None,
+                summary=False
+            )
+        ]
         
         assert response.json() == {
             "orders":[
@@ -240,7 +580,9 @@ class TestGetOrders(object):
             ],
             "page":1,
             "per_page":10,
-            "total_orders":2
+            "total_orders":2,
+            "next_cursor":None,
+            "prev_cursor":None
         }
 
     def test_empty_list_orders(self, gateway_service, web_session):
@@ -248,31 +590,172 @@ class TestGetOrders(object):
             "orders": [],
             "page": 1,
             "per_page": 10,
-            "total_orders": 0
+            "total_orders": 0,
+            "next_cursor": None,
+            "prev_cursor": None
         }
 
         response = web_session.get('/orders')
         assert response.status_code == 200
-        assert gateway_service.orders_rpc.list_orders.call_args_list == [call(page=1, per_page=10)]
+        assert gateway_service.orders_rpc.list_orders.call_args_list == [
+            call(
+                page=1, per_page=10, count='exact', after=None, before=None,
+                summary=False
+            )
+        ]
         assert response.json() == {
             'orders': [],
             'page': 1,
             "per_page": 10,
-            "total_orders": 0
+            "total_orders": 0,
+            "next_cursor": None,
+            "prev_cursor": None
         }
 
 
+    def test_can_list_orders_with_estimated_count(
+        self, gateway_service, web_session
+    ):
+        gateway_service.orders_rpc.list_orders.return_value = {
+            "orders": [],
+            "page": 2,
+            "per_page": 5,
+            "total_orders": 1000,
+            "next_cursor": "MjAyNi0xMC0xN1QxMDoxMjo0NHw0Mg==",
+            "prev_cursor": "MjAyNi0xMC0xN1QxMDoxMjo0NHwzOA=="
+        }
+
+        response = web_session.get('/orders?page=2&per_page=5&count=estimate')
+
+        assert response.status_code == 200
+        assert gateway_service.orders_rpc.list_orders.call_args_list == [
+            call(
+                page=2, per_page=5, count='estimate', after=None, before=None,
+                summary=False
+            )
+        ]
+        assert response.json()['total_orders'] == 1000
+
+    def test_list_orders_fails_with_unknown_count(
+        self, gateway_service, web_session
+    ):
+        response = web_session.get('/orders?count=precise')
+
+        assert response.status_code == 400
+        assert response.json()['error'] == 'BAD_REQUEST'
+        assert not gateway_service.orders_rpc.list_orders.called
+
+    def test_can_list_orders_after_cursor(self, gateway_service, web_session):
+        gateway_service.orders_rpc.list_orders.return_value = {
+            "orders": [],
+            "page": 1,
+            "per_page": 5,
+            "total_orders": 6,
+            "next_cursor": None,
+            "prev_cursor": "MjAyNi0xMC0xN1QxMDoxMjo0NHw2"
+        }
+
+        response = web_session.get(
+            '/orders?per_page=5&after=MjAyNi0xMC0xN1QxMDoxMjo0NHw1')
+
+        assert response.status_code == 200
+        assert gateway_service.orders_rpc.list_orders.call_args_list == [
+            call(
+                page=1, per_page=5, count='exact',
+                after='MjAyNi0xMC0xN1QxMDoxMjo0NHw1', before=None,
+                summary=False
+            )
+        ]
+        assert response.json()['next_cursor'] is None
+        assert response.json()['prev_cursor'] == 'MjAyNi0xMC0xN1QxMDoxMjo0NHw2'
+
+    def test_can_list_order_summaries(self, gateway_service, web_session):
+        gateway_service.orders_rpc.list_orders.return_value = {
+            "orders": [{"id": 1, "total_amount": "41.00", "line_count": 1}],
+            "page": 1,
+            "per_page": 10,
+            "total_orders": 1,
+            "next_cursor": None,
+            "prev_cursor": None
+        }
+
+        response = web_session.get('/orders?summary=true')
+
+        assert response.status_code == 200
+        assert gateway_service.orders_rpc.list_orders.call_args_list == [
+            call(
+                page=1, per_page=10, count='exact', after=None, before=None,
+                summary=True
+            )
+        ]
+        assert response.json()['orders'] == [
+            {"id": 1, "total_amount": "41.00", "line_count": 1}
+        ]
+
+    def test_list_orders_fails_with_after_and_before(
+        self, gateway_service, web_session
+    ):
+        response = web_session.get('/orders?after=a&before=b')
+
+        assert response.status_code == 400
+        assert not gateway_service.orders_rpc.list_orders.called
+
+    def test_list_orders_fails_with_invalid_cursor(
+        self, gateway_service, web_session
+    ):
+        gateway_service.orders_rpc.list_orders.side_effect = (
+            InvalidCursor('Cursor foo is not valid'))
+
+        response = web_session.get('/orders?after=foo')
+
+        assert response.status_code == 400
+        assert response.json() == {
+            'error': 'BAD_REQUEST',
+            'message': 'Cursor foo is not valid'
+        }
+
+
+class TestExportOrders(object):
+
+    def test_can_export_orders(self, gateway_service, web_session):
+        gateway_service.orders_rpc.export_orders.call_async.side_effect = [
+            rpc_reply({
+                'orders': [{'id': 1, 'order_details': []}],
+                'next_cursor': 1,
+            }),
+            rpc_reply({
+                'orders': [{'id': 2, 'order_details': []}],
+                'next_cursor': None,
+            }),
+        ]
+
+        with config.patch({'EXPORT_CHUNK_SIZE': 1}):
+            response = web_session.get('/orders/export')
+
+        assert response.status_code == 200
+        assert response.headers['Content-Type'] == 'application/x-ndjson'
+        assert [
+            {'id': 1, 'order_details': []}, {'id': 2, 'order_details': []}
+        ] == [json.loads(line) for line in response.text.splitlines()]
+        assert [
+            call(after=None, limit=1), call(after=1, limit=1)
+        ] == gateway_service.orders_rpc.export_orders.call_async.call_args_list
+
+    def test_export_no_orders(self, gateway_service, web_session):
+        gateway_service.orders_rpc.export_orders.call_async.return_value = (
+            rpc_reply({'orders': [], 'next_cursor': None}))
+
+        response = web_session.get('/orders/export')
+
+        assert response.status_code == 200
+        assert '' == response.text
+
+
 class TestCreateOrder(object):
 
     def test_can_create_order(self, gateway_service, web_session):
         # setup mock products-service response:
-        gateway_service.products_rpc.get.return_value = {
-                "id": "zd",
-                "maximum_speed": 150,
-                "title": "Zelda",
-                "in_stock": -250,
-                "passenger_capacity": 30
-            }
+        gateway_service.products_rpc.reserve_stock.return_value = {'zd': 7}
 
         # setup mock create response
         gateway_service.orders_rpc.create_order.return_value = {
@@ -295,12 +778,15 @@ class TestCreateOrder(object):
         )
         assert response.status_code == 200
         assert response.json() == {'id': 11}
-        assert gateway_service.products_rpc.get.call_args_list == [call('zd')]
+        order_details = [
+            {'product_id': 'zd', 'quantity': 3, 'price': '41.00'}
+        ]
+        assert [call(order_details)] == (
+            gateway_service.products_rpc.reserve_stock.call_args_list)
         assert gateway_service.orders_rpc.create_order.call_args_list == [
-            call([
-                {'product_id': 'zd', 'quantity': 3, 'price': '41.00'}
-            ])
+            call(order_details, stock_reserved=True)
         ]
+        assert not gateway_service.products_rpc.release_stock.called
 
     def test_create_order_fails_with_invalid_json(
         self, gateway_service, web_session
@@ -331,11 +817,33 @@ class TestCreateOrder(object):
         assert response.status_code == 400
         assert response.json()['error'] == 'VALIDATION_ERROR'
 
+    @pytest.mark.parametrize('quantity', [0, -1])
+    def test_create_order_fails_with_non_positive_quantity(
+        self, gateway_service, web_session, quantity
+    ):
+        response = web_session.post(
+            '/orders',
+            json.dumps({
+                'order_details': [
+                    {
+                        'product_id': 'the_odyssey',
+                        'price': '41.00',
+                        'quantity': quantity,
+                    }
+                ]
+            })
+        )
+
+        assert response.status_code == 400
+        assert response.json()['error'] == 'VALIDATION_ERROR'
+        assert not gateway_service.products_rpc.reserve_stock.called
+
     def test_create_order_fails_with_unknown_product(
         self, gateway_service, web_session
     ):
         # setup mock products-service response:
-        gateway_service.products_rpc.get.side_effect = ProductNotFound('Product Id unknown')
+        gateway_service.products_rpc.reserve_stock.side_effect = (
+            ProductNotFound('Product ID unknown does not exist'))
 
         # call the gateway service to create the order
         response = web_session.post(
@@ -352,4 +860,186 @@ class TestCreateOrder(object):
         )
         assert response.status_code == 404
         assert response.json()['error'] == 'PRODUCT_NOT_FOUND'
-        assert response.json()['message'] == 'Product Id unknown'
+        assert response.json()['message'] == (
+            'Product ID unknown does not exist')
+        assert not gateway_service.orders_rpc.create_order.called
+
+    def test_create_order_fails_when_out_of_stock(
+        self, gateway_service, web_session
+    ):
+        gateway_service.products_rpc.reserve_stock.side_effect = (
+            OutOfStock('Product ID zd is out of stock'))
+
+        response = web_session.post(
+            '/orders',
+            json.dumps({
+                'order_details': [
+                    {'product_id': 'zd', 'price': '41', 'quantity': 100}
+                ]
+            })
+        )
+        assert response.status_code == 409
+        assert response.json()['error'] == 'OUT_OF_STOCK'
+        assert response.json()['message'] == 'Product ID zd is out of stock'
+        assert not gateway_service.orders_rpc.create_order.called
+
+    def test_create_order_sets_last_write_at_cookie(
+        self, gateway_service, web_session
+    ):
+        gateway_service.orders_rpc.create_order.return_value = {'id': 11}
+
+        response = web_session.post(
+            '/orders',
+            json.dumps({
+                'order_details': [
+                    {'product_id': 'zd', 'price': '41.00', 'quantity': 3}
+                ]
+            })
+        )
+        assert response.status_code == 200
+        assert time.time() - float(response.cookies['last_write_at']) < 60
+
+    def test_create_order_releases_stock_on_failure(
+        self, gateway_service, web_session
+    ):
+        gateway_service.orders_rpc.create_order.side_effect = (
+            RemoteError('OperationalError', 'database is down'))
+
+        response = web_session.post(
+            '/orders',
+            json.dumps({
+                'order_details': [
+                    {'product_id': 'zd', 'price': '41.00', 'quantity': 3}
+                ]
+            })
+        )
+        assert response.status_code == 500
+        assert [
+            call([{'product_id': 'zd', 'quantity': 3, 'price': '41.00'}])
+        ] == gateway_service.products_rpc.release_stock.call_args_list
+
+    def test_create_order_keeps_stock_when_outcome_is_unknown(
+        self, gateway_service, web_session
+    ):
+        # the order may have been created after all
+        gateway_service.orders_rpc.create_order.side_effect = RpcTimeout()
+
+        response = web_session.post(
+            '/orders',
+            json.dumps({
+                'order_details': [
+                    {'product_id': 'zd', 'price': '41.00', 'quantity': 3}
+                ]
+            })
+        )
+        assert response.status_code == 500
+        assert not gateway_service.products_rpc.release_stock.called
+
+
+class TestCreateOrders(object):
+
+    def test_can_create_orders(self, gateway_service, web_session):
+        gateway_service.products_rpc.get_many.call_async.return_value = (
+            rpc_reply([
+                {"id": "the_odyssey"}, {"id": "the_enigma"}
+            ]))
+        gateway_service.orders_rpc.create_orders.call_async.return_value = (
+            rpc_reply([
+                {'id': 11, 'order_details': []},
+                {'id': 12, 'order_details': []},
+            ]))
+
+        response = web_session.post(
+            '/orders/batch',
+            json.dumps({'orders': [
+                {'order_details': [
+                    {'product_id': 'the_odyssey', 'price': '41', 'quantity': 3}
+                ]},
+                {'order_details': [
+                    {'product_id': 'the_enigma', 'price': '5.99', 'quantity': 1},
+                    {'product_id': 'the_odyssey', 'price': '41', 'quantity': 1}
+                ]},
+            ]})
+        )
+
+        assert response.status_code == 200
+        assert response.json() == {'results': [{'id': 11}, {'id': 12}]}
+        assert gateway_service.products_rpc.get_many.call_async.call_args_list == [
+            call(['the_odyssey', 'the_enigma'])
+        ]
+        assert gateway_service.orders_rpc.create_orders.call_async.call_args_list == [
+            call([
+                {'order_details': [
+                    {'product_id': 'the_odyssey', 'price': '41', 'quantity': 3}
+                ]},
+                {'order_details': [
+                    {'product_id': 'the_enigma', 'price': '5.99', 'quantity': 1},
+                    {'product_id': 'the_odyssey', 'price': '41', 'quantity': 1}
+                ]},
+            ])
+        ]
+
+    def test_create_orders_reports_each_failure(
+        self, gateway_service, web_session
+    ):
+        gateway_service.products_rpc.get_many.call_async.return_value = (
+            rpc_reply([{"id": "the_odyssey"}]))
+        gateway_service.orders_rpc.create_orders.call_async.return_value = (
+            rpc_reply([{'id': 11, 'order_details': []}]))
+
+        response = web_session.post(
+            '/orders/batch',
+            json.dumps({'orders': [
+                {'order_details': [
+                    {'product_id': 'unknown', 'price': '41', 'quantity': 1}
+                ]},
+                {'order_details': [
+                    {'product_id': 'the_odyssey', 'price': '41', 'quantity': 3}
+                ]},
+                {'order_details': [{'product_id': 'the_odyssey'}]},
+            ]})
+        )
+
+        assert response.status_code == 200
+        results = response.json()['results']
+        assert results[0] == {
+            'error': 'PRODUCT_NOT_FOUND',
+            'message': 'Product ID unknown does not exist'
+        }
+        assert results[1] == {'id': 11}
+        assert results[2]['error'] == 'VALIDATION_ERROR'
+        assert gateway_service.orders_rpc.create_orders.call_async.call_args_list == [
+            call([
+                {'order_details': [
+                    {'product_id': 'the_odyssey', 'price': '41', 'quantity': 3}
+                ]},
+            ])
+        ]
+
+    def test_create_orders_in_batches(self, gateway_service, web_session):
+        gateway_service.products_rpc.get_many.call_async.return_value = (
+            rpc_reply([{"id": "the_odyssey"}]))
+        gateway_service.orders_rpc.create_orders.call_async.side_effect = [
+            rpc_reply([{'id': 1}, {'id': 2}]),
+            rpc_reply([{'id': 3}]),
+        ]
+        order = {'order_details': [
+            {'product_id': 'the_odyssey', 'price': '41', 'quantity': 1}
+        ]}
+
+        with config.patch({'ORDERS_BATCH_SIZE': 2}):
+            response = web_session.post(
+                '/orders/batch', json.dumps({'orders': [order] * 3}))
+
+        assert response.json() == {'results': [{'id': 1}, {'id': 2}, {'id': 3}]}
+        assert gateway_service.orders_rpc.create_orders.call_async.call_args_list == [
+            call([order, order]), call([order])
+        ]
+
+    def test_create_orders_fails_with_invalid_json(
+        self, gateway_service, web_session
+    ):
+        response = web_session.post('/orders/batch', 'NOT-JSON')
+
+        assert response.status_code == 400
+        assert response.json()['error'] == 'BAD_REQUEST'
@@ -0,0 +1,181 @@
+import eventlet
+import pytest
+from eventlet.event import Event
+from mock import Mock
+
+from gateway.cache import ResponseCache
+
+
+class Timer:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class Spawner:
+    """ Collects background loads, to run them when the test decides """
+
+    def __init__(self):
+        self.spawned = []
+
+    def __call__(self, fn):
+        self.spawned.append(fn)
+
+    def run(self):
+        spawned, self.spawned = self.spawned, []
+        for fn in spawned:
+            fn()
+
+
+@pytest.fixture
+def timer():
+    return Timer()
+
+
+@pytest.fixture
+def spawn():
+    return Spawner()
+
+
+@pytest.fixture
+def cache(timer, spawn):
+    return ResponseCache(
+        maxsize=2, ttl=10, stale_ttl=20, timer=timer, spawn=spawn)
+
+
+def test_miss_loads(cache):
+    load = Mock(return_value={'id': 1})
+
+    assert {'id': 1} == cache.get(1, load)
+    assert 1 == load.call_count
+    assert (0, 1) == (cache.stats()['hits'], cache.stats()['misses'])
+
+
+def test_fresh_hit(cache):
+    load = Mock(return_value={'id': 1})
+    cache.get(1, load)
+
+    assert {'id': 1} == cache.get(1, load)
+    assert 1 == load.call_count
+    assert (1, 1) == (cache.stats()['hits'], cache.stats()['misses'])
+
+
+def test_stale_hit_revalidates_once_in_background(cache, timer, spawn):
+    cache.get(1, Mock(return_value='old'))
+    timer.now = 15
+    load = Mock(return_value='new')
+
+    assert 'old' == cache.get(1, load)
+    assert 'old' == cache.get(1, load)
+    assert not load.called
+    assert 1 == len(spawn.spawned)
+
+    spawn.run()
+
+    assert 'new' == cache.get(1, load)
+    assert 1 == load.call_count
+    assert 2 == cache.stats()['stale_hits']
+
+
+def test_failed_revalidation_keeps_stale_value(cache, timer, spawn):
+    cache.get(1, Mock(return_value='old'))
+    timer.now = 15
+
+    cache.get(1, Mock(side_effect=ConnectionError('down')))
+    spawn.run()
+
+    assert 'old' == cache.get(1, Mock(return_value='new'))
+    assert 1 == len(spawn.spawned)
+
+
+def test_expired_entry_is_loaded(cache, timer):
+    cache.get(1, Mock(return_value='old'))
+    timer.now = 30
+
+    assert 'new' == cache.get(1, Mock(return_value='new'))
+
+
+def test_concurrent_misses_are_coalesced(cache):
+    release = Event()
+    calls = []
+
+    def load():
+        calls.append(1)
+        release.wait()
+        return {'id': 1}
+
+    threads = [eventlet.spawn(cache.get, 1, load) for _ in range(5)]
+    eventlet.sleep()
+    release.send()
+
+    assert [{'id': 1}] * 5 == [thread.wait() for thread in threads]
+    assert [1] == calls
+    assert 4 == cache.stats()['coalesced']
+
+
+def test_coalesced_callers_get_the_exception(cache):
+    release = Event()
+
+    def load():
+        release.wait()
+        raise ValueError('boom')
+
+    threads = [eventlet.spawn(cache.get, 1, load) for _ in range(3)]
+    eventlet.sleep()
+    release.send()
+
+    for thread in threads:
+        with pytest.raises(ValueError):
+            thread.wait()
+    # errors are not cached
+    assert 'ok' == cache.get(1, Mock(return_value='ok'))
+
+
+def test_invalidation_discards_loads_in_flight(cache):
+    release = Event()
+
+    def load():
+        release.wait()
+        return 'old'
+
+    before = eventlet.spawn(cache.get, 1, load)
+    eventlet.sleep()
+
+    cache.invalidate(1)
+    after = eventlet.spawn(cache.get, 1, Mock(return_value='new'))
+    release.send()
+
+    assert 'old' == before.wait()
+    assert 'new' == after.wait()
+    assert 'new' == cache.get(1, Mock(return_value='newer'))
+
+
+def test_clear(cache):
+    cache.get(1, Mock(return_value='old'))
+
+    cache.clear()
+
+    assert 'new' == cache.get(1, Mock(return_value='new'))
+
+
+def test_least_recently_used_entries_are_evicted(cache):
+    cache.get(1, Mock(return_value=1))
+    cache.get(2, Mock(return_value=2))
+    cache.get(1, Mock())
+    cache.get(3, Mock(return_value=3))
+
+    assert 1 == cache.get(1, Mock())
+    assert 'reloaded' == cache.get(2, Mock(return_value='reloaded'))
+
+
+def test_disabled(timer, spawn):
+    cache = ResponseCache(maxsize=10, ttl=0, timer=timer, spawn=spawn)
+    load = Mock(return_value='value')
+
+    cache.get(1, load)
+    cache.get(1, load)
+
+    assert 2 == load.call_count
@@ -1,8 +1,12 @@
+import gzip
 import json
 import pytest
 from marshmallow import ValidationError
+from nameko import config
+from werkzeug import Request, Response
+from werkzeug.test import EnvironBuilder
 
-from gateway.entrypoints import HttpEntrypoint
+from gateway.entrypoints import HttpEntrypoint, ReadYourWritesWebServer
 from gateway.exceptions import ProductNotFound, OrderNotFound
 
 
@@ -36,3 +40,113 @@ class TestHttpEntrypoint(object):
         assert response.status_code == expected_status_code
         assert response_data['error'] == expected_error
         assert response_data['message'] == expected_message
+
+
+def make_request(**headers):
+    return Request(EnvironBuilder(path='/url', headers=headers).get_environ())
+
+
+class TestConditionalGet(object):
+
+    def test_etag_is_added(self):
+        entrypoint = HttpEntrypoint('GET', 'url')
+        response = Response('{"id": 1}', mimetype='application/json')
+
+        response = entrypoint.make_conditional(make_request(), response)
+
+        assert response.status_code == 200
+        etag, weak = response.get_etag()
+        assert etag and weak
+
+    def test_not_modified(self):
+        entrypoint = HttpEntrypoint('GET', 'url')
+        response = Response('{"id": 1}', mimetype='application/json')
+        response.add_etag(weak=True)
+        etag = response.headers['ETag']
+
+        response = entrypoint.make_conditional(
+            make_request(**{'If-None-Match': etag}), response)
+
+        assert response.status_code == 304
+        assert response.get_data() == b''
+        assert response.headers['ETag'] == etag
+
+    def test_etag_set_by_handler_is_kept(self):
+        entrypoint = HttpEntrypoint('GET', 'url')
+        response = Response('{"id": 1}', mimetype='application/json')
+        response.set_etag('version-1', weak=True)
+
+        response = entrypoint.make_conditional(make_request(), response)
+
+        assert response.headers['ETag'] == 'W/"version-1"'
+
+
+class TestCompression(object):
+
+    @pytest.fixture(autouse=True)
+    def min_size(self):
+        with config.patch({'COMPRESSION_MIN_SIZE': 100}):
+            yield
+
+    def make_response(self, size):
+        return Response('x' * size, mimetype='application/json')
+
+    def test_large_body_is_compressed(self):
+        entrypoint = HttpEntrypoint('GET', 'url')
+
+        response = entrypoint.compress(
+            make_request(**{'Accept-Encoding': 'gzip, deflate'}),
+            self.make_response(100)
+        )
+
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        assert gzip.decompress(response.get_data()) == b'x' * 100
+
+    def test_small_body_is_not_compressed(self):
+        entrypoint = HttpEntrypoint('GET', 'url')
+
+        response = entrypoint.compress(
+            make_request(**{'Accept-Encoding': 'gzip'}),
+            self.make_response(99)
+        )
+
+        assert 'Content-Encoding' not in response.headers
+        assert response.headers['Vary'] == 'Accept-Encoding'
+
+    @pytest.mark.parametrize('accept_encoding', [None, 'identity', 'gzip;q=0'])
+    def test_not_compressed_unless_accepted(self, accept_encoding):
+        entrypoint = HttpEntrypoint('GET', 'url')
+        headers = {'Accept-Encoding': accept_encoding} if accept_encoding else {}
+
+        response = entrypoint.compress(
+            make_request(**headers), self.make_response(1000))
+
+        assert 'Content-Encoding' not in response.headers
+        assert response.get_data() == b'x' * 1000
+
+    def test_brotli_is_preferred(self):
+        brotli = pytest.importorskip('brotli')
+        entrypoint = HttpEntrypoint('GET', 'url')
+
+        response = entrypoint.compress(
+            make_request(**{'Accept-Encoding': 'gzip, br'}),
+            self.make_response(1000)
+        )
+
+        assert response.headers['Content-Encoding'] == 'br'
+        assert brotli.decompress(response.get_data()) == b'x' * 1000
+
+
+class TestReadYourWrites(object):
+
+    def test_last_write_at_cookie_is_passed_on_as_context_data(self):
+        request = make_request(Cookie='last_write_at=1700000000.123')
+
+        assert {'last_write_at': '1700000000.123'} == (
+            ReadYourWritesWebServer().context_data_from_headers(request))
+
+    def test_no_context_data_without_cookie(self):
+        assert {} == (
+            ReadYourWritesWebServer().context_data_from_headers(
+                make_request()))
@@ -0,0 +1,52 @@
+import json
+
+from gateway.schemas import GetOrderSchema, ProductSchema
+from gateway.serializers import serialize_order, serialize_product
+
+
+def test_serialize_order_matches_schema():
+    order = {
+        'id': 1,
+        'total_amount': '1042.50',
+        'line_count': 2,
+        'order_details': [
+            {
+                'id': 1,
+                'quantity': 5,
+                'product_id': 'the_odyssey',
+                'image': 'http://example.com/airship/images/the_odyssey.jpg',
+                'price': '99.51',
+                'product': {
+                    'id': 'the_odyssey',
+                    'title': 'The Odyssey',
+                    'maximum_speed': 3,
+                    'in_stock': 899,
+                    'passenger_capacity': 100,
+                },
+            },
+            {
+                'id': 2,
+                'quantity': 109,
+                'product_id': 'the_enigma',
+                'price': '5.00',
+                'product': None,
+            },
+        ],
+    }
+
+    assert json.dumps(serialize_order(order)) == json.dumps(
+        GetOrderSchema().dump(order).data)
+
+
+def test_serialize_product_matches_schema():
+    product = {
+        'id': 'the_odyssey',
+        'title': 'The Odyssey',
+        'maximum_speed': '3',
+        'in_stock': 899,
+        'passenger_capacity': 100,
+        'extra': 'ignored',
+    }
+
+    assert json.dumps(serialize_product(product)) == json.dumps(
+        ProductSchema().dump(product).data)
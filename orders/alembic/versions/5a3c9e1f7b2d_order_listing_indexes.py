@@ -0,0 +1,31 @@
+"""order listing indexes
+
+Revision ID: 5a3c9e1f7b2d
+Revises: dd33cb03d01f
+Create Date: 2026-10-17 10:12:44.517306
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '5a3c9e1f7b2d'
+down_revision = 'dd33cb03d01f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keyset pagination of the orders list seeks on (created_at, id)
+    op.create_index(
+        "ix_orders_created_at_id", "orders", ["created_at", "id"]
+    )
+    # loading the details of a page of orders looks them up by order
+    op.create_index(
+        "ix_order_details_order_id", "order_details", ["order_id"]
+    )
+
+
+def downgrade():
+    op.drop_index("ix_order_details_order_id", table_name="order_details")
+    op.drop_index("ix_orders_created_at_id", table_name="orders")
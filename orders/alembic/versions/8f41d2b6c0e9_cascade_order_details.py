@@ -0,0 +1,36 @@
+"""cascade order details
+
+Revision ID: 8f41d2b6c0e9
+Revises: 5a3c9e1f7b2d
+Create Date: 2026-10-17 11:03:27.904152
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '8f41d2b6c0e9'
+down_revision = '5a3c9e1f7b2d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # deleting an order deletes its details in the same statement
+    op.drop_constraint(
+        "fk_order_details_orders", "order_details", type_="foreignkey"
+    )
+    op.create_foreign_key(
+        "fk_order_details_orders", "order_details", "orders",
+        ["order_id"], ["id"], ondelete="CASCADE"
+    )
+
+
+def downgrade():
+    op.drop_constraint(
+        "fk_order_details_orders", "order_details", type_="foreignkey"
+    )
+    op.create_foreign_key(
+        "fk_order_details_orders", "order_details", "orders",
+        ["order_id"], ["id"]
+    )
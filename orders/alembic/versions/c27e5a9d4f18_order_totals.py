@@ -0,0 +1,53 @@
+"""order totals
+
+Revision ID: c27e5a9d4f18
+Revises: 8f41d2b6c0e9
+Create Date: 2026-10-17 11:48:09.211473
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'c27e5a9d4f18'
+down_revision = '8f41d2b6c0e9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "orders",
+        sa.Column(
+            "total_amount", sa.DECIMAL(18, 2), nullable=False,
+            server_default="0"
+        )
+    )
+    op.add_column(
+        "orders",
+        sa.Column("line_count", sa.Integer(), nullable=False,
+                  server_default="0")
+    )
+
+    op.execute(
+        "UPDATE orders SET "
+        "total_amount = totals.total_amount, "
+        "line_count = totals.line_count "
+        "FROM ("
+        "  SELECT order_id, "
+        "  SUM(price * quantity) AS total_amount, "
+        "  COUNT(*) AS line_count "
+        "  FROM order_details GROUP BY order_id"
+        ") AS totals "
+        "WHERE orders.id = totals.order_id"
+    )
+
+    # the orders service sets them from now on
+    op.alter_column("orders", "total_amount", server_default=None)
+    op.alter_column("orders", "line_count", server_default=None)
+
+
+def downgrade():
+    op.drop_column("orders", "line_count")
+    op.drop_column("orders", "total_amount")
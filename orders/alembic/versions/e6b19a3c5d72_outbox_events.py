@@ -0,0 +1,34 @@
+"""outbox events
+
+Revision ID: e6b19a3c5d72
+Revises: c27e5a9d4f18
+Create Date: 2026-10-17 13:20:51.630984
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'e6b19a3c5d72'
+down_revision = 'c27e5a9d4f18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "outbox_events",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("event_id", sa.String(36), nullable=False),
+        sa.Column("event_type", sa.String(255), nullable=False),
+        sa.Column("payload", sa.Text(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("event_id")
+    )
+
+
+def downgrade():
+    op.drop_table("outbox_events")
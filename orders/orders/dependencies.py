@@ -0,0 +1,424 @@
+import itertools
+import json
+import logging
+import threading
+import time
+
+from nameko import config
+from nameko.extensions import DependencyProvider
+from nameko.standalone.events import event_dispatcher
+from nameko_sqlalchemy import DatabaseSession
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError, TimeoutError as PoolTimeout
+from sqlalchemy.pool import NullPool, QueuePool
+
+from nameko_examples_common.cache import TTLCache
+from orders.models import OutboxEvent
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+
+ORDER_CACHE_SIZE_KEY = 'ORDER_CACHE_SIZE'
+ORDER_CACHE_TTL_KEY = 'ORDER_CACHE_TTL'
+ORDER_CACHE_REDIS_URI_KEY = 'ORDER_CACHE_REDIS_URI'
+ORDER_CACHE_REDIS_TTL_KEY = 'ORDER_CACHE_REDIS_TTL'
+
+ORDER_CACHE_KEY = 'orders:order:{}'
+
+DB_POOL_SIZE_KEY = 'DB_POOL_SIZE'
+DB_MAX_OVERFLOW_KEY = 'DB_MAX_OVERFLOW'
+DB_POOL_TIMEOUT_KEY = 'DB_POOL_TIMEOUT'
+DB_POOL_RECYCLE_KEY = 'DB_POOL_RECYCLE'
+DB_POOL_PRE_PING_KEY = 'DB_POOL_PRE_PING'
+DB_QUERY_CACHE_SIZE_KEY = 'DB_QUERY_CACHE_SIZE'
+DB_PGBOUNCER_KEY = 'DB_PGBOUNCER'
+DB_REPLICA_URIS_KEY = 'DB_REPLICA_URIS'
+DB_REPLICA_STICKY_SECONDS_KEY = 'DB_REPLICA_STICKY_SECONDS'
+DB_REPLICA_RETRY_SECONDS_KEY = 'DB_REPLICA_RETRY_SECONDS'
+
+# Context data of callers that just wrote: when they last did, in seconds
+# since the epoch, see `PooledDatabaseSession`
+LAST_WRITE_AT_CONTEXT_KEY = 'last_write_at'
+# How far ahead of ours the clocks of the gateways may be, in seconds
+LAST_WRITE_AT_CLOCK_SKEW = 1
+
+OUTBOX_BATCH_SIZE_KEY = 'OUTBOX_BATCH_SIZE'
+OUTBOX_POLL_INTERVAL_KEY = 'OUTBOX_POLL_INTERVAL'
+OUTBOX_RETRY_DELAY_KEY = 'OUTBOX_RETRY_DELAY'
+
+logger = logging.getLogger(__name__)
+
+
+class OrderCacheWrapper:
+    """
+    Read-through cache of serialized order documents.
+
+    Orders are looked up in a process-wide `TTLCache` shared by all workers,
+    then, when one is configured, in a Redis tier shared by every orders
+    instance, and only then loaded from the database. Only plain documents
+    are cached, never SQLAlchemy objects, so nothing outlives the session
+    of the worker that loaded it.
+
+    Writes invalidate both tiers. Other instances may keep serving their
+    local copy of a changed order for up to `ORDER_CACHE_TTL` seconds.
+
+    """
+
+    def __init__(self, cache, client=None, client_ttl=None):
+        self.cache = cache
+        self.client = client
+        self.client_ttl = client_ttl
+
+    def _format_key(self, order_id):
+        return ORDER_CACHE_KEY.format(order_id)
+
+    def _get_shared(self, order_id):
+        try:
+            document = self.client.get(self._format_key(order_id))
+        except redis.RedisError:
+            logger.warning('Could not read the shared order cache',
+                           exc_info=True)
+            return None
+        return json.loads(document) if document is not None else None
+
+    def _set_shared(self, order_id, order):
+        try:
+            self.client.set(
+                self._format_key(order_id), json.dumps(order),
+                ex=self.client_ttl)
+        except redis.RedisError:
+            logger.warning('Could not write the shared order cache',
+                           exc_info=True)
+
+    def get(self, order_id, load):
+        """ Return the cached document of order `order_id`, calling
+        `load()` to serialize it from the database on a miss.
+        """
+        order = self.cache.get(order_id)
+        if order is not None:
+            return order
+
+        generation = self.cache.generation
+        if self.client is not None:
+            order = self._get_shared(order_id)
+        if order is None:
+            order = load()
+            # unless the order was changed or deleted while it loaded, which
+            # would write the outdated document back
+            if (
+                self.client is not None and
+                self.cache.generation == generation
+            ):
+                self._set_shared(order_id, order)
+
+        self.cache.set(order_id, order, generation)
+        return order
+
+    def invalidate(self, *order_ids):
+        self.cache.invalidate(*order_ids)
+        if self.client is not None and order_ids:
+            try:
+                self.client.delete(*map(self._format_key, order_ids))
+            except redis.RedisError:
+                logger.warning('Could not invalidate the shared order cache',
+                               exc_info=True)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+class OrderCache(DependencyProvider):
+    """ Provides an `OrderCacheWrapper` sharing the local cache and, when
+    `ORDER_CACHE_REDIS_URI` is set, the Redis client of the container.
+    """
+
+    def setup(self):
+        self.cache = TTLCache(
+            maxsize=int(config.get(ORDER_CACHE_SIZE_KEY, 1024)),
+            ttl=float(config.get(ORDER_CACHE_TTL_KEY, 5)),
+        )
+        self.client = None
+        self.client_ttl = int(config.get(ORDER_CACHE_REDIS_TTL_KEY, 60))
+
+        redis_uri = config.get(ORDER_CACHE_REDIS_URI_KEY)
+        if redis_uri:
+            if redis is None:
+                raise RuntimeError(
+                    '{} is set but redis is not installed'.format(
+                        ORDER_CACHE_REDIS_URI_KEY))
+            self.client = redis.StrictRedis.from_url(redis_uri)
+
+    def get_dependency(self, worker_ctx):
+        return OrderCacheWrapper(self.cache, self.client, self.client_ttl)
+
+
+def read_only(entrypoint):
+    """ Marks a service method as only reading from the database, so that
+    `PooledDatabaseSession` may serve its workers from a read replica.
+    """
+    entrypoint.read_only = True
+    return entrypoint
+
+
+class TimedQueuePool(QueuePool):
+    """ `QueuePool` keeping track of how long checkouts wait for a
+    connection, including the time to open a new one.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        except PoolTimeout:
+            self.checkout_timeouts += 1
+            raise
+        finally:
+            wait = time.monotonic() - start
+            self.checkouts += 1
+            self.checkout_wait_total += wait
+            self.checkout_wait_max = max(self.checkout_wait_max, wait)
+
+    def stats(self):
+        return {
+            'size': self.size(),
+            'checked_out': self.checkedout(),
+            'overflow': self.overflow(),
+            'checkouts': self.checkouts,
+            'checkout_timeouts': self.checkout_timeouts,
+            'checkout_wait_avg': (
+                self.checkout_wait_total / self.checkouts
+                if self.checkouts else 0.0
+            ),
+            'checkout_wait_max': self.checkout_wait_max,
+        }
+
+
+class PooledDatabaseSession(DatabaseSession):
+    """ `DatabaseSession` whose connection pool is configured from config,
+    and which serves read-only workers from read replicas.
+
+    By default the pool holds `DB_POOL_SIZE` connections, as many as the
+    service runs workers (`max_workers`), so a worker never waits for
+    another to give its connection back, plus up to `DB_MAX_OVERFLOW`
+    more under bursts. Connections are checked with a ping before use
+    and recycled after `DB_POOL_RECYCLE` seconds. Checkouts are timed,
+    see `TimedQueuePool.stats`. Compiled statements are cached, up to
+    `DB_QUERY_CACHE_SIZE` of them.
+
+    With `DB_PGBOUNCER`, connections are not pooled by the service but
+    opened and closed around every use, leaving the pooling to PgBouncer.
+
+    Workers of entrypoints marked `read_only` get a session bound to one
+    of `DB_REPLICA_URIS`, taken in turn. A replica that cannot be
+    connected to is skipped for `DB_REPLICA_RETRY_SECONDS`, and without a
+    reachable replica the primary is used.
+
+    Workers whose caller wrote less than `DB_REPLICA_STICKY_SECONDS` ago,
+    according to the `last_write_at` timestamp in their context data, use
+    the primary too, so that the caller reads its own writes whatever the
+    replication lag and whichever instance serves it. The gateway keeps
+    that timestamp for every client; as clients may tamper with it,
+    timestamps further in the future than `LAST_WRITE_AT_CLOCK_SKEW` are
+    ignored.
+    """
+
+    def setup(self):
+        self.engine_options = dict(
+            self._configured_engine_options(), **self.engine_options)
+        super(PooledDatabaseSession, self).setup()
+
+        replica_uris = config.get(DB_REPLICA_URIS_KEY) or []
+        if isinstance(replica_uris, str):
+            replica_uris = [
+                uri.strip() for uri in replica_uris.split(',') if uri.strip()]
+        self.replica_engines = [
+            create_engine(uri, **self.engine_options) for uri in replica_uris
+        ]
+        self._replicas = itertools.cycle(self.replica_engines)
+        self._replica_down_until = {}
+        self.sticky_seconds = float(
+            config.get(DB_REPLICA_STICKY_SECONDS_KEY, 2))
+        self.retry_seconds = float(
+            config.get(DB_REPLICA_RETRY_SECONDS_KEY, 10))
+        self.connections = {}
+
+    def _configured_engine_options(self):
+        options = {
+            'query_cache_size': int(config.get(DB_QUERY_CACHE_SIZE_KEY, 500)),
+        }
+        if config.get(DB_PGBOUNCER_KEY, False):
+            options['poolclass'] = NullPool
+            return options
+
+        options.update({
+            'poolclass': TimedQueuePool,
+            'pool_size': int(config.get(
+                DB_POOL_SIZE_KEY, config.get('max_workers', 10))),
+            'max_overflow': int(config.get(DB_MAX_OVERFLOW_KEY, 5)),
+            'pool_timeout': float(config.get(DB_POOL_TIMEOUT_KEY, 30)),
+            'pool_recycle': int(config.get(DB_POOL_RECYCLE_KEY, 1800)),
+            'pool_pre_ping': bool(config.get(DB_POOL_PRE_PING_KEY, True)),
+        })
+        return options
+
+    def stop(self):
+        for engine in self.replica_engines:
+            engine.dispose()
+        super(PooledDatabaseSession, self).stop()
+
+    def kill(self):
+        for engine in self.replica_engines:
+            engine.dispose()
+        super(PooledDatabaseSession, self).kill()
+
+    def _is_read_only(self, worker_ctx):
+        method = getattr(
+            self.container.service_cls, worker_ctx.entrypoint.method_name)
+        return getattr(method, 'read_only', False)
+
+    def _is_sticky(self, worker_ctx):
+        try:
+            last_write_at = float(worker_ctx.data[LAST_WRITE_AT_CONTEXT_KEY])
+        except (KeyError, TypeError, ValueError):
+            return False
+        age = time.time() - last_write_at
+        return -LAST_WRITE_AT_CLOCK_SKEW <= age < self.sticky_seconds
+
+    def _connect_replica(self):
+        now = time.monotonic()
+        for _ in range(len(self.replica_engines)):
+            engine = next(self._replicas)
+            if self._replica_down_until.get(engine, 0) > now:
+                continue
+            try:
+                return engine.connect()
+            except DBAPIError:
+                logger.warning(
+                    'Read replica %s is unavailable', engine.url,
+                    exc_info=True)
+                self._replica_down_until[engine] = now + self.retry_seconds
+        return None
+
+    def get_dependency(self, worker_ctx):
+        if (
+            self.replica_engines and
+            self._is_read_only(worker_ctx) and
+            not self._is_sticky(worker_ctx)
+        ):
+            connection = self._connect_replica()
+            if connection is not None:
+                session = self.Session(bind=connection)
+                self.sessions[worker_ctx] = session
+                self.connections[worker_ctx] = connection
+                return session
+        return super(PooledDatabaseSession, self).get_dependency(worker_ctx)
+
+    def worker_teardown(self, worker_ctx):
+        super(PooledDatabaseSession, self).worker_teardown(worker_ctx)
+        connection = self.connections.pop(worker_ctx, None)
+        if connection is not None:
+            connection.close()
+
+
+class OutboxRelayWrapper:
+
+    def __init__(self, wake):
+        self._wake = wake
+
+    def wake(self):
+        """ Have the relay dispatch pending events now rather than at its
+        next poll. Call after committing new outbox events.
+        """
+        self._wake.set()
+
+
+class OutboxRelay(DependencyProvider):
+    """ Dispatches the `OutboxEvent`s written by the service.
+
+    While the container runs, a managed thread reads pending events in
+    batches of `OUTBOX_BATCH_SIZE`, oldest first, dispatches them as events
+    of the service and deletes them once they were all confirmed by the
+    broker. It runs when woken by a worker that wrote events and every
+    `OUTBOX_POLL_INTERVAL` seconds, and retries after
+    `OUTBOX_RETRY_DELAY` seconds when the database or the broker fails.
+
+    Events are delivered at least once: an event dispatched just before a
+    failure is dispatched again. Every payload carries the UUID of its outbox
+    event as `event_id`, the same for every delivery, so that handlers can
+    skip the events they already applied. On Postgres, batches are locked with
+    SKIP LOCKED so that the relays of several instances share the work.
+    """
+
+    def setup(self):
+        self.batch_size = int(config.get(OUTBOX_BATCH_SIZE_KEY, 100))
+        self.poll_interval = float(config.get(OUTBOX_POLL_INTERVAL_KEY, 1))
+        self.retry_delay = float(config.get(OUTBOX_RETRY_DELAY_KEY, 5))
+        self.dispatch = event_dispatcher()
+        self._wake = threading.Event()
+
+    def start(self):
+        self.Session = next(
+            dependency.Session for dependency in self.container.dependencies
+            if isinstance(dependency, DatabaseSession)
+        )
+        self.container.spawn_managed_thread(self._relay)
+
+    def get_dependency(self, worker_ctx):
+        return OutboxRelayWrapper(self._wake)
+
+    def _relay(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                while self.relay_batch() == self.batch_size:
+                    pass
+            except Exception:
+                logger.warning(
+                    'Could not relay outbox events, retrying in %ss',
+                    self.retry_delay, exc_info=True)
+                time.sleep(self.retry_delay)
+                self._wake.set()
+
+    def relay_batch(self):
+        """ Dispatch and delete the next batch of pending events, and
+        return how many there were.
+        """
+        session = self.Session()
+        try:
+            query = (
+                session.query(OutboxEvent)
+                .order_by(OutboxEvent.id)
+                .limit(self.batch_size)
+            )
+            if session.bind.dialect.name == 'postgresql':
+                query = query.with_for_update(skip_locked=True)
+            events = query.all()
+            if not events:
+                return 0
+
+            for outbox_event in events:
+                payload = json.loads(outbox_event.payload)
+                payload['event_id'] = outbox_event.event_id
+                self.dispatch(
+                    self.container.service_name, outbox_event.event_type,
+                    payload)
+
+            session.query(OutboxEvent).filter(
+                OutboxEvent.id.in_(
+                    [outbox_event.id for outbox_event in events])
+            ).delete(synchronize_session=False)
+            session.commit()
+            return len(events)
+        finally:
+            session.close()
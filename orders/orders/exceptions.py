@@ -1,2 +1,6 @@
 class NotFound(Exception):
     pass
+
+
+class InvalidCursor(Exception):
+    pass
@@ -1,10 +1,11 @@
 import datetime
+import uuid
 
 from sqlalchemy import (
-    DECIMAL, Column, DateTime, ForeignKey, Integer,
+    DECIMAL, Column, DateTime, ForeignKey, Index, Integer, String, Text,
 )
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import backref, relationship
 
 
 class Base(object):
@@ -28,7 +29,16 @@ class Order(DeclarativeBase):
     __tablename__ = "orders"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    
+    # sum of price * quantity and number of the order details, kept up to
+    # date by the orders service so that listings need not load the details
+    total_amount = Column(DECIMAL(18, 2), default=0, nullable=False)
+    line_count = Column(Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        # supports the keyset pagination of `list_orders`
+        Index('ix_orders_created_at_id', 'created_at', 'id'),
+    )
+
 
 class OrderDetail(DeclarativeBase):
     __tablename__ = "order_details"
@@ -36,10 +46,35 @@ class OrderDetail(DeclarativeBase):
     id = Column(Integer, primary_key=True, autoincrement=True)
     order_id = Column(
         Integer,
-        ForeignKey("orders.id", name="fk_order_details_orders"),
-        nullable=False
+        ForeignKey(
+            "orders.id", name="fk_order_details_orders", ondelete="CASCADE"
+        ),
+        nullable=False,
+        index=True
     )
-    order = relationship(Order, backref="order_details")
+    # the database deletes the details of a deleted order
+    order = relationship(
+        Order, backref=backref("order_details", passive_deletes=True))
     product_id = Column(Integer, nullable=False)
     price = Column(DECIMAL(18, 2), nullable=False)
     quantity = Column(Integer, nullable=False)
+
+
+class OutboxEvent(DeclarativeBase):
+    """ An event written in the transaction of the change it announces and
+    dispatched once that transaction committed, see
+    `orders.dependencies.OutboxRelay`.
+    """
+    __tablename__ = "outbox_events"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # ids are reused by SQLite and after sequence resets or restores, so
+    # handlers recognise redeliveries by this one instead
+    event_id = Column(
+        String(36),
+        default=lambda: str(uuid.uuid4()),
+        nullable=False,
+        unique=True
+    )
+    event_type = Column(String(255), nullable=False)
+    payload = Column(Text, nullable=False)
@@ -10,4 +10,6 @@ class OrderDetailSchema(Schema):
 
 class OrderSchema(Schema):
     id = fields.Int(required=True)
+    total_amount = fields.Decimal(as_string=True)
+    line_count = fields.Int()
     order_details = fields.Nested(OrderDetailSchema, many=True)
@@ -0,0 +1,12 @@
+"""
+Serializers compiled from the schemas of the service, see
+`nameko_examples_common.serializers`.
+"""
+from nameko_examples_common.serializers import compile_serializer
+
+from orders.schemas import OrderSchema
+
+
+serialize_order = compile_serializer(OrderSchema())
+serialize_order_summary = compile_serializer(
+    OrderSchema(exclude=('order_details',)))
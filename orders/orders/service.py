@@ -1,25 +1,64 @@
-from nameko.events import EventDispatcher
+import base64
+import binascii
+import datetime
+import json
+import time
+from decimal import Decimal
+
+from nameko import config
 from nameko.rpc import rpc
-from nameko_sqlalchemy import DatabaseSession
-from functools import lru_cache
-from orders.exceptions import NotFound
-from orders.models import DeclarativeBase, Order, OrderDetail
-from orders.schemas import OrderSchema
+from sqlalchemy import (
+    DECIMAL, Integer, bindparam, column, func, select, text, tuple_, update,
+    values
+)
+from sqlalchemy.orm import selectinload
+from orders.dependencies import (
+    OrderCache, OutboxRelay, PooledDatabaseSession, TimedQueuePool,
+    read_only
+)
+from orders.exceptions import InvalidCursor, NotFound
+from orders.models import DeclarativeBase, Order, OrderDetail, OutboxEvent
+from orders.serializers import serialize_order, serialize_order_summary
+
+
+ORDERS_COUNT_TTL_KEY = 'ORDERS_COUNT_TTL'
+
+# How `list_orders` computes `total_orders`:
+# - 'exact' runs a COUNT(*) over the whole table,
+# - 'estimate' reads the planner's row estimate on Postgres (exact elsewhere),
+# - 'cached' reuses an exact count for `ORDERS_COUNT_TTL` seconds.
+COUNT_MODES = ('exact', 'estimate', 'cached')
+
+CENTS = Decimal('0.01')
+
+# rows `export_orders` fetches from the database cursor at a time
+EXPORT_YIELD_PER = 500
 
 
 class OrderServiceMixin:
-    db = DatabaseSession(DeclarativeBase)
+    db = PooledDatabaseSession(DeclarativeBase)
 
-    @lru_cache(maxsize=128)
     def _get_order(self, order_id):
         order = self.db.query(Order).get(order_id)
         if not order:
             raise NotFound(f"Order with id {order_id} not found")
         return order
 
+    def _load_order(self, order_id):
+        """ Like `_get_order`, with the order details loaded up front """
+        order = (
+            self.db.query(Order)
+            .options(selectinload(Order.order_details))
+            .filter(Order.id == order_id)
+            .one_or_none()
+        )
+        if not order:
+            raise NotFound(f"Order with id {order_id} not found")
+        return order
+
 
 class OrderDetailServiceMixin:
-    db = DatabaseSession(DeclarativeBase)
+    db = PooledDatabaseSession(DeclarativeBase)
 
     def _get_order_details(self, order):
         return {od.id: od for od in order.order_details}
@@ -28,33 +67,176 @@ class OrderDetailServiceMixin:
 class OrdersService(OrderServiceMixin, OrderDetailServiceMixin):
     name = 'orders'
 
-    event_dispatcher = EventDispatcher()
+    outbox_relay = OutboxRelay()
+    order_cache = OrderCache()
+
+    @rpc
+    def db_pool_stats(self):
+        pool = self.db.bind.pool
+        return pool.stats() if isinstance(pool, TimedQueuePool) else {}
 
     @rpc
     def get_order(self, order_id):
-        order = self._get_order(order_id)
-        return OrderSchema().dump(order).data
+        # not `read_only`: on a miss the order is cached, and a lagging
+        # replica could return it as it was before its last update
+        return self.order_cache.get(
+            order_id,
+            lambda: serialize_order(self._get_order(order_id))
+        )
+
+    # shared by the workers of the service, see `_count_orders`
+    _cached_total_orders = None
+    _cached_total_orders_expires_at = 0
+
+    def _count_orders(self, count):
+        if count not in COUNT_MODES:
+            raise ValueError(
+                'count must be one of {}'.format(', '.join(COUNT_MODES)))
+
+        if count == 'estimate' and self.db.bind.dialect.name == 'postgresql':
+            estimate = self.db.execute(text(
+                "SELECT reltuples::bigint FROM pg_class "
+                "WHERE oid = 'orders'::regclass"
+            )).scalar()
+            if estimate is not None and estimate >= 0:
+                return estimate
+
+        if count == 'cached':
+            cls = type(self)
+            if time.monotonic() < cls._cached_total_orders_expires_at:
+                return cls._cached_total_orders
+            cls._cached_total_orders = self.db.query(Order).count()
+            cls._cached_total_orders_expires_at = (
+                time.monotonic() + float(config.get(ORDERS_COUNT_TTL_KEY, 60)))
+            return cls._cached_total_orders
+
+        return self.db.query(Order).count()
+
+    def _format_cursor(self, order):
+        key = '{}|{}'.format(order.created_at.isoformat(), order.id)
+        return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+    def _parse_cursor(self, cursor):
+        try:
+            key = base64.urlsafe_b64decode(
+                cursor.encode('ascii')).decode('utf-8')
+            created_at, order_id = key.rsplit('|', 1)
+            return datetime.datetime.fromisoformat(created_at), int(order_id)
+        except (binascii.Error, UnicodeError, ValueError):
+            raise InvalidCursor('Cursor {} is not valid'.format(cursor))
 
     @rpc
-    def list_orders(self, page=1, per_page=10):
+    @read_only
+    def list_orders(
+        self, page=1, per_page=10, count='exact', after=None, before=None,
+        summary=False
+    ):
+        """ List orders, oldest first.
+
+        Pages are selected either by `page` or, when given, by the
+        `next_cursor` (as `after`) or `prev_cursor` (as `before`) of a
+        previous page. Cursors seek on the (created_at, id) index, so they
+        cost the same however deep into the list the page is.
+
+        With `summary`, orders are listed with their totals but without
+        their details, which are then not read at all.
+        """
+        if after and before:
+            raise ValueError('Only one of after and before can be given')
+
+        total_orders = self._count_orders(count)
+
         orders_query = self.db.query(Order)
+        if not summary:
+            # load the details of the whole page in one extra query rather
+            # than lazily, one query per order
+            orders_query = orders_query.options(
+                selectinload(Order.order_details))
+        key = tuple_(Order.created_at, Order.id)
+
+        if after:
+            orders_query = (
+                orders_query
+                .filter(key > tuple_(*self._parse_cursor(after)))
+                .order_by(Order.created_at, Order.id)
+            )
+        elif before:
+            orders_query = (
+                orders_query
+                .filter(key < tuple_(*self._parse_cursor(before)))
+                .order_by(Order.created_at.desc(), Order.id.desc())
+            )
+        else:
+            orders_query = (
+                orders_query
+                .order_by(Order.created_at, Order.id)
+                .offset((page - 1) * per_page)
+            )
+
+        orders = orders_query.limit(per_page).all()
+        if before:
+            orders.reverse()
 
-        total_orders = orders_query.count()
-        orders_query = orders_query.offset((page - 1) * per_page).limit(per_page)
+        # a full page may be followed by more orders, and a page reached by
+        # going backwards is always followed by the one it was reached from
+        has_next = len(orders) == per_page or bool(before)
+        has_prev = (
+            len(orders) == per_page if before else bool(after) or page > 1)
 
-        orders = orders_query.all()
-        orders_data = OrderSchema(many=True).dump(orders).data
+        serialize = serialize_order_summary if summary else serialize_order
+        orders_data = [serialize(order) for order in orders]
 
         return {
             'orders': orders_data,
             'page': page,
             'per_page': per_page,
             'total_orders': total_orders,
+            'next_cursor': (
+                self._format_cursor(orders[-1])
+                if orders and has_next else None
+            ),
+            'prev_cursor': (
+                self._format_cursor(orders[0])
+                if orders and has_prev else None
+            ),
         }
 
     @rpc
-    def create_order(self, order_details):
-        order = Order(
+    @read_only
+    def export_orders(self, after=None, limit=1000):
+        """ Return up to `limit` orders, with their details, by id, and the
+        `next_cursor` to pass as `after` for the following ones, which is
+        None after the last order.
+
+        Chunks seek on the primary key, so exporting all the orders chunk by
+        chunk is linear however many there are, and rows are read off a
+        server-side cursor `EXPORT_YIELD_PER` at a time.
+        """
+        orders_query = (
+            self.db.query(Order)
+            .options(selectinload(Order.order_details))
+            .order_by(Order.id)
+        )
+        if after is not None:
+            orders_query = orders_query.filter(Order.id > after)
+
+        orders = [
+            serialize_order(order) for order in
+            orders_query.limit(limit).yield_per(EXPORT_YIELD_PER)
+        ]
+        return {
+            'orders': orders,
+            'next_cursor': orders[-1]['id'] if len(orders) == limit else None,
+        }
+
+    def _build_order(self, order_details):
+        total_amount = sum(
+            Decimal(str(order_detail['price'])) * order_detail['quantity']
+            for order_detail in order_details
+        )
+        return Order(
+            total_amount=Decimal(total_amount).quantize(CENTS),
+            line_count=len(order_details),
             order_details=[
                 OrderDetail(
                     product_id=order_detail['product_id'],
@@ -64,37 +246,150 @@ class OrdersService(OrderServiceMixin, OrderDetailServiceMixin):
                 for order_detail in order_details
             ]
         )
+
+    def _add_event(self, event_type, event_data):
+        """ Write an event to the outbox, to be dispatched by the
+        `outbox_relay` once the current transaction committed.
+        """
+        self.db.add(OutboxEvent(
+            event_type=event_type, payload=json.dumps(event_data)))
+
+    @rpc
+    def create_order(self, order_details, stock_reserved=False):
+        """ Create an order from `order_details`.
+
+        Callers that already took the order's stock off the products, with
+        `products.reserve_stock`, pass `stock_reserved` so that the
+        `order_created` event tells the products service not to take it
+        again.
+        """
+        order = self._build_order(order_details)
         self.db.add(order)
-        self.db.commit()
+        self.db.flush()
 
-        order = OrderSchema().dump(order).data
+        order = serialize_order(order)
 
-        self.event_dispatcher('order_created', {
-            'order': order,
-        })
+        event_data = {'order': order}
+        if stock_reserved:
+            event_data['stock_reserved'] = True
+        self._add_event('order_created', event_data)
+        self.db.commit()
+        self.outbox_relay.wake()
 
         return order
 
     @rpc
-    def update_order(self, order):
-        order_details = {
-            order_details['id']: order_details
-            for order_details in order['order_details']
-        }
+    def create_orders(self, orders):
+        """ Create many orders, each given as `{'order_details': [...]}`, in
+        a single transaction.
+
+        The inserts are flushed together, which SQLAlchemy sends as batched
+        multi-row statements, and the orders are serialized before the
+        commit expires them, so that no order is loaded back one by one.
+        Dispatches, through the outbox, a single `orders_created` event for
+        the whole batch and returns the new orders in the order they were given.
+        """
+        new_orders = [
+            self._build_order(order['order_details']) for order in orders
+        ]
+        self.db.add_all(new_orders)
+        self.db.flush()
+        orders = [serialize_order(order) for order in new_orders]
+
+        self._add_event('orders_created', {
+            'orders': orders,
+        })
+        self.db.commit()
+        self.outbox_relay.wake()
+
+        return orders
+
+    def _update_order_details(self, order_id, order_details):
+        """ Set the price and quantity of `order_details` of order
+        `order_id` in a single statement, however many there are.
+        """
+        if not order_details:
+            return
 
-        order = self._get_order(order['id'])
+        if self.db.bind.dialect.name == 'postgresql':
+            new_details = values(
+                column('id', Integer),
+                column('price', DECIMAL(18, 2)),
+                column('quantity', Integer),
+                name='new_details'
+            ).data([
+                (
+                    order_detail['id'],
+                    Decimal(str(order_detail['price'])),
+                    order_detail['quantity']
+                )
+                for order_detail in order_details
+            ])
+            self.db.execute(
+                update(OrderDetail.__table__)
+                .where(OrderDetail.id == new_details.c.id)
+                .where(OrderDetail.order_id == order_id)
+                .values(
+                    price=new_details.c.price,
+                    quantity=new_details.c.quantity
+                )
+            )
+        else:
+            # no UPDATE ... FROM (VALUES ...), fall back to an executemany
+            self.db.execute(
+                update(OrderDetail.__table__)
+                .where(OrderDetail.id == bindparam('detail_id'))
+                .where(OrderDetail.order_id == order_id)
+                .values(
+                    price=bindparam('price'),
+                    quantity=bindparam('quantity')
+                ),
+                [
+                    {
+                        'detail_id': order_detail['id'],
+                        'price': Decimal(str(order_detail['price'])),
+                        'quantity': order_detail['quantity'],
+                    }
+                    for order_detail in order_details
+                ]
+            )
 
-        for order_detail in order.order_details:
-            order_detail.price = order_details[order_detail.id]['price']
-            order_detail.quantity = order_details[order_detail.id]['quantity']
+    def _update_order_totals(self, order_id):
+        """ Recompute the totals of order `order_id` from its details """
+        details = OrderDetail.__table__
+        self.db.execute(
+            update(Order.__table__)
+            .where(Order.id == order_id)
+            .values(
+                total_amount=select(
+                    func.coalesce(
+                        func.sum(details.c.price * details.c.quantity), 0)
+                ).where(details.c.order_id == order_id).scalar_subquery(),
+                line_count=select(
+                    func.count()
+                ).where(details.c.order_id == order_id).scalar_subquery(),
+            )
+        )
+
+    @rpc
+    def update_order(self, order):
+        self._update_order_details(order['id'], order['order_details'])
+        self._update_order_totals(order['id'])
+        order = serialize_order(self._load_order(order['id']))
 
         self.db.commit()
-        return OrderSchema().dump(order).data
+        self.order_cache.invalidate(order['id'])
+        return order
 
     @rpc
     def delete_order(self, order_id):
-        order = self._get_order(order_id)
-        for order_detail in order.order_details:
-            self.db.delete(order_detail)
-        self.db.delete(order)
-        self.db.commit()
\ No newline at end of file
+        # the order details go with it, through ON DELETE CASCADE
+        deleted = (
+            self.db.query(Order)
+            .filter(Order.id == order_id)
+            .delete(synchronize_session=False)
+        )
+        if not deleted:
+            raise NotFound(f"Order with id {order_id} not found")
+        self.db.commit()
+        self.order_cache.invalidate(order_id)
@@ -7,6 +7,7 @@ setup(
     description='Store and serve orders',
     packages=find_packages(exclude=['test', 'test.*']),
     install_requires=[
+        'nameko-examples-common==0.0.1',
         'nameko==v3.0.0-rc6',
         'nameko-sqlalchemy==1.5.0',
         'alembic==1.0.10',
@@ -14,10 +15,14 @@ setup(
         'psycopg2-binary==2.8.2',
     ],
     extras_require={
+        'redis': [
+            'redis==3.2.1',
+        ],
         'dev': [
             'pytest==4.5.0',
             'coverage==4.5.3',
             'flake8==3.7.7',
+            'redis==3.2.1',
         ],
     },
     zip_safe=True
@@ -1,4 +1,8 @@
+import sqlite3
+
 import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 from orders.models import DeclarativeBase
 
@@ -21,3 +25,16 @@ def db_url():
 def model_base():
     """Overriding model_base fixture from `nameko_sqlalchemy`"""
     return DeclarativeBase
+
+
+@pytest.fixture(scope='session', autouse=True)
+def sqlite_foreign_keys():
+    """ SQLite only enforces foreign keys, and with them ON DELETE CASCADE,
+    when asked to on every connection, unlike Postgres """
+    def connect(dbapi_connection, connection_record):
+        if isinstance(dbapi_connection, sqlite3.Connection):
+            dbapi_connection.execute('PRAGMA foreign_keys=ON')
+
+    event.listen(Engine, 'connect', connect)
+    yield
+    event.remove(Engine, 'connect', connect)
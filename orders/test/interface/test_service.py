@@ -1,9 +1,19 @@
+import json
+import time
+import uuid
+
+import eventlet
 import pytest
 
-from mock import call
+from mock import ANY, call, patch
+from nameko import config
 from nameko.exceptions import RemoteError
+from nameko.standalone.rpc import ServiceRpcProxy
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
 
-from orders.models import Order, OrderDetail
+from orders.models import DeclarativeBase, Order, OrderDetail, OutboxEvent
 from orders.schemas import OrderSchema, OrderDetailSchema
 
 
@@ -41,8 +51,18 @@ def test_will_raise_when_order_not_found(orders_rpc):
     assert err.value.value == 'Order with id 1 not found'
 
 
-@pytest.mark.usefixtures('db_session')
-def test_can_create_order(orders_service, orders_rpc):
+@pytest.fixture
+def outbox(db_session):
+    """ Returns the pending outbox events """
+    def events():
+        return [
+            (event.event_type, json.loads(event.payload))
+            for event in db_session.query(OutboxEvent).order_by(OutboxEvent.id)
+        ]
+    return events
+
+
+def test_can_create_order(orders_service, orders_rpc, outbox):
     order_details = [
         {
             'product_id': "the_odyssey",
@@ -60,9 +80,11 @@ def test_can_create_order(orders_service, orders_rpc):
     )
     assert new_order['id'] > 0
     assert len(new_order['order_details']) == len(order_details)
-    assert [call(
+    assert [(
         'order_created', {'order': {
             'id': 1,
+            'total_amount': '147.91',
+            'line_count': 2,
             'order_details': [
                 {
                     'price': '99.99',
@@ -77,7 +99,19 @@ def test_can_create_order(orders_service, orders_rpc):
                     'quantity': 8
                 }
             ]}}
-    )] == orders_service.event_dispatcher.call_args_list
+    )] == outbox()
+    assert orders_service.outbox_relay.wake.called
+
+
+def test_create_order_flags_reserved_stock(orders_service, orders_rpc, outbox):
+    new_order = orders_rpc.create_order(
+        [{'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1}],
+        stock_reserved=True
+    )
+
+    assert [(
+        'order_created', {'order': new_order, 'stock_reserved': True}
+    )] == outbox()
 
 
 @pytest.mark.usefixtures('db_session', 'order_details')
@@ -94,3 +128,431 @@ def test_can_update_order(orders_rpc, order):
 def test_can_delete_order(orders_rpc, order, db_session):
     orders_rpc.delete_order(order.id)
     assert not db_session.query(Order).filter_by(id=order.id).count()
+
+
+@pytest.fixture
+def orders(db_session):
+    orders = [
+        Order(order_details=[
+            OrderDetail(
+                product_id="the_odyssey", price=99.51, quantity=index + 1),
+            OrderDetail(
+                product_id="the_enigma", price=30.99, quantity=index + 2),
+        ])
+        for index in range(3)
+    ]
+    db_session.add_all(orders)
+    db_session.commit()
+    return orders
+
+
+@pytest.fixture
+def statements():
+    """ Records the SQL statements executed while the fixture is active """
+    executed = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        executed.append(statement)
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    yield executed
+    event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def test_can_list_orders(orders_rpc, orders):
+    response = orders_rpc.list_orders(page=1, per_page=2)
+
+    assert [order.id for order in orders[:2]] == [
+        order['id'] for order in response['orders']]
+    assert [2, 2] == [
+        len(order['order_details']) for order in response['orders']]
+    assert 1 == response['page']
+    assert 2 == response['per_page']
+    assert 3 == response['total_orders']
+
+
+def test_list_orders_loads_details_in_one_query(
+    orders_rpc, orders, statements
+):
+    orders_rpc.list_orders(page=1, per_page=3)
+
+    # count, orders page and order details
+    assert 3 == len(statements)
+
+
+@pytest.mark.parametrize('count', ['exact', 'estimate', 'cached'])
+def test_list_orders_count_modes(orders_rpc, orders, count):
+    response = orders_rpc.list_orders(count=count)
+
+    assert 3 == response['total_orders']
+
+
+@pytest.mark.usefixtures('db_session')
+def test_list_orders_fails_on_unknown_count_mode(orders_rpc):
+    with pytest.raises(RemoteError) as err:
+        orders_rpc.list_orders(count='precise')
+    assert err.value.exc_type == 'ValueError'
+
+
+def test_can_list_orders_after_cursor(orders_rpc, orders):
+    first_page = orders_rpc.list_orders(per_page=2)
+    assert first_page['prev_cursor'] is None
+
+    response = orders_rpc.list_orders(
+        per_page=2, after=first_page['next_cursor'])
+
+    assert [orders[2].id] == [order['id'] for order in response['orders']]
+    assert response['next_cursor'] is None
+    assert response['prev_cursor'] is not None
+    assert 3 == response['total_orders']
+
+
+def test_can_list_orders_before_cursor(orders_rpc, orders):
+    last_page = orders_rpc.list_orders(
+        per_page=1, after=orders_rpc.list_orders(per_page=2)['next_cursor'])
+
+    response = orders_rpc.list_orders(
+        per_page=2, before=last_page['prev_cursor'])
+
+    assert [order.id for order in orders[:2]] == [
+        order['id'] for order in response['orders']]
+    assert response['next_cursor'] is not None
+
+
+def test_can_export_orders_in_chunks(orders_rpc, orders):
+    first_chunk = orders_rpc.export_orders(limit=2)
+    last_chunk = orders_rpc.export_orders(
+        after=first_chunk['next_cursor'], limit=2)
+
+    assert [order.id for order in orders] == [
+        order['id']
+        for order in first_chunk['orders'] + last_chunk['orders']
+    ]
+    assert 2 == len(first_chunk['orders'][0]['order_details'])
+    assert last_chunk['next_cursor'] is None
+
+
+@pytest.mark.usefixtures('db_session')
+def test_export_orders_when_empty(orders_rpc):
+    assert {'orders': [], 'next_cursor': None} == orders_rpc.export_orders()
+
+
+@pytest.mark.usefixtures('db_session')
+def test_list_orders_fails_on_invalid_cursor(orders_rpc):
+    with pytest.raises(RemoteError) as err:
+        orders_rpc.list_orders(after='not-a-cursor')
+    assert err.value.exc_type == 'InvalidCursor'
+
+
+def test_get_order_is_cached(orders_rpc, order, statements):
+    orders_rpc.get_order(order.id)
+    del statements[:]
+
+    response = orders_rpc.get_order(order.id)
+
+    assert response['id'] == order.id
+    assert [] == statements
+
+
+@pytest.mark.usefixtures('db_session', 'order_details')
+def test_update_order_invalidates_cached_order(orders_rpc, order):
+    order_payload = orders_rpc.get_order(order.id)
+    for order_detail in order_payload['order_details']:
+        order_detail['quantity'] += 1
+
+    updated_order = orders_rpc.update_order(order_payload)
+
+    assert orders_rpc.get_order(order.id) == updated_order
+    assert (
+        updated_order['order_details'] == order_payload['order_details'])
+
+
+def test_delete_order_invalidates_cached_order(orders_rpc, order):
+    orders_rpc.get_order(order.id)
+
+    orders_rpc.delete_order(order.id)
+
+    with pytest.raises(RemoteError) as err:
+        orders_rpc.get_order(order.id)
+    assert err.value.exc_type == 'NotFound'
+
+
+def test_can_create_orders(orders_service, orders_rpc, outbox, statements):
+    orders = [
+        {'order_details': [
+            {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1},
+        ]},
+        {'order_details': [
+            {'product_id': "the_enigma", 'price': '5.99', 'quantity': 8},
+            {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 2},
+        ]},
+    ]
+
+    new_orders = orders_rpc.create_orders(orders)
+
+    assert [1, 2] == [order['id'] for order in new_orders]
+    assert [1, 2] == [len(order['order_details']) for order in new_orders]
+    # the orders and their details are not loaded back after the commit
+    assert not [
+        statement for statement in statements
+        if statement.startswith('SELECT')
+    ]
+    assert [('orders_created', {'orders': new_orders})] == outbox()
+
+
+@pytest.fixture
+def large_order(db_session):
+    order = Order(order_details=[
+        OrderDetail(product_id="the_odyssey", price=99.51, quantity=index)
+        for index in range(1, 51)
+    ])
+    db_session.add(order)
+    db_session.commit()
+    return order
+
+
+def test_update_order_takes_constant_statements(
+    orders_rpc, large_order, statements
+):
+    order_payload = OrderSchema().dump(large_order).data
+    for order_detail in order_payload['order_details']:
+        order_detail['quantity'] += 1
+        order_detail['price'] = '10.50'
+    del statements[:]
+
+    updated_order = orders_rpc.update_order(order_payload)
+
+    assert updated_order['order_details'] == order_payload['order_details']
+    assert '13912.50' == updated_order['total_amount']
+    # details update, totals update, order and order details
+    assert 4 == len(statements)
+
+
+def test_delete_order_cascades_to_details(
+    orders_rpc, large_order, db_session, statements
+):
+    order_id = large_order.id
+    del statements[:]
+
+    orders_rpc.delete_order(order_id)
+
+    assert 1 == len(statements)
+    assert not db_session.query(OrderDetail).filter_by(
+        order_id=order_id).count()
+
+
+@pytest.mark.usefixtures('db_session')
+def test_delete_order_fails_when_order_not_found(orders_rpc):
+    with pytest.raises(RemoteError) as err:
+        orders_rpc.delete_order(1)
+    assert err.value.exc_type == 'NotFound'
+
+
+@pytest.mark.usefixtures('db_session')
+def test_created_order_has_totals(orders_rpc):
+    new_order = orders_rpc.create_order([
+        {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 3},
+        {'product_id': "the_enigma", 'price': '5.99', 'quantity': 1},
+    ])
+
+    assert '305.96' == new_order['total_amount']
+    assert 2 == new_order['line_count']
+
+
+@pytest.mark.usefixtures('db_session')
+def test_can_list_order_summaries(orders_rpc, statements):
+    orders_rpc.create_orders([
+        {'order_details': [
+            {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 2},
+        ]},
+        {'order_details': [
+            {'product_id': "the_enigma", 'price': '5.99', 'quantity': 1},
+            {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1},
+        ]},
+    ])
+    del statements[:]
+
+    response = orders_rpc.list_orders(summary=True)
+
+    assert [
+        {'id': 1, 'total_amount': '199.98', 'line_count': 1},
+        {'id': 2, 'total_amount': '105.98', 'line_count': 2},
+    ] == response['orders']
+    # count and orders page, no order details
+    assert 2 == len(statements)
+
+
+def test_db_pool_stats(orders_rpc, order):
+    orders_rpc.get_order(order.id)
+
+    stats = orders_rpc.db_pool_stats()
+
+    assert stats['checkouts'] >= 1
+    assert 0 == stats['checkout_timeouts']
+
+
+@pytest.fixture
+def replica_url(tmp_path):
+    """ A second SQLite database standing in for a read replica """
+    return 'sqlite:///{}'.format(tmp_path / 'replica.sql')
+
+
+@pytest.fixture
+def replica_session(replica_url):
+    engine = create_engine(replica_url)
+    DeclarativeBase.metadata.create_all(engine)
+    session = Session(bind=engine)
+    yield session
+    session.close()
+    engine.dispose()
+
+
+@pytest.fixture
+def create_replicated_orders_rpc(create_service_meta):
+    def create(replica_url, context_data=None):
+        with config.patch({
+            'DB_REPLICA_URIS': replica_url, 'ORDER_CACHE_TTL': 0,
+            'DB_REPLICA_STICKY_SECONDS': 60,
+        }):
+            create_service_meta('outbox_relay')
+        return ServiceRpcProxy('orders', context_data=context_data)
+    return create
+
+
+@pytest.mark.usefixtures('db_session')
+def test_reads_are_served_from_replica(
+    create_replicated_orders_rpc, replica_url, replica_session
+):
+    replica_session.add(Order(order_details=[
+        OrderDetail(product_id="the_odyssey", price=99.51, quantity=1),
+    ]))
+    replica_session.commit()
+
+    with create_replicated_orders_rpc(replica_url) as orders_rpc:
+        assert 1 == orders_rpc.list_orders()['total_orders']
+        assert 1 == len(list(orders_rpc.export_orders()['orders']))
+
+
+@pytest.mark.usefixtures('db_session')
+def test_orders_are_cached_from_primary(
+    create_replicated_orders_rpc, replica_url, replica_session
+):
+    # the replica lags behind: the order is not there yet
+    with create_replicated_orders_rpc(replica_url) as orders_rpc:
+        new_order = orders_rpc.create_order([
+            {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1},
+        ])
+
+        assert new_order == orders_rpc.get_order(new_order['id'])
+
+
+@pytest.mark.usefixtures('db_session')
+def test_reads_stick_to_primary_after_callers_write(
+    create_replicated_orders_rpc, replica_url, replica_session
+):
+    with create_replicated_orders_rpc(
+        replica_url, context_data={'last_write_at': time.time()}
+    ) as orders_rpc:
+        orders_rpc.create_order([
+            {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1},
+        ])
+
+        assert 1 == orders_rpc.list_orders()['total_orders']
+
+
+@pytest.mark.usefixtures('db_session')
+def test_reads_of_other_callers_do_not_stick_to_primary(
+    create_replicated_orders_rpc, replica_url, replica_session
+):
+    with create_replicated_orders_rpc(replica_url) as orders_rpc:
+        orders_rpc.create_order([
+            {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1},
+        ])
+
+        assert 0 == orders_rpc.list_orders()['total_orders']
+
+    # nor do callers that wrote long ago, or claim to write in the future
+    for last_write_at in (time.time() - 3600, time.time() + 3600):
+        with create_replicated_orders_rpc(
+            replica_url, context_data={'last_write_at': last_write_at}
+        ) as orders_rpc:
+            assert 0 == orders_rpc.list_orders()['total_orders']
+
+
+def test_reads_fall_back_to_primary(create_replicated_orders_rpc, order):
+    unreachable_url = 'sqlite:////nonexistent/replica.sql'
+
+    with create_replicated_orders_rpc(unreachable_url) as orders_rpc:
+        assert order.id == orders_rpc.get_order(order.id)['id']
+
+
+@pytest.fixture
+def dispatch():
+    with patch('orders.dependencies.event_dispatcher') as event_dispatcher:
+        yield event_dispatcher.return_value
+
+
+@pytest.fixture
+def relaying_orders_rpc(create_service_meta, dispatch):
+    """ Orders service with its outbox relay running """
+    with config.patch({'OUTBOX_POLL_INTERVAL': 60, 'OUTBOX_RETRY_DELAY': 0}):
+        create_service_meta()
+    with ServiceRpcProxy('orders') as proxy:
+        yield proxy
+
+
+def wait_for(condition):
+    with eventlet.Timeout(5):
+        while not condition():
+            eventlet.sleep(0.01)
+
+
+@pytest.mark.usefixtures('db_session')
+def test_outbox_relay_dispatches_and_deletes_events(
+    relaying_orders_rpc, dispatch, outbox
+):
+    new_order = relaying_orders_rpc.create_order([
+        {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1},
+    ])
+
+    wait_for(lambda: not outbox())
+    assert [
+        call('orders', 'order_created', {'order': new_order, 'event_id': ANY})
+    ] == dispatch.call_args_list
+    event_id = dispatch.call_args[0][2]['event_id']
+    assert str(uuid.UUID(event_id)) == event_id
+
+
+@pytest.mark.usefixtures('db_session')
+def test_outbox_relay_never_reuses_event_ids(
+    relaying_orders_rpc, dispatch, outbox
+):
+    # the rows of relayed events are deleted, so their ids may be reused
+    for _ in range(2):
+        relaying_orders_rpc.create_order([
+            {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1},
+        ])
+        wait_for(lambda: not outbox())
+
+    first, second = dispatch.call_args_list
+    assert first[0][2]['event_id'] != second[0][2]['event_id']
+
+
+@pytest.mark.usefixtures('db_session')
+def test_outbox_relay_retries_failed_dispatches(
+    relaying_orders_rpc, dispatch, outbox
+):
+    dispatch.side_effect = [ConnectionError('broker down'), None]
+
+    new_order = relaying_orders_rpc.create_order([
+        {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1},
+    ])
+
+    wait_for(lambda: not outbox())
+    # with the same id, for the redelivery to be recognised
+    assert [
+        call('orders', 'order_created', {'order': new_order, 'event_id': ANY}),
+        call('orders', 'order_created', {'order': new_order, 'event_id': ANY}),
+    ] == dispatch.call_args_list
+    first, second = dispatch.call_args_list
+    assert first[0][2]['event_id'] == second[0][2]['event_id']
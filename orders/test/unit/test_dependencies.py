@@ -0,0 +1,157 @@
+import json
+
+import pytest
+import redis
+from mock import Mock
+from nameko import config
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import NullPool
+
+from nameko_examples_common.cache import TTLCache
+from orders.dependencies import (
+    OrderCacheWrapper, PooledDatabaseSession, TimedQueuePool
+)
+from orders.models import DeclarativeBase
+
+
+@pytest.fixture
+def client():
+    client = Mock()
+    client.get.return_value = None
+    return client
+
+
+@pytest.fixture
+def order_cache(client):
+    return OrderCacheWrapper(
+        TTLCache(maxsize=10, ttl=10), client, client_ttl=60)
+
+
+def test_miss_loads_and_fills_both_tiers(order_cache, client):
+    load = Mock(return_value={'id': 1, 'order_details': []})
+
+    assert {'id': 1, 'order_details': []} == order_cache.get(1, load)
+    assert {'id': 1, 'order_details': []} == order_cache.get(1, load)
+
+    assert 1 == load.call_count
+    client.set.assert_called_once_with(
+        'orders:order:1', json.dumps({'id': 1, 'order_details': []}), ex=60)
+
+
+def test_shared_hit_skips_load(order_cache, client):
+    client.get.return_value = json.dumps({'id': 1, 'order_details': []})
+    load = Mock()
+
+    assert {'id': 1, 'order_details': []} == order_cache.get(1, load)
+    assert not load.called
+
+
+def test_shared_tier_errors_fall_back_to_load(order_cache, client):
+    client.get.side_effect = redis.ConnectionError
+    client.set.side_effect = redis.ConnectionError
+    load = Mock(return_value={'id': 1, 'order_details': []})
+
+    assert {'id': 1, 'order_details': []} == order_cache.get(1, load)
+    assert load.called
+
+
+def test_invalidate_clears_both_tiers(order_cache, client):
+    load = Mock(return_value={'id': 1, 'order_details': []})
+    order_cache.get(1, load)
+
+    order_cache.invalidate(1)
+    order_cache.get(1, load)
+
+    client.delete.assert_called_once_with('orders:order:1')
+    assert 2 == load.call_count
+
+
+def test_order_invalidated_while_loading_is_not_cached(order_cache, client):
+
+    def load():
+        order_cache.invalidate(1)
+        return {'id': 1, 'order_details': []}
+
+    order_cache.get(1, load)
+
+    assert not client.set.called
+    assert 0 == order_cache.stats()['size']
+
+
+def test_local_only_without_client():
+    order_cache = OrderCacheWrapper(TTLCache(maxsize=10, ttl=10))
+    load = Mock(return_value={'id': 1, 'order_details': []})
+
+    order_cache.get(1, load)
+    order_cache.get(1, load)
+    order_cache.invalidate(1)
+
+    assert 1 == load.call_count
+    assert 0 == order_cache.stats()['size']
+
+
+@pytest.fixture
+def pooled_session(db_url):
+    def create():
+        session = PooledDatabaseSession(DeclarativeBase)
+        session.container = Mock(
+            service_name='orders',
+            config={'DB_URIS': {'orders:Base': db_url}})
+        session.setup()
+        return session
+    return create
+
+
+def test_pool_is_configured_from_config(pooled_session):
+    with config.patch({
+        'max_workers': 4, 'DB_MAX_OVERFLOW': 2, 'DB_POOL_TIMEOUT': 3
+    }):
+        session = pooled_session()
+
+    pool = session.engine.pool
+    assert isinstance(pool, TimedQueuePool)
+    assert 4 == pool.size()
+    assert 2 == pool._max_overflow
+    assert 3 == pool._timeout
+    assert pool._pre_ping
+
+
+def test_pool_size_overrides_max_workers(pooled_session):
+    with config.patch({'max_workers': 4, 'DB_POOL_SIZE': 8}):
+        session = pooled_session()
+
+    assert 8 == session.engine.pool.size()
+
+
+def test_pgbouncer_mode_does_not_pool(pooled_session):
+    with config.patch({'DB_PGBOUNCER': True}):
+        session = pooled_session()
+
+    assert isinstance(session.engine.pool, NullPool)
+
+
+def test_pool_times_checkouts(pooled_session):
+    pool = pooled_session().engine.pool
+
+    pool.connect().close()
+    pool.connect().close()
+
+    stats = pool.stats()
+    assert 2 == stats['checkouts']
+    assert 0 == stats['checked_out']
+    assert 0 == stats['checkout_timeouts']
+    assert stats['checkout_wait_max'] >= stats['checkout_wait_avg'] >= 0
+
+
+def test_pool_counts_checkout_timeouts(pooled_session):
+    with config.patch({
+        'DB_POOL_SIZE': 1, 'DB_MAX_OVERFLOW': 0, 'DB_POOL_TIMEOUT': 0.01
+    }):
+        pool = pooled_session().engine.pool
+
+    connection = pool.connect()
+    with pytest.raises(PoolTimeout):
+        pool.connect()
+    connection.close()
+
+    assert 1 == pool.stats()['checkout_timeouts']
@@ -0,0 +1,56 @@
+import json
+from decimal import Decimal
+
+import pytest
+
+from orders.models import Order, OrderDetail
+from orders.schemas import OrderSchema
+from orders.serializers import serialize_order, serialize_order_summary
+
+
+@pytest.fixture
+def order():
+    return Order(
+        id=1,
+        total_amount=Decimal('1042.50'),
+        line_count=2,
+        order_details=[
+            OrderDetail(
+                id=1, product_id='the_odyssey', price=Decimal('99.51'),
+                quantity=5),
+            OrderDetail(
+                id=2, product_id='the_enigma', price=Decimal('5.00'),
+                quantity=109),
+        ]
+    )
+
+
+def test_serialize_order_matches_schema(order):
+    assert json.dumps(serialize_order(order)) == json.dumps(
+        OrderSchema().dump(order).data)
+
+
+def test_serialize_order_summary_matches_schema(order):
+    assert json.dumps(serialize_order_summary(order)) == json.dumps(
+        OrderSchema(exclude=('order_details',)).dump(order).data)
+    assert 'order_details' not in serialize_order_summary(order)
+
+
+def test_serialize_dict_matches_schema():
+    order = {
+        'id': '1',
+        'order_details': [
+            {'id': 1, 'product_id': 'the_odyssey', 'price': '99.51',
+             'quantity': 5},
+        ]
+    }
+    assert json.dumps(serialize_order(order)) == json.dumps(
+        OrderSchema().dump(order).data)
+
+
+def test_serialize_none_values_matches_schema():
+    order = Order(id=1, total_amount=None, line_count=None, order_details=[])
+
+    assert json.dumps(serialize_order(order)) == json.dumps(
+        OrderSchema().dump(order).data)
+
@@ -1,13 +1,84 @@
-import re
+import base64
+import binascii
+import bisect
+import json
+import logging
+import time
+from collections import Counter
+
 from nameko import config
-from functools import lru_cache
 from nameko.extensions import DependencyProvider
 import redis
 
-from products.exceptions import NotFound, Conflict
+from nameko_examples_common.cache import TTLCache
+from products.exceptions import NotFound, Conflict, InvalidCursor, OutOfStock
 
 
 REDIS_URI_KEY = 'REDIS_URI'
+PRODUCT_CACHE_SIZE_KEY = 'PRODUCT_CACHE_SIZE'
+PRODUCT_CACHE_TTL_KEY = 'PRODUCT_CACHE_TTL'
+
+# Titles are indexed by every lowercase substring up to this length, so a
+# filter term of up to `TITLE_INDEX_NGRAM` characters is a single set lookup
+# and longer terms intersect their n-gram sets before a final substring check.
+TITLE_INDEX_NGRAM = 3
+TITLE_INDEX_KEY = 'product_index:title:{}'
+TITLES_KEY = 'product_index:titles'
+
+# Every product id is a member of this sorted set with the same score, so the
+# members are kept in lexicographical order and can be paged with ZRANGE and
+# ZRANGEBYLEX in O(log N) no matter how deep the page is.
+CATALOGUE_KEY = 'product_index:catalogue'
+
+# Set once the indexes have been built from the stored products, which the
+# first instance to start does for products written before they existed.
+INDEXED_KEY = 'product_index:indexed'
+
+# Writes publish the ids of the products they touched on this channel, so
+# that every products instance evicts them from its local cache.
+INVALIDATION_CHANNEL = 'products:invalidations'
+INVALIDATION_RECONNECT_DELAY = 1
+
+# Incremented by every write, so that clients can tell whether anything in
+# the catalogue changed from a single GET.
+CATALOGUE_VERSION_KEY = 'product_index:version'
+
+# Set once the stock of an event of the orders service, by its `event_id`,
+# was taken, so that a redelivery of the event is skipped. Redeliveries come
+# within minutes, the marks are kept for a day.
+APPLIED_EVENT_KEY = 'product_events:orders:{}'
+APPLIED_EVENT_TTL = 24 * 60 * 60
+
+# Takes `ARGV[i]` off the stock of product hash `KEYS[i]` for every i, but
+# only when all of them exist and have enough stock, so that a reservation
+# either goes through as a whole or leaves every stock untouched. Scripts
+# run atomically, so no other write can get in between the check and the
+# decrement. On success the catalogue version, the last of KEYS, is
+# incremented and the invalidation message, the last two ARGV, published.
+RESERVE_STOCK_SCRIPT = """
+local count = #KEYS - 1
+for i = 1, count do
+    if not (tonumber(ARGV[i]) and tonumber(ARGV[i]) > 0) then
+        return {'INVALID_QUANTITY', i}
+    end
+    local in_stock = redis.call('HGET', KEYS[i], 'in_stock')
+    if not in_stock then
+        return {'NOT_FOUND', i}
+    end
+    if tonumber(in_stock) < tonumber(ARGV[i]) then
+        return {'OUT_OF_STOCK', i}
+    end
+end
+local stocks = {}
+for i = 1, count do
+    stocks[i] = redis.call('HINCRBY', KEYS[i], 'in_stock', -ARGV[i])
+end
+redis.call('INCR', KEYS[count + 1])
+redis.call('PUBLISH', ARGV[count + 1], ARGV[count + 2])
+return {'OK', stocks}
+"""
+
+logger = logging.getLogger(__name__)
 
 
 class StorageWrapper:
@@ -16,8 +87,15 @@ class StorageWrapper:
 
     A very simple example of a custom Nameko dependency. Simplified
     implementation of products database based on Redis key value store.
-    Handling the product ID increments or keeping sorted sets of product
-    names for ordering the products is out of the scope of this example.
+    Product ids are kept in a sorted set ordered by id, which gives a stable
+    listing order, and product titles in an n-gram index so that listing
+    with a title filter only touches the matching products. Handling the
+    product ID increments is out of the scope of this example.
+
+    Product reads go through a process-wide `TTLCache` shared by all
+    workers; every write invalidates the products it touches, both locally
+    and, through `INVALIDATION_CHANNEL`, in every other instance, and bumps
+    the catalogue version.
 
     """
 
@@ -26,12 +104,92 @@ class StorageWrapper:
     def _product_not_found(self, product_id):
         raise self.NotFound('Product ID {} does not exist'.format(product_id))
 
-    def __init__(self, client):
+    def _invalid_quantity(self, product_id, quantity):
+        raise ValueError('Invalid quantity {} for product ID {}'.format(
+            quantity, product_id))
+
+    def __init__(self, client, cache=None, reserve_stock_script=None):
         self.client = client
+        self.cache = cache or TTLCache(maxsize=0, ttl=0)
+        self.reserve_stock_script = (
+            reserve_stock_script or
+            client.register_script(RESERVE_STOCK_SCRIPT)
+        )
 
     def _format_key(self, product_id):
         return 'products:{}'.format(product_id)
 
+    def _format_title_index_key(self, ngram):
+        return TITLE_INDEX_KEY.format(ngram)
+
+    def _title_ngrams(self, title):
+        return {
+            title[start:start + size]
+            for size in range(1, TITLE_INDEX_NGRAM + 1)
+            for start in range(len(title) - size + 1)
+        }
+
+    def _index_title(self, pipe, product_id, title):
+        title = title.lower()
+        pipe.hset(TITLES_KEY, product_id, title)
+        for ngram in self._title_ngrams(title):
+            pipe.sadd(self._format_title_index_key(ngram), product_id)
+
+    def _unindex_title(self, pipe, product_id, title):
+        pipe.hdel(TITLES_KEY, product_id)
+        for ngram in self._title_ngrams(title.lower()):
+            pipe.srem(self._format_title_index_key(ngram), product_id)
+
+    def _search_title(self, term):
+        """ Return the sorted ids of products whose title contains `term`
+        (case insensitive) using the n-gram index only.
+        """
+        term = term.lower()
+        if len(term) <= TITLE_INDEX_NGRAM:
+            return sorted(
+                product_id.decode('utf-8') for product_id in
+                self.client.smembers(self._format_title_index_key(term))
+            )
+
+        candidates = sorted(self.client.sinter([
+            self._format_title_index_key(term[start:start + TITLE_INDEX_NGRAM])
+            for start in range(len(term) - TITLE_INDEX_NGRAM + 1)
+        ]))
+        if not candidates:
+            return []
+
+        titles = self.client.hmget(TITLES_KEY, candidates)
+        return [
+            product_id.decode('utf-8')
+            for product_id, title in zip(candidates, titles)
+            if title is not None and term in title.decode('utf-8')
+        ]
+
+    def format_cursor(self, product_id):
+        """ Return an opaque cursor for listing the products after
+        `product_id`.
+        """
+        return base64.urlsafe_b64encode(
+            str(product_id).encode('utf-8')).decode('ascii')
+
+    def _parse_cursor(self, cursor):
+        try:
+            return base64.urlsafe_b64decode(
+                cursor.encode('ascii')).decode('utf-8')
+        except (binascii.Error, UnicodeError):
+            raise InvalidCursor('Cursor {} is not valid'.format(cursor))
+
+    def _page_ids(self, page, per_page, cursor):
+        if cursor:
+            return self.client.zrangebylex(
+                CATALOGUE_KEY, '(' + self._parse_cursor(cursor), '+',
+                start=0, num=per_page or -1)
+        if page and per_page:
+            start = (page - 1) * per_page
+            return self.client.zrange(
+                CATALOGUE_KEY, start, start + per_page - 1)
+        return self.client.zrange(CATALOGUE_KEY, 0, -1)
+
     def _from_hash(self, document):
         return {
             'id': document[b'id'].decode('utf-8'),
@@ -41,73 +199,363 @@ class StorageWrapper:
             'in_stock': int(document[b'in_stock'])
         }
 
-    @lru_cache(maxsize=128)
+    def _publish_invalidation(self, pipe, *product_ids):
+        pipe.incr(CATALOGUE_VERSION_KEY)
+        pipe.publish(INVALIDATION_CHANNEL, json.dumps(
+            [str(product_id) for product_id in product_ids]))
+
+    def _invalidate(self, *product_ids):
+        self.cache.invalidate(*(str(product_id) for product_id in product_ids))
+
     def get(self, product_id):
-        product = self.client.hgetall(self._format_key(product_id))
-        if not product:
+        product = self.cache.get(str(product_id))
+        if product is not None:
+            return dict(product)
+
+        generation = self.cache.generation
+        document = self.client.hgetall(self._format_key(product_id))
+        if not document:
             self._product_not_found(product_id)
         else:
-            return self._from_hash(product)
+            product = self._from_hash(document)
+            self.cache.set(str(product_id), product, generation)
+            return dict(product)
 
-    def list(self, filter_title_term='', page=1, per_page=10):
-        keys = self.client.keys(self._format_key('*'))
+    def list(self, filter_title_term='', page=1, per_page=10, cursor=None):
+        """ List products ordered by id.
 
-        filtered_keys = []
+        Pages are selected either by `page` or, when given, by a `cursor`
+        from `format_cursor`, which lists the products after the one it was
+        built from.
+        """
         if filter_title_term:
-            pattern = re.compile(f".*{filter_title_term}.*", re.IGNORECASE)
-            for key in keys:
-                product = self._from_hash(self.client.hgetall(key))
-                if pattern.match(product['title']):
-                    filtered_keys.append(key)
-        else:
-            filtered_keys = keys
-
-        total_products = len(filtered_keys)
+            filtered_ids = self._search_title(filter_title_term)
+            total_products = len(filtered_ids)
 
-        if page and per_page:
-            start = (page - 1) * per_page
-            end = start + per_page
-            paginated_keys = filtered_keys[start:end]
-        else: 
-            paginated_keys = filtered_keys
+            if cursor:
+                start = bisect.bisect_right(
+                    filtered_ids, self._parse_cursor(cursor))
+            elif page and per_page:
+                start = (page - 1) * per_page
+            else:
+                start = 0
+            end = start + per_page if per_page else None
+            paginated_ids = filtered_ids[start:end]
+        else:
+            total_products = self.client.zcard(CATALOGUE_KEY)
+            paginated_ids = [
+                product_id.decode('utf-8')
+                for product_id in self._page_ids(page, per_page, cursor)
+            ]
 
         def product_generator():
-            for key in paginated_keys:
-                yield self._from_hash(self.client.hgetall(key))
+            yield from self.get_many(paginated_ids)
 
         return product_generator(), total_products
 
+    def get_many(self, product_ids):
+        """ Get the products for `product_ids` in a single round trip.
+
+        Products are returned in the order of `product_ids`; unknown ids are
+        left out of the result. Cached products are not read from Redis.
+        """
+        product_ids = [str(product_id) for product_id in product_ids]
+        products = {
+            product_id: self.cache.get(product_id)
+            for product_id in product_ids
+        }
+        missing_ids = [
+            product_id for product_id, product in products.items()
+            if product is None
+        ]
+
+        if missing_ids:
+            generation = self.cache.generation
+            pipe = self.client.pipeline(transaction=False)
+            for product_id in missing_ids:
+                pipe.hgetall(self._format_key(product_id))
+            for product_id, document in zip(missing_ids, pipe.execute()):
+                if document:
+                    products[product_id] = self._from_hash(document)
+                    self.cache.set(
+                        product_id, products[product_id], generation)
+
+        return [
+            dict(products[product_id])
+            for product_id in product_ids if products[product_id] is not None
+        ]
+
+    def export(self, cursor=0, count=500):
+        """ Return a chunk of about `count` products, straight from Redis,
+        and the cursor to pass for the next chunk, which is 0 after the
+        last one.
+
+        Chunks are walked with SCAN, so exporting the whole catalogue is
+        linear and never holds more than a chunk, in no particular order. A
+        product may come up twice when the keyspace is resized meanwhile.
+        """
+        cursor, keys = self.client.scan(
+            cursor, match=self._format_key('*'), count=count)
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        products = [
+            self._from_hash(document)
+            for document in (pipe.execute() if keys else []) if document
+        ]
+        return products, cursor
+
     def create(self, product):
         if self.client.exists(self._format_key(product['id'])):
             raise Conflict('Product ID {} already exists'.format(product['id']))
-        
-        self.client.hmset(
+
+        pipe = self.client.pipeline()
+        pipe.hmset(
             self._format_key(product['id']),
             product)
-        
+        pipe.zadd(CATALOGUE_KEY, {product['id']: 0})
+        self._index_title(pipe, product['id'], product['title'])
+        self._publish_invalidation(pipe, product['id'])
+        pipe.execute()
+        self._invalidate(product['id'])
+
     def delete(self, product_id):
         key = self._format_key(product_id)
-        if not self.client.exists(key):
+        title = self.client.hget(key, 'title')
+        if title is None:
             self._product_not_found(product_id)
         else:
-            self.client.delete(key)
-        
+            pipe = self.client.pipeline()
+            pipe.delete(key)
+            pipe.zrem(CATALOGUE_KEY, product_id)
+            self._unindex_title(pipe, product_id, title.decode('utf-8'))
+            self._publish_invalidation(pipe, product_id)
+            pipe.execute()
+            self._invalidate(product_id)
+
     def update(self, product_id, updated_fields):
-        if not self.client.exists(self._format_key(product_id)):
+        key = self._format_key(product_id)
+        title = self.client.hget(key, 'title')
+        if title is None:
             raise NotFound('Product ID {} does not exist'.format(product_id))
         else:
-            self.client.hmset(self._format_key(product_id), updated_fields)
-        
+            pipe = self.client.pipeline()
+            pipe.hmset(key, updated_fields)
+            if 'title' in updated_fields:
+                self._unindex_title(pipe, product_id, title.decode('utf-8'))
+                self._index_title(
+                    pipe, product_id, updated_fields['title'])
+            self._publish_invalidation(pipe, product_id)
+            pipe.execute()
+            self._invalidate(product_id)
+
+    def reindex(self):
+        """ Rebuild the catalogue and the title index from the stored
+        products, e.g. for products written before the indexes existed.
+        """
+        cursor = None
+        while cursor != 0:
+            products, cursor = self.export(cursor or 0)
+            if products:
+                pipe = self.client.pipeline()
+                pipe.zadd(
+                    CATALOGUE_KEY,
+                    {product['id']: 0 for product in products})
+                for product in products:
+                    self._index_title(pipe, product['id'], product['title'])
+                pipe.execute()
+        self.client.set(INDEXED_KEY, 1)
+
+    def ensure_indexed(self):
+        """ Run `reindex` unless the indexes were built already.
+        """
+        if not self.client.exists(INDEXED_KEY):
+            self.reindex()
 
     def decrement_stock(self, product_id, amount):
-        return self.client.hincrby(
-            self._format_key(product_id), 'in_stock', -amount)
+        pipe = self.client.pipeline()
+        pipe.hincrby(self._format_key(product_id), 'in_stock', -amount)
+        self._publish_invalidation(pipe, product_id)
+        in_stock = pipe.execute()[0]
+        self._invalidate(product_id)
+        return in_stock
+
+    def decrement_stocks(self, amounts):
+        """ Decrement the stock of several products in a single round trip.
+
+        `amounts` maps product ids to the amount to take off their stock.
+        Returns the new stock of each product, keyed by product id.
+        """
+        product_ids = list(amounts)
+        pipe = self.client.pipeline()
+        for product_id in product_ids:
+            pipe.hincrby(
+                self._format_key(product_id), 'in_stock', -amounts[product_id])
+        self._publish_invalidation(pipe, *product_ids)
+        in_stock = dict(zip(product_ids, pipe.execute()))
+        self._invalidate(*product_ids)
+        return in_stock
+
+    def decrement_stocks_once(self, events):
+        """ Like `decrement_stocks`, for the amounts of several events,
+        skipping the events applied already.
+
+        `events` is a list of `(event_id, amounts)` pairs; events without an
+        id are always applied. The stocks are decremented and the events
+        marked as applied in a single transaction, which is retried when
+        another worker marks one of them meanwhile. Returns the ids of the
+        events applied.
+        """
+        if not events:
+            return []
+
+        keys = [
+            APPLIED_EVENT_KEY.format(event_id)
+            for event_id, _ in events if event_id is not None
+        ]
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    if keys:
+                        pipe.watch(*keys)
+                        applied = {
+                            key for key, mark in zip(keys, pipe.mget(keys))
+                            if mark is not None
+                        }
+                    else:
+                        applied = set()
+                    new_events = []
+                    for event_id, amounts in events:
+                        if event_id is not None:
+                            key = APPLIED_EVENT_KEY.format(event_id)
+                            if key in applied:
+                                continue
+                            # delivered twice within the batch
+                            applied.add(key)
+                        new_events.append((event_id, amounts))
+                    total = Counter()
+                    for _, amounts in new_events:
+                        total.update(amounts)
+
+                    pipe.multi()
+                    for product_id, amount in total.items():
+                        pipe.hincrby(
+                            self._format_key(product_id), 'in_stock', -amount)
+                    for event_id, _ in new_events:
+                        if event_id is not None:
+                            pipe.set(
+                                APPLIED_EVENT_KEY.format(event_id), 1,
+                                ex=APPLIED_EVENT_TTL)
+                    if total:
+                        self._publish_invalidation(pipe, *total)
+                    pipe.execute()
+                    break
+                except redis.WatchError:
+                    continue
+        if total:
+            self._invalidate(*total)
+        return [event_id for event_id, _ in new_events]
+
+    def reserve_stock(self, amounts):
+        """ Take `amounts`, mapping product ids to quantities, off the stock
+        of the products, all or nothing, in a single round trip.
+
+        Raises `ValueError` unless every quantity is positive, `NotFound` if
+        a product does not exist and `OutOfStock` if one has less stock than
+        asked for, in which case no stock is taken. Returns the new stock of
+        each product, keyed by product id.
+        """
+        product_ids = [str(product_id) for product_id in amounts]
+        if not product_ids:
+            return {}
+        quantities = [int(amounts[product_id]) for product_id in amounts]
+        for product_id, quantity in zip(product_ids, quantities):
+            if quantity <= 0:
+                self._invalid_quantity(product_id, quantity)
+
+        status, result = self.reserve_stock_script(
+            keys=[
+                self._format_key(product_id) for product_id in product_ids
+            ] + [CATALOGUE_VERSION_KEY],
+            args=quantities + [INVALIDATION_CHANNEL, json.dumps(product_ids)],
+        )
+        if status == b'INVALID_QUANTITY':
+            self._invalid_quantity(
+                product_ids[result - 1], quantities[result - 1])
+        if status == b'NOT_FOUND':
+            self._product_not_found(product_ids[result - 1])
+        if status == b'OUT_OF_STOCK':
+            raise OutOfStock('Product ID {} is out of stock'.format(
+                product_ids[result - 1]))
+
+        self._invalidate(*product_ids)
+        return dict(zip(product_ids, result))
+
+    def catalogue_version(self):
+        """ Return a number that changes whenever any product is written.
+        """
+        return int(self.client.get(CATALOGUE_VERSION_KEY) or 0)
+
+    def cache_stats(self):
+        return self.cache.stats()
 
 
 class Storage(DependencyProvider):
+    """ Provides a `StorageWrapper` sharing the Redis client and the product
+    cache of the container.
+
+    Starting the container backfills the catalogue and the title index
+    when they were never built, see `StorageWrapper.ensure_indexed`.
+
+    While the container runs, a managed thread listens on
+    `INVALIDATION_CHANNEL` and evicts the products written by other
+    instances from the cache.
+    """
 
     def setup(self):
         self.client = redis.StrictRedis.from_url(config.get(REDIS_URI_KEY))
+        self.cache = TTLCache(
+            maxsize=int(config.get(PRODUCT_CACHE_SIZE_KEY, 1024)),
+            ttl=float(config.get(PRODUCT_CACHE_TTL_KEY, 5)),
+        )
+        self.reserve_stock_script = self.client.register_script(
+            RESERVE_STOCK_SCRIPT)
 
     def get_dependency(self, worker_ctx):
-        return StorageWrapper(self.client)
+        return StorageWrapper(
+            self.client, self.cache, self.reserve_stock_script)
+
+    def start(self):
+        StorageWrapper(self.client).ensure_indexed()
+        self.container.spawn_managed_thread(self._listen_for_invalidations)
+
+    def _listen_for_invalidations(self):
+        while True:
+            pubsub = self.client.pubsub()
+            try:
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                for message in pubsub.listen():
+                    if message['type'] == 'subscribe':
+                        # anything published while we were not subscribed
+                        # has been missed
+                        self.cache.clear()
+                    elif message['type'] == 'message':
+                        self._invalidate(message['data'])
+            except redis.RedisError:
+                logger.warning(
+                    'Lost product cache invalidation subscription',
+                    exc_info=True)
+                self.cache.clear()
+                time.sleep(INVALIDATION_RECONNECT_DELAY)
+            finally:
+                pubsub.close()
+
+    def _invalidate(self, data):
+        try:
+            product_ids = json.loads(data)
+            self.cache.invalidate(*product_ids)
+        except (TypeError, ValueError):
+            # which products were written is unknown
+            logger.warning(
+                'Invalid product cache invalidation: %r', data, exc_info=True)
+            self.cache.clear()
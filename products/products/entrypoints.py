@@ -0,0 +1,97 @@
+from functools import partial
+
+import eventlet
+from nameko import config
+from nameko.events import EventHandler
+from nameko.exceptions import ContainerBeingKilled
+from nameko.messaging import decode_from_headers
+
+
+EVENT_BATCH_SIZE_KEY = 'EVENT_BATCH_SIZE'
+EVENT_BATCH_WAIT_KEY = 'EVENT_BATCH_WAIT'  # ms
+EVENT_PREFETCH_COUNT_KEY = 'EVENT_PREFETCH_COUNT'
+
+
+class BatchEventHandler(EventHandler):
+    """ Event handler that hands events over to its method in batches.
+
+    Events are collected until `EVENT_BATCH_SIZE` of them arrived, or
+    `EVENT_BATCH_WAIT` ms passed since the first of them, and then the
+    decorated method is called, in a single worker, with the list of their
+    payloads. When it returns, all the events of the batch are acknowledged
+    together; when it fails, they are all requeued if `requeue_on_error`,
+    so the method should skip the payloads it cannot handle rather than
+    fail on them. The worker runs with the context data of the first event
+    of the batch.
+
+    The broker delivers up to `EVENT_PREFETCH_COUNT` unacknowledged events,
+    which is never less than the batch size, so that a batch can fill up.
+    Events still collecting when the service stops are redelivered.
+
+    Example::
+
+        @batch_event_handler('orders', 'order_created')
+        def handle_orders(self, payloads):
+            ...
+    """
+
+    def setup(self):
+        self.batch_size = int(config.get(EVENT_BATCH_SIZE_KEY, 100))
+        self.batch_wait = float(config.get(EVENT_BATCH_WAIT_KEY, 50)) / 1000
+        self.consumer_options['prefetch_count'] = max(
+            int(config.get(EVENT_PREFETCH_COUNT_KEY, 2 * self.batch_size)),
+            self.batch_size
+        )
+        self.batch = []
+        self.batch_id = 0
+        super(BatchEventHandler, self).setup()
+
+    def handle_message(self, body, message):
+        self.batch.append((body, message))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        elif len(self.batch) == 1:
+            self.container.spawn_managed_thread(
+                partial(self._flush_after_wait, self.batch_id))
+
+    def _flush_after_wait(self, batch_id):
+        eventlet.sleep(self.batch_wait)
+        # unless the batch filled up in the meantime
+        if batch_id == self.batch_id:
+            self.flush()
+
+    def flush(self):
+        """ Spawn a worker handling the events collected so far.
+        """
+        batch, self.batch = self.batch, []
+        self.batch_id += 1
+        if not batch:
+            return
+
+        payloads = [body for body, _ in batch]
+        messages = [message for _, message in batch]
+        context_data = decode_from_headers(messages[0].headers)
+        handle_result = partial(self.handle_result, messages)
+
+        def spawn_worker():
+            try:
+                self.container.spawn_worker(
+                    self, (payloads,), {},
+                    context_data=context_data,
+                    handle_result=handle_result
+                )
+            except ContainerBeingKilled:
+                for message in messages:
+                    self.consumer.requeue_message(message)
+
+        # like `Consumer.handle_message`, wait for a worker in another thread
+        # so that the AMQP consumer is never blocked
+        self.container.spawn_managed_thread(spawn_worker)
+
+    def handle_result(self, messages, worker_ctx, result=None, exc_info=None):
+        for message in messages:
+            self.handle_message_processed(message, result, exc_info)
+        return result, exc_info
+
+
+batch_event_handler = BatchEventHandler.decorator
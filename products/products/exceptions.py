@@ -2,4 +2,10 @@ class NotFound(Exception):
     pass
 
 class Conflict(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class InvalidCursor(Exception):
+    pass
+
+class OutOfStock(Exception):
+    pass
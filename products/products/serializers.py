@@ -0,0 +1,10 @@
+"""
+Serializers compiled from the schemas of the service, see
+`nameko_examples_common.serializers`.
+"""
+from nameko_examples_common.serializers import compile_serializer
+
+from products.schemas import Product
+
+
+serialize_product = compile_serializer(Product())
@@ -1,8 +1,10 @@
 import logging
+from collections import Counter
 
 from nameko.events import event_handler
 from nameko.rpc import rpc
-from products import dependencies, schemas
+from products import dependencies, schemas, serializers
+from products.entrypoints import batch_event_handler
 
 
 logger = logging.getLogger(__name__)
@@ -17,15 +19,42 @@ class ProductsService:
     @rpc
     def get(self, product_id):
         product = self.storage.get(product_id)
-        return schemas.Product().dump(product).data
+        return serializers.serialize_product(product)
 
     @rpc
-    def list(self, filter_title_term='', page=1, per_page=10):
-        product_generator, total_products = self.storage.list(filter_title_term, page, per_page)
+    def get_many(self, product_ids):
+        products = self.storage.get_many(product_ids)
+        return [serializers.serialize_product(product) for product in products]
+
+    @rpc
+    def list(self, filter_title_term='', page=1, per_page=10, cursor=None):
+        product_generator, total_products = self.storage.list(
+            filter_title_term, page, per_page, cursor)
         products = list(product_generator)
+
+        next_cursor = None
+        if per_page and len(products) == per_page:
+            next_cursor = self.storage.format_cursor(products[-1]['id'])
+
+        return {
+            'products': [
+                serializers.serialize_product(product) for product in products
+            ],
+            'total_products': total_products,
+            'next_cursor': next_cursor,
+        }
+
+    @rpc
+    def export(self, cursor=0, count=500):
+        """ Return a chunk of products and the `next_cursor` to pass for
+        the following one, which is None after the last chunk.
+        """
+        products, cursor = self.storage.export(cursor, count)
         return {
-            'products': schemas.Product(many=True).dump(products).data,
-            'total_products': total_products
+            'products': [
+                serializers.serialize_product(product) for product in products
+            ],
+            'next_cursor': cursor or None,
         }
 
     @rpc
@@ -43,8 +72,81 @@ class ProductsService:
         valid_fields = schema.load(updated_fields).data
         self.storage.update(product_id, valid_fields)
 
-    @event_handler('orders', 'order_created')
-    def handle_order_created(self, payload):
-        for product in payload['order']['order_details']:
-            self.storage.decrement_stock(
-                product['product_id'], product['quantity'])
+    @rpc
+    def catalogue_version(self):
+        return self.storage.catalogue_version()
+
+    @rpc
+    def cache_stats(self):
+        return self.storage.cache_stats()
+
+    @rpc
+    def reindex(self):
+        self.storage.reindex()
+
+    def _amounts(self, orders):
+        amounts = Counter()
+        for order in orders:
+            for product in order['order_details']:
+                amounts[product['product_id']] += product['quantity']
+        return amounts
+
+    def _stock_events(self, payloads, get_orders):
+        # a malformed event is logged and skipped rather than failing the
+        # well-formed ones handled along with it
+        events = []
+        for payload in payloads:
+            try:
+                amounts = self._amounts(get_orders(payload))
+                if not all(
+                    isinstance(amount, int) and amount > 0
+                    for amount in amounts.values()
+                ):
+                    raise ValueError('Quantities must be positive integers')
+            except (AttributeError, KeyError, TypeError, ValueError):
+                logger.error(
+                    'Skipping malformed orders event: %r', payload,
+                    exc_info=True)
+                continue
+            if amounts:
+                events.append((payload.get('event_id'), amounts))
+        return events
+
+    @rpc
+    def reserve_stock(self, order_details):
+        """ Take the quantities of `order_details` off the stock of their
+        products, atomically and only if all of them are in stock.
+
+        Orders created with their stock reserved are flagged in their
+        `order_created` event, so that their stock is not taken twice.
+        """
+        return self.storage.reserve_stock(
+            self._amounts([{'order_details': order_details}]))
+
+    @rpc
+    def release_stock(self, order_details):
+        """ Put back the stock reserved for an order that could not be
+        created.
+        """
+        amounts = self._amounts([{'order_details': order_details}])
+        self.storage.decrement_stocks({
+            product_id: -amount for product_id, amount in amounts.items()})
+
+    @batch_event_handler('orders', 'order_created')
+    def handle_order_created(self, payloads):
+        """ Take the stock of a batch of new orders off their products, in
+        a single transaction, unless it was reserved already.
+
+        Orders events are delivered at least once; a redelivered event has
+        the same `event_id` and is skipped.
+        """
+        self.storage.decrement_stocks_once(self._stock_events(
+            payloads,
+            lambda payload: (
+                [] if payload.get('stock_reserved') else [payload['order']])
+        ))
+
+    @event_handler('orders', 'orders_created')
+    def handle_orders_created(self, payload):
+        self.storage.decrement_stocks_once(self._stock_events(
+            [payload], lambda payload: payload['orders']))
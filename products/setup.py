@@ -9,6 +9,7 @@ setup(
     packages=find_packages(exclude=['test', 'test.*']),
     py_modules=['products'],
     install_requires=[
+        "nameko-examples-common==0.0.1",
         "marshmallow==2.19.2",
         "nameko==v3.0.0-rc6",
         "redis==3.2.1",
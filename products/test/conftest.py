@@ -2,7 +2,7 @@ import pytest
 import redis
 
 from nameko import config
-from products.dependencies import REDIS_URI_KEY
+from products.dependencies import REDIS_URI_KEY, StorageWrapper
 
 
 @pytest.fixture
@@ -36,9 +36,7 @@ def create_product(redis_client, product):
     def create(**overrides):
         new_product = product.copy()
         new_product.update(**overrides)
-        redis_client.hmset(
-            'products:{}'.format(new_product['id']),
-            new_product)
+        StorageWrapper(redis_client).create(new_product)
         return new_product
     return create
 
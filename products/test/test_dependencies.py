@@ -1,8 +1,14 @@
+import json
+
 import pytest
-from mock import Mock
+import redis
+from mock import Mock, patch
 
 from nameko import config
-from products.dependencies import Storage
+from products.dependencies import (
+    CATALOGUE_VERSION_KEY, INVALIDATION_CHANNEL, Storage,
+)
+from products.exceptions import InvalidCursor, NotFound, OutOfStock
 
 
 @pytest.fixture
@@ -28,6 +34,22 @@ def test_get(storage, products):
     assert 11 == product['in_stock']
 
 
+def test_get_many(storage, products):
+    loaded_products = storage.get_many(['LZ130', 'LZ127'])
+
+    assert [products[2], products[0]] == loaded_products
+
+
+def test_get_many_leaves_out_unknown_ids(storage, products):
+    loaded_products = storage.get_many(['LZ129', 'unknown'])
+
+    assert [products[1]] == loaded_products
+
+
+def test_get_many_when_empty(storage):
+    assert [] == storage.get_many([])
+
+
 def test_list(storage, products):
     products_generator, _ = storage.list()
     listed_products_response = list(products_generator)
@@ -39,6 +61,106 @@ def test_list(storage, products):
         sorted_response == sorted_products)
 
 
+def test_list_is_ordered_by_id(storage, create_product):
+    for product_id in ('LZ130', 'LZ127', 'LZ129'):
+        create_product(id=product_id)
+
+    products_generator, total_products = storage.list()
+
+    assert ['LZ127', 'LZ129', 'LZ130'] == [
+        product['id'] for product in products_generator]
+    assert 3 == total_products
+
+
+def test_list_paginates(storage, products):
+    products_generator, total_products = storage.list(page=2, per_page=2)
+
+    assert ['LZ130'] == [product['id'] for product in products_generator]
+    assert 3 == total_products
+
+
+@pytest.mark.parametrize('filter_title_term', ['', 'lz'])
+def test_list_after_cursor(storage, products, filter_title_term):
+    cursor = storage.format_cursor('LZ127')
+
+    products_generator, total_products = storage.list(
+        filter_title_term=filter_title_term, per_page=1, cursor=cursor)
+
+    assert ['LZ129'] == [product['id'] for product in products_generator]
+    assert 3 == total_products
+
+
+def test_list_fails_on_invalid_cursor(storage, products):
+    with pytest.raises(InvalidCursor):
+        storage.list(cursor='not a cursor')
+
+
+def test_export(storage, create_product):
+    for index in range(25):
+        create_product(id='product_{:02}'.format(index))
+
+    exported = []
+    products, cursor = storage.export(count=10)
+    exported.extend(products)
+    while cursor:
+        products, cursor = storage.export(cursor, count=10)
+        exported.extend(products)
+
+    assert ['product_{:02}'.format(index) for index in range(25)] == sorted(
+        {product['id'] for product in exported})
+
+
+def test_export_when_empty(storage):
+    assert ([], 0) == storage.export()
+
+
+def test_reindex(storage, redis_client, product):
+    redis_client.hmset('products:LZ127', product)
+
+    storage.reindex()
+
+    assert [product] == list(storage.list()[0])
+    assert [product] == list(storage.list(filter_title_term='lz 1')[0])
+
+
+def test_reindex_in_chunks(storage, redis_client, product):
+    for index in range(25):
+        redis_client.hmset(
+            'products:product_{:02}'.format(index),
+            dict(product, id='product_{:02}'.format(index)))
+
+    storage.reindex()
+
+    assert 25 == storage.list(per_page=5)[1]
+
+
+def test_ensure_indexed_builds_the_title_index(storage, redis_client, product):
+    redis_client.hmset('products:LZ127', product)
+    redis_client.hmset(
+        'products:LZ129', dict(product, id='LZ129', title='Hindenburg'))
+
+    storage.ensure_indexed()
+
+    assert ['LZ127'] == [
+        item['id'] for item in storage.list(filter_title_term='lz 12')[0]]
+    assert ['LZ129'] == [
+        item['id'] for item in storage.list(filter_title_term='den')[0]]
+
+    # a backfilled title is unindexed like any other on update
+    storage.update('LZ129', {'title': 'Graf Zeppelin'})
+    assert [] == list(storage.list(filter_title_term='den')[0])
+
+
+def test_ensure_indexed_runs_once(storage, redis_client, product):
+    redis_client.hmset('products:LZ127', product)
+    storage.ensure_indexed()
+    redis_client.hmset('products:LZ129', dict(product, id='LZ129'))
+
+    storage.ensure_indexed()
+
+    assert ['LZ127'] == [item['id'] for item in storage.list()[0]]
+
+
 def test_create(product, redis_client, storage):
 
     storage.create(product)
@@ -67,3 +189,330 @@ def test_decrement_stock(storage, create_product, redis_client):
     assert b'10' == product_one[b'in_stock']
     assert b'7' == product_two[b'in_stock']
     assert b'12' == product_three[b'in_stock']
+
+
+@pytest.mark.parametrize('filter_title_term, expected_ids', [
+    ('zeppelin', ['LZ127', 'LZ130']),
+    ('ZEPPELIN II', ['LZ130']),
+    ('hind', ['LZ129']),
+    ('lz', ['LZ127', 'LZ129', 'LZ130']),
+    ('z', ['LZ127', 'LZ129', 'LZ130']),
+    ('zeppelin iii', []),
+    ('blimp', []),
+])
+def test_list_filtered_by_title(
+    storage, products, filter_title_term, expected_ids
+):
+    products_generator, total_products = storage.list(
+        filter_title_term=filter_title_term)
+
+    assert expected_ids == [product['id'] for product in products_generator]
+    assert len(expected_ids) == total_products
+
+
+def test_list_filtered_by_title_paginates(storage, products):
+    products_generator, total_products = storage.list(
+        filter_title_term='lz', page=2, per_page=2)
+
+    assert ['LZ130'] == [product['id'] for product in products_generator]
+    assert 3 == total_products
+
+
+def test_create_indexes_title(storage, product, redis_client):
+    storage.create(product)
+
+    products_generator, _ = storage.list(filter_title_term='lz 1')
+
+    assert [product] == list(products_generator)
+
+
+def test_update_reindexes_title(storage, product, redis_client):
+    storage.create(product)
+
+    storage.update(product['id'], {'title': 'Hindenburg'})
+
+    assert [] == list(storage.list(filter_title_term='lz 1')[0])
+    assert ['LZ127'] == [
+        listed['id']
+        for listed in storage.list(filter_title_term='denb')[0]]
+
+
+def test_delete_unindexes_title(storage, product, redis_client):
+    storage.create(product)
+
+    storage.delete(product['id'])
+
+    assert [] == list(storage.list(filter_title_term='lz 1')[0])
+    assert [] == redis_client.keys('product_index:title:*')
+
+
+def test_decrement_stocks(storage, create_product, redis_client):
+    create_product(id=1, title='LZ 127', in_stock=10)
+    create_product(id=2, title='LZ 129', in_stock=11)
+    create_product(id=3, title='LZ 130', in_stock=12)
+
+    in_stock = storage.decrement_stocks({1: 3, 3: 5})
+
+    assert {1: 7, 3: 7} == in_stock
+    product_one, product_two, product_three = [
+        redis_client.hgetall('products:{}'.format(id_))
+        for id_ in (1, 2, 3)]
+    assert b'7' == product_one[b'in_stock']
+    assert b'11' == product_two[b'in_stock']
+    assert b'7' == product_three[b'in_stock']
+
+
+def test_reserve_stock(storage, products, redis_client):
+    in_stock = storage.reserve_stock({'LZ127': 10, 'LZ130': 5})
+
+    assert {'LZ127': 0, 'LZ130': 7} == in_stock
+    assert [b'0', b'11', b'7'] == [
+        redis_client.hget('products:{}'.format(id_), 'in_stock')
+        for id_ in ('LZ127', 'LZ129', 'LZ130')]
+
+
+@pytest.mark.parametrize('amounts, exception', [
+    ({'LZ127': 1, 'LZ130': 13}, OutOfStock),
+    ({'LZ127': 1, 'unknown': 1}, NotFound),
+])
+def test_reserve_stock_is_all_or_nothing(
+    storage, products, redis_client, amounts, exception
+):
+    with pytest.raises(exception):
+        storage.reserve_stock(amounts)
+
+    assert [b'10', b'11', b'12'] == [
+        redis_client.hget('products:{}'.format(id_), 'in_stock')
+        for id_ in ('LZ127', 'LZ129', 'LZ130')]
+
+
+@pytest.mark.parametrize('quantity', [0, -5])
+def test_reserve_stock_rejects_non_positive_quantities(
+    storage, products, redis_client, quantity
+):
+    with pytest.raises(ValueError):
+        storage.reserve_stock({'LZ127': 1, 'LZ130': quantity})
+
+    # not even through the script, which would otherwise add stock
+    status, index = storage.reserve_stock_script(
+        keys=['products:LZ127', 'products:LZ130', CATALOGUE_VERSION_KEY],
+        args=[1, quantity, INVALIDATION_CHANNEL, '[]'])
+    assert (b'INVALID_QUANTITY', 2) == (status, index)
+
+    assert [b'10', b'11', b'12'] == [
+        redis_client.hget('products:{}'.format(id_), 'in_stock')
+        for id_ in ('LZ127', 'LZ129', 'LZ130')]
+
+
+def test_reserve_stock_when_empty(storage):
+    assert {} == storage.reserve_stock({})
+
+
+def test_get_is_served_from_cache(storage, products, redis_client):
+    storage.get('LZ129')
+    redis_client.hset('products:LZ129', 'in_stock', 0)
+
+    product = storage.get('LZ129')
+
+    assert 11 == product['in_stock']
+    assert 1 == storage.cache_stats()['hits']
+
+
+def test_get_many_is_served_from_cache(storage, products, redis_client):
+    storage.get('LZ129')
+    redis_client.hset('products:LZ129', 'in_stock', 0)
+
+    loaded_products = storage.get_many(['LZ127', 'LZ129'])
+
+    assert [10, 11] == [product['in_stock'] for product in loaded_products]
+    assert storage.get('LZ127') == loaded_products[0]
+
+
+@pytest.mark.parametrize('write', [
+    lambda storage: storage.update('LZ129', {'in_stock': 3}),
+    lambda storage: storage.decrement_stock('LZ129', 8),
+    lambda storage: storage.decrement_stocks({'LZ129': 8}),
+    lambda storage: storage.reserve_stock({'LZ129': 8}),
+])
+def test_writes_invalidate_cache(storage, products, write):
+    storage.get('LZ129')
+
+    write(storage)
+
+    assert 3 == storage.get('LZ129')['in_stock']
+
+
+def test_catalogue_version(storage):
+    assert 0 == storage.catalogue_version()
+
+
+@pytest.mark.parametrize('write', [
+    lambda storage: storage.create({
+        'id': 'LZ131', 'title': 'LZ 131', 'passenger_capacity': 1,
+        'maximum_speed': 1, 'in_stock': 1}),
+    lambda storage: storage.update('LZ129', {'in_stock': 3}),
+    lambda storage: storage.delete('LZ129'),
+    lambda storage: storage.decrement_stock('LZ129', 8),
+    lambda storage: storage.decrement_stocks({'LZ129': 8}),
+    lambda storage: storage.reserve_stock({'LZ129': 8}),
+])
+def test_writes_bump_catalogue_version(storage, products, write):
+    version = storage.catalogue_version()
+
+    write(storage)
+
+    assert version + 1 == storage.catalogue_version()
+
+
+def test_failed_reservation_keeps_catalogue_version(storage, products):
+    version = storage.catalogue_version()
+
+    with pytest.raises(OutOfStock):
+        storage.reserve_stock({'LZ129': 100})
+
+    assert version == storage.catalogue_version()
+
+
+def test_delete_invalidates_cache(storage, products):
+    storage.get('LZ129')
+
+    storage.delete('LZ129')
+
+    with pytest.raises(storage.NotFound):
+        storage.get('LZ129')
+
+
+def test_writes_publish_invalidations(storage, products, redis_client):
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(INVALIDATION_CHANNEL)
+
+    storage.update('LZ129', {'in_stock': 3})
+    storage.decrement_stocks({'LZ127': 1, 'LZ130': 1})
+    storage.reserve_stock({'LZ130': 1})
+
+    messages = []
+    for message in pubsub.listen():
+        messages.append(json.loads(message['data']))
+        if len(messages) == 3:
+            break
+    pubsub.close()
+
+    assert [['LZ129'], ['LZ127', 'LZ130'], ['LZ130']] == messages
+
+
+class StopListening(Exception):
+    pass
+
+
+@pytest.fixture
+def provider(test_config):
+    provider = Storage()
+    provider.container = Mock(config=config)
+    provider.setup()
+    return provider
+
+
+def subscription(*messages):
+    """ A subscription delivering `messages`, then failing with
+    `StopListening` to end the test
+    """
+    def listen():
+        yield {'type': 'subscribe', 'data': 1}
+        for message in messages:
+            yield message
+        raise StopListening()
+
+    pubsub = Mock()
+    pubsub.listen.side_effect = listen
+    return pubsub
+
+
+def test_listener_resubscribes_after_redis_errors(provider):
+    broken = subscription()
+    broken.listen.side_effect = redis.ResponseError('LOADING')
+    provider.client = Mock()
+    provider.client.pubsub.side_effect = [broken, subscription()]
+
+    with patch('products.dependencies.INVALIDATION_RECONNECT_DELAY', 0):
+        with pytest.raises(StopListening):
+            provider._listen_for_invalidations()
+
+    assert 2 == provider.client.pubsub.call_count
+    assert broken.close.called
+
+
+def test_listener_skips_invalid_messages(provider):
+    provider.client = Mock()
+    provider.client.pubsub.return_value = subscription(
+        {'type': 'message', 'data': b'not json'},
+        {'type': 'message', 'data': b'5'},
+        {'type': 'message', 'data': b'["LZ127"]'},
+    )
+    generation = provider.cache.generation
+
+    # all of them are handled, on the same subscription
+    with pytest.raises(StopListening):
+        provider._listen_for_invalidations()
+
+    assert 1 == provider.client.pubsub.call_count
+    # cleared when subscribing and for each invalid message, the products
+    # written being unknown, then invalidated by the valid one
+    assert generation + 4 == provider.cache.generation
+
+
+def test_decrement_stocks_once(storage, products, redis_client):
+    applied = storage.decrement_stocks_once([
+        (1, {'LZ127': 3}),
+        (2, {'LZ127': 1, 'LZ129': 2}),
+        # delivered twice in the same batch
+        (1, {'LZ127': 3}),
+    ])
+
+    assert [1, 2] == applied
+    assert b'6' == redis_client.hget('products:LZ127', 'in_stock')
+    assert b'9' == redis_client.hget('products:LZ129', 'in_stock')
+
+
+def test_decrement_stocks_once_skips_applied_events(
+    storage, products, redis_client
+):
+    storage.decrement_stocks_once([(1, {'LZ127': 3})])
+
+    assert [2] == storage.decrement_stocks_once([
+        (1, {'LZ127': 3}), (2, {'LZ129': 2})])
+
+    assert b'7' == redis_client.hget('products:LZ127', 'in_stock')
+    assert b'9' == redis_client.hget('products:LZ129', 'in_stock')
+    assert 0 < redis_client.ttl('product_events:orders:1')
+
+
+def test_decrement_stocks_once_applies_events_without_id(
+    storage, products, redis_client
+):
+    storage.decrement_stocks_once([(None, {'LZ127': 3})])
+    storage.decrement_stocks_once([(None, {'LZ127': 3})])
+
+    assert b'4' == redis_client.hget('products:LZ127', 'in_stock')
+
+
+def test_decrement_stocks_once_retries_on_concurrent_mark(
+    storage, products, redis_client
+):
+    make_pipeline = storage.client.pipeline
+
+    def pipeline():
+        pipe = make_pipeline()
+        watched_mget = pipe.mget
+
+        def mark_first(keys):
+            # another worker applies the event between WATCH and EXEC
+            redis_client.set('product_events:orders:1', 1)
+            redis_client.hincrby('products:LZ127', 'in_stock', -3)
+            pipe.mget = watched_mget
+            return watched_mget(keys)
+        pipe.mget = mark_first
+        return pipe
+    storage.client.pipeline = pipeline
+
+    assert [] == storage.decrement_stocks_once([(1, {'LZ127': 3})])
+    assert b'7' == redis_client.hget('products:LZ127', 'in_stock')
@@ -0,0 +1,92 @@
+from mock import Mock, call
+from nameko import config
+from nameko.standalone.events import event_dispatcher
+from nameko.testing.services import entrypoint_waiter
+from nameko.testing.utils import get_extension
+import pytest
+
+from products.entrypoints import BatchEventHandler, batch_event_handler
+
+
+class Service:
+
+    name = 'batches'
+
+    handled = Mock()
+
+    @batch_event_handler('orders', 'order_created')
+    def handle(self, payloads):
+        self.handled(payloads)
+
+
+@pytest.fixture
+def create_container(rabbit_config, container_factory):
+    Service.handled.reset_mock()
+
+    def create(**settings):
+        with config.patch(settings):
+            container = container_factory(Service)
+            container.start()
+        return container
+    return create
+
+
+def collect_batches(count):
+    batches = []
+
+    def callback(worker_ctx, result, exc_info):
+        batches.append(worker_ctx.args[0])
+        return len(batches) == count
+    return batches, callback
+
+
+def test_full_batch_is_handled_at_once(create_container):
+    container = create_container(EVENT_BATCH_SIZE=3, EVENT_BATCH_WAIT=60000)
+    dispatch = event_dispatcher()
+
+    batches, callback = collect_batches(2)
+    with entrypoint_waiter(container, 'handle', callback=callback):
+        for number in range(6):
+            dispatch('orders', 'order_created', {'number': number})
+
+    assert [
+        [{'number': 0}, {'number': 1}, {'number': 2}],
+        [{'number': 3}, {'number': 4}, {'number': 5}],
+    ] == batches
+
+
+def test_partial_batch_is_handled_after_wait(create_container):
+    container = create_container(EVENT_BATCH_SIZE=100, EVENT_BATCH_WAIT=20)
+    dispatch = event_dispatcher()
+
+    with entrypoint_waiter(container, 'handle'):
+        dispatch('orders', 'order_created', {'number': 0})
+        dispatch('orders', 'order_created', {'number': 1})
+
+    assert [
+        call([{'number': 0}, {'number': 1}])
+    ] == Service.handled.call_args_list
+
+
+@pytest.mark.parametrize('settings, prefetch_count', [
+    ({'EVENT_BATCH_SIZE': 10}, 20),
+    ({'EVENT_BATCH_SIZE': 10, 'EVENT_PREFETCH_COUNT': 50}, 50),
+    # a batch must be able to fill up
+    ({'EVENT_BATCH_SIZE': 10, 'EVENT_PREFETCH_COUNT': 5}, 10),
+])
+def test_prefetch_count(create_container, settings, prefetch_count):
+    container = create_container(**settings)
+
+    handler = get_extension(container, BatchEventHandler)
+    assert prefetch_count == handler.consumer.prefetch_count
+
+
+def test_batch_is_acknowledged_together(create_container):
+    container = create_container(EVENT_BATCH_SIZE=100)
+    handler = get_extension(container, BatchEventHandler)
+    messages = [Mock(), Mock()]
+
+    handler.handle_result(messages, Mock())
+
+    for message in messages:
+        assert message.ack.called
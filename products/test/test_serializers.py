@@ -0,0 +1,31 @@
+import json
+
+import pytest
+
+from products.schemas import Product
+from products.serializers import serialize_product
+
+
+@pytest.mark.parametrize('product', [
+    {
+        'id': 'LZ127',
+        'title': 'LZ 127',
+        'passenger_capacity': '20',
+        'maximum_speed': '128',
+        'in_stock': '11',
+    },
+    {
+        'id': b'LZ127',
+        'title': b'LZ 127',
+        'passenger_capacity': 20,
+        'maximum_speed': 128,
+        'in_stock': None,
+    },
+    {
+        'id': 'LZ127',
+        'title': 'LZ 127',
+    },
+])
+def test_serialize_product_matches_schema(product):
+    assert json.dumps(serialize_product(product)) == json.dumps(
+        Product().dump(product).data)
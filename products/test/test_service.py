@@ -1,10 +1,16 @@
+import eventlet
 from marshmallow.exceptions import ValidationError
+from nameko import config
 from nameko.testing.services import entrypoint_hook
 from nameko.standalone.events import event_dispatcher
 from nameko.testing.services import entrypoint_waiter
+from nameko.testing.utils import get_extension
 import pytest
 
-from products.dependencies import NotFound
+from products.dependencies import (
+    NotFound, Storage, StorageWrapper
+)
+from products.exceptions import OutOfStock
 from products.service import ProductsService
 
 
@@ -32,6 +38,14 @@ def test_get_product_fails_on_not_found(service_container):
             get(111)
 
 
+def test_get_many_products(products, service_container):
+
+    with entrypoint_hook(service_container, 'get_many') as get_many:
+        loaded_products = get_many(['LZ130', 'unknown', 'LZ127'])
+
+    assert [products[2], products[0]] == loaded_products
+
+
 def test_list_products(products, service_container):
 
     with entrypoint_hook(service_container, 'list') as list_:
@@ -40,6 +54,51 @@ def test_list_products(products, service_container):
     assert products == sorted(listed_products['products'], key=lambda p: p['id'])
 
 
+def test_list_products_returns_next_cursor(products, service_container):
+
+    with entrypoint_hook(service_container, 'list') as list_:
+        first_page = list_(per_page=2)
+        second_page = list_(per_page=2, cursor=first_page['next_cursor'])
+
+    assert ['LZ127', 'LZ129'] == [
+        product['id'] for product in first_page['products']]
+    assert ['LZ130'] == [
+        product['id'] for product in second_page['products']]
+    assert second_page['next_cursor'] is None
+    assert 3 == second_page['total_products']
+
+
+def test_products_stored_before_the_indexes_are_backfilled(
+    product, redis_client, test_config, container_factory
+):
+    redis_client.hmset('products:LZ127', product)
+    redis_client.hmset('products:LZ129', dict(product, id='LZ129'))
+
+    container = container_factory(ProductsService)
+    container.start()
+
+    with entrypoint_hook(container, 'list') as list_:
+        listed = list_()
+    assert ['LZ127', 'LZ129'] == [item['id'] for item in listed['products']]
+    assert 2 == listed['total_products']
+
+    with entrypoint_hook(container, 'list') as list_:
+        listed = list_(filter_title_term='lz 1')
+    assert 2 == listed['total_products']
+
+
+def test_reindex(product, redis_client, service_container):
+    redis_client.hmset('products:LZ127', product)
+
+    with entrypoint_hook(service_container, 'reindex') as reindex:
+        reindex()
+
+    with entrypoint_hook(service_container, 'get_many') as get_many:
+        assert [product] == get_many(['LZ127'])
+    with entrypoint_hook(service_container, 'list') as list_:
+        assert 1 == list_()['total_products']
+
+
 def test_list_productis_when_empty(service_container):
 
     with entrypoint_hook(service_container, 'list') as list_:
@@ -136,7 +195,8 @@ def test_handle_order_created(
         'order': {
             'order_details': [
                 {'product_id': 'LZ129', 'quantity': 2},
-                {'product_id': 'LZ127', 'quantity': 4},
+                {'product_id': 'LZ127', 'quantity': 3},
+                {'product_id': 'LZ127', 'quantity': 1},
             ]
         }
     }
@@ -150,3 +210,239 @@ def test_handle_order_created(
     assert b'6' == product_one[b'in_stock']
     assert b'9' == product_two[b'in_stock']
     assert b'12' == product_three[b'in_stock']
+
+
+def test_handle_order_created_skips_reserved_orders(
+    test_config, products, redis_client, service_container
+):
+
+    dispatch = event_dispatcher()
+
+    payload = {
+        'order': {
+            'order_details': [{'product_id': 'LZ127', 'quantity': 3}]
+        },
+        'stock_reserved': True,
+    }
+
+    with entrypoint_waiter(service_container, 'handle_order_created'):
+        dispatch('orders', 'order_created', payload)
+
+    assert b'10' == redis_client.hget('products:LZ127', 'in_stock')
+
+
+def test_handle_order_created_skips_redelivered_events(
+    test_config, products, redis_client, service_container
+):
+
+    dispatch = event_dispatcher()
+
+    payload = {
+        'order': {
+            'order_details': [{'product_id': 'LZ127', 'quantity': 3}]
+        },
+        'event_id': 1,
+    }
+
+    for _ in range(2):
+        with entrypoint_waiter(service_container, 'handle_order_created'):
+            dispatch('orders', 'order_created', payload)
+
+    assert b'7' == redis_client.hget('products:LZ127', 'in_stock')
+
+
+def test_handle_order_created_in_batches(
+    test_config, products, redis_client, container_factory
+):
+    with config.patch({'EVENT_BATCH_SIZE': 2, 'EVENT_BATCH_WAIT': 60000}):
+        container = container_factory(ProductsService)
+        container.start()
+
+    dispatch = event_dispatcher()
+
+    with entrypoint_waiter(container, 'handle_order_created'):
+        dispatch('orders', 'order_created', {
+            'order': {
+                'order_details': [{'product_id': 'LZ127', 'quantity': 3}]
+            },
+        })
+        dispatch('orders', 'order_created', {
+            'order': {
+                'order_details': [{'product_id': 'LZ129', 'quantity': 2}]
+            },
+            'stock_reserved': True,
+        })
+
+    assert b'7' == redis_client.hget('products:LZ127', 'in_stock')
+    assert b'11' == redis_client.hget('products:LZ129', 'in_stock')
+
+
+def test_handle_order_created_skips_malformed_events(
+    test_config, products, redis_client, container_factory
+):
+    with config.patch({'EVENT_BATCH_SIZE': 3, 'EVENT_BATCH_WAIT': 60000}):
+        container = container_factory(ProductsService)
+        container.start()
+
+    dispatch = event_dispatcher()
+
+    with entrypoint_waiter(container, 'handle_order_created') as result:
+        dispatch('orders', 'order_created', {
+            'order': {'order_details': [{'product_id': 'LZ127'}]},
+        })
+        dispatch('orders', 'order_created', {
+            'order': {
+                'order_details': [{'product_id': 'LZ129', 'quantity': -2}]
+            },
+        })
+        dispatch('orders', 'order_created', {
+            'order': {
+                'order_details': [{'product_id': 'LZ127', 'quantity': 3}]
+            },
+        })
+
+    # the well-formed event of the batch is still applied
+    assert result.get() is None
+    assert b'7' == redis_client.hget('products:LZ127', 'in_stock')
+    assert b'11' == redis_client.hget('products:LZ129', 'in_stock')
+
+
+def test_catalogue_version(create_product, service_container):
+
+    with entrypoint_hook(
+        service_container, 'catalogue_version'
+    ) as catalogue_version:
+        version = catalogue_version()
+        create_product()
+        assert version + 1 == catalogue_version()
+
+
+def test_export_products(products, service_container):
+
+    with entrypoint_hook(service_container, 'export') as export:
+        chunk = export(count=1000)
+
+    assert products == sorted(chunk['products'], key=lambda p: p['id'])
+    assert chunk['next_cursor'] is None
+
+
+def test_reserve_stock(products, redis_client, service_container):
+
+    with entrypoint_hook(service_container, 'reserve_stock') as reserve_stock:
+        in_stock = reserve_stock([
+            {'product_id': 'LZ129', 'quantity': 2},
+            {'product_id': 'LZ127', 'quantity': 3},
+            {'product_id': 'LZ127', 'quantity': 1},
+        ])
+
+    assert {'LZ129': 9, 'LZ127': 6} == in_stock
+    assert b'6' == redis_client.hget('products:LZ127', 'in_stock')
+    assert b'9' == redis_client.hget('products:LZ129', 'in_stock')
+
+
+def test_reserve_stock_fails_when_out_of_stock(
+    products, redis_client, service_container
+):
+
+    with pytest.raises(OutOfStock):
+        with entrypoint_hook(
+            service_container, 'reserve_stock'
+        ) as reserve_stock:
+            reserve_stock([
+                {'product_id': 'LZ129', 'quantity': 2},
+                {'product_id': 'LZ127', 'quantity': 6},
+                {'product_id': 'LZ127', 'quantity': 5},
+            ])
+
+    assert b'10' == redis_client.hget('products:LZ127', 'in_stock')
+    assert b'11' == redis_client.hget('products:LZ129', 'in_stock')
+
+
+def test_release_stock(products, redis_client, service_container):
+
+    with entrypoint_hook(service_container, 'release_stock') as release_stock:
+        release_stock([
+            {'product_id': 'LZ127', 'quantity': 3},
+            {'product_id': 'LZ127', 'quantity': 1},
+        ])
+
+    assert b'14' == redis_client.hget('products:LZ127', 'in_stock')
+
+
+def test_handle_orders_created(
+    test_config, products, redis_client, service_container
+):
+
+    dispatch = event_dispatcher()
+
+    payload = {
+        'orders': [
+            {'order_details': [
+                {'product_id': 'LZ129', 'quantity': 2},
+                {'product_id': 'LZ127', 'quantity': 3},
+            ]},
+            {'order_details': [
+                {'product_id': 'LZ127', 'quantity': 1},
+            ]},
+        ]
+    }
+
+    # delivered twice
+    for _ in range(2):
+        with entrypoint_waiter(service_container, 'handle_orders_created'):
+            dispatch('orders', 'orders_created', dict(payload, event_id=2))
+
+    product_one, product_two, product_three = [
+        redis_client.hgetall('products:{}'.format(id_))
+        for id_ in ('LZ127', 'LZ129', 'LZ130')]
+    assert b'6' == product_one[b'in_stock']
+    assert b'9' == product_two[b'in_stock']
+    assert b'12' == product_three[b'in_stock']
+
+
+@pytest.fixture
+def storage(service_container):
+    """ The `Storage` of the service, once it subscribed to invalidations
+
+    Subscribing clears the cache, so tests counting on cached products wait
+    for it first.
+    """
+    storage = get_extension(service_container, Storage)
+    with eventlet.Timeout(5):
+        while not storage.cache.generation:
+            eventlet.sleep(0.01)
+    return storage
+
+
+@pytest.mark.usefixtures('storage')
+def test_cache_stats(products, service_container):
+
+    with entrypoint_hook(service_container, 'get') as get:
+        get('LZ127')
+        get('LZ127')
+
+    with entrypoint_hook(service_container, 'cache_stats') as cache_stats:
+        stats = cache_stats()
+
+    assert 1 == stats['hits']
+    assert 1 == stats['misses']
+    assert 1 == stats['size']
+
+
+def test_cache_is_invalidated_by_other_instances(
+    products, redis_client, service_container, storage
+):
+
+    with entrypoint_hook(service_container, 'get') as get:
+        get('LZ127')
+    assert 1 == storage.cache.stats()['size']
+
+    # another instance, with its own cache, updates the product
+    StorageWrapper(redis_client).update('LZ127', {'in_stock': 3})
+
+    with eventlet.Timeout(5):
+        while storage.cache.stats()['size']:
+            eventlet.sleep(0.01)
+
+    with entrypoint_hook(service_container, 'get') as get:
+        assert 3 == get('LZ127')['in_stock']
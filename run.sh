@@ -8,7 +8,7 @@ if  [ $# == 0 ]; then
 fi
 
 # Setup env if not available
-export PYTHONPATH=./gateway:./orders:./products:./gateapi
+export PYTHONPATH=./common:./gateway:./orders:./products:./gateapi
 
 # Check if required env is set, if not exit in errors
 REQ_ENVS=(
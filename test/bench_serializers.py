@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Compare the compiled serializers of the services with the marshmallow
+schemas they replace, on payloads shaped like the ones on the hot paths:
+
+    python test/bench_serializers.py [--number 20] [--size 500]
+
+Needs the orders, products and gateway packages installed
+(`make install-dependencies`).
+"""
+import argparse
+import json
+import timeit
+from decimal import Decimal
+
+from gateway.schemas import GetOrderSchema
+from gateway.serializers import serialize_order as serialize_gateway_order
+from orders.models import Order, OrderDetail
+from orders.schemas import OrderSchema
+from orders.serializers import serialize_order
+from products.schemas import Product
+from products.serializers import serialize_product
+
+
+def make_product(index):
+    return {
+        'id': 'product_{}'.format(index),
+        'title': 'Product {}'.format(index),
+        'passenger_capacity': '100',
+        'maximum_speed': '5',
+        'in_stock': '{}'.format(index),
+    }
+
+
+def make_order(index, lines=5):
+    return Order(
+        id=index,
+        total_amount=Decimal('497.55'),
+        line_count=lines,
+        order_details=[
+            OrderDetail(
+                id=index * lines + line, product_id='product_{}'.format(line),
+                price=Decimal('99.51'), quantity=1)
+            for line in range(lines)
+        ]
+    )
+
+
+def make_gateway_order(index, lines=5):
+    return {
+        'id': index,
+        'total_amount': '497.55',
+        'line_count': lines,
+        'order_details': [
+            {
+                'id': index * lines + line,
+                'quantity': 1,
+                'product_id': 'product_{}'.format(line),
+                'image': 'http://example.com/product_{}.jpg'.format(line),
+                'price': '99.51',
+                'product': make_product(line),
+            }
+            for line in range(lines)
+        ],
+    }
+
+
+def cases(size):
+    products = [make_product(index) for index in range(size)]
+    orders = [make_order(index) for index in range(size)]
+    gateway_orders = [make_gateway_order(index) for index in range(size)]
+    return [
+        (
+            'products.list',
+            lambda: Product(many=True).dump(products).data,
+            lambda: [serialize_product(product) for product in products],
+        ),
+        (
+            'orders.list_orders',
+            lambda: OrderSchema(many=True).dump(orders).data,
+            lambda: [serialize_order(order) for order in orders],
+        ),
+        (
+            'gateway get_order',
+            lambda: [
+                GetOrderSchema().dumps(order).data for order in gateway_orders
+            ],
+            lambda: [
+                json.dumps(serialize_gateway_order(order))
+                for order in gateway_orders
+            ],
+        ),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--number', type=int, default=20)
+    parser.add_argument('--size', type=int, default=500)
+    args = parser.parse_args()
+
+    print('{:<20} {:>12} {:>12} {:>8}'.format(
+        'case', 'schema (ms)', 'compiled', 'speedup'))
+    for name, schema, compiled in cases(args.size):
+        # both must produce the very same JSON
+        assert json.dumps(schema()) == json.dumps(compiled()), name
+
+        schema_time = min(timeit.repeat(schema, number=args.number, repeat=3))
+        compiled_time = min(
+            timeit.repeat(compiled, number=args.number, repeat=3))
+        print('{:<20} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(
+            name,
+            schema_time / args.number * 1000,
+            compiled_time / args.number * 1000,
+            schema_time / compiled_time,
+        ))
+
+
+if __name__ == '__main__':
+    main()